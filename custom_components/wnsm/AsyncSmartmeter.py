@@ -1,36 +1,193 @@
 import asyncio
 import logging
-from asyncio import Future
-from datetime import datetime
+import random
+import time
+from collections import deque
+from datetime import date, datetime, timedelta
+from enum import Enum
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable
 
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.event import async_call_later
+from homeassistant.util import dt as dt_util
 
-from .api import Smartmeter
+from .api import AioSmartmeter
 from .api.constants import ValueType
+from .api.errors import SmartmeterError, SmartmeterQueryError
 from .const import ATTRS_METERREADINGS_CALL, ATTRS_BASEINFORMATION_CALL, ATTRS_CONSUMPTIONS_CALL, ATTRS_BEWEGUNGSDATEN, ATTRS_ZAEHLPUNKTE_CALL, ATTRS_HISTORIC_DATA, ATTRS_VERBRAUCH_CALL
 from .utils import translate_dict
 
 _LOGGER = logging.getLogger(__name__)
 
+# Tokens are renewed this many seconds before they expire (plus a random jitter)
+TOKEN_RENEWAL_MARGIN = 30
+TOKEN_RENEWAL_JITTER = 15
+# Lower bound for scheduling the next renewal, e.g. after a failed one
+TOKEN_RENEWAL_MIN_DELAY = 10
+
+# Backfills of bewegungsdaten are split into windows of about a month, their size adapts
+# to the observed latency and payload (bounded by the min/max days)
+BACKFILL_WINDOW_DAYS = 31
+BACKFILL_MIN_WINDOW_DAYS = 3
+BACKFILL_MAX_WINDOW_DAYS = 92
+BACKFILL_TARGET_SECONDS = 15
+BACKFILL_TARGET_VALUES = 10000
+# Windows requested concurrently (shared by all meters of an account)
+BACKFILL_CONCURRENCY = 3
+
+
+class _WindowSizer:
+    """Chooses the size of the next backfill window from the latency and payload of the previous ones"""
+
+    def __init__(self):
+        self.days = BACKFILL_WINDOW_DAYS
+
+    def observe(self, days: int, seconds: float, values: int) -> None:
+        candidates = [BACKFILL_MAX_WINDOW_DAYS]
+        if seconds > 0:
+            candidates.append(int(days * BACKFILL_TARGET_SECONDS / seconds))
+        if values > 0:
+            candidates.append(int(days * BACKFILL_TARGET_VALUES / values))
+        # move halfway to the target (at least a day) to smooth out single slow responses
+        target = max(min(candidates), BACKFILL_MIN_WINDOW_DAYS)
+        step = (target - self.days + (1 if target > self.days else 0)) // 2
+        self.days = max(BACKFILL_MIN_WINDOW_DAYS, min(BACKFILL_MAX_WINDOW_DAYS, self.days + step))
+
+    def shrink(self, days: int) -> None:
+        self.days = max(BACKFILL_MIN_WINDOW_DAYS, min(self.days, days // 2))
+
+
+# Marks the end of the values of a backfill window in its queue
+_END_OF_WINDOW = object()
+
+
+class _WindowFailed:
+    """Put into the queue of a backfill window that failed, instead of _END_OF_WINDOW"""
+
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+
+def _raise_failed(item: Any) -> Any:
+    if isinstance(item, _WindowFailed):
+        raise item.exception
+    return item
+
+
+def _flight_key(name: str, *args) -> tuple[Hashable, ...]:
+    """Key of an API call for the single-flight deduplication: endpoint plus normalized query"""
+    def normalize(value):
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if isinstance(value, Enum):
+            return value.value
+        return value
+    return (name, *(normalize(arg) for arg in args))
+
+
 class AsyncSmartmeter:
 
-    def __init__(self, hass: HomeAssistant, smartmeter: Smartmeter = None):
+    def __init__(self, hass: HomeAssistant, smartmeter: AioSmartmeter = None):
         self.hass = hass
         self.smartmeter = smartmeter
-        self.login_lock = asyncio.Lock()
+        # The in-flight token renewal (if any). Callers with a valid token never wait on it,
+        # callers finding the token expired all await the same renewal.
+        self._renewal: asyncio.Task | None = None
+        self._cancel_renewal_timer = None
+        # API calls in flight by their key, concurrent identical calls share one request
+        self._in_flight: dict[tuple, asyncio.Task] = {}
+        self._backfill_slots = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+
+    async def _single_flight(self, key: tuple, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        """
+        Runs func(*args) once for all concurrent callers using the same key.
+        The callers share the result (or exception), so the response must not be mutated.
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self.hass.async_create_task(func(*args))
+            self._in_flight[key] = task
+
+            def _done(finished: asyncio.Task) -> None:
+                if self._in_flight.get(key) is finished:
+                    del self._in_flight[key]
+                if not finished.cancelled():
+                    finished.exception()  # retrieved, even if all callers were cancelled
+
+            task.add_done_callback(_done)
+        else:
+            _LOGGER.debug("Joining in-flight request %s", key)
+        # shield: a cancelled caller must not cancel the request for everybody else
+        return await asyncio.shield(task)
+
+    async def _call(self, name: str, *args) -> Any:
+        """Calls the method name of the client, deduplicated by its normalized arguments"""
+        return await self._single_flight(_flight_key(name, *args), getattr(self.smartmeter, name), *args)
+
+    async def login(self) -> AioSmartmeter:
+        """
+        Ensures a valid access token. Returns without any I/O while the token is valid,
+        otherwise waits for the (single) renewal.
+        """
+        if self.smartmeter.is_logged_in():
+            if self._cancel_renewal_timer is None and (self._renewal is None or self._renewal.done()):
+                # e.g. tokens restored from the token store
+                self._schedule_renewal()
+            return self.smartmeter
+        return await self._renew(self.smartmeter.login)
+
+    async def _renew(self, renew_func) -> AioSmartmeter:
+        if self._renewal is None or self._renewal.done():
+            self._renewal = self.hass.async_create_task(self._async_renew(renew_func))
+        # shield: a cancelled caller must not cancel the renewal for everybody else
+        return await asyncio.shield(self._renewal)
+
+    async def _async_renew(self, renew_func) -> AioSmartmeter:
+        try:
+            return await renew_func()
+        finally:
+            self._schedule_renewal()
+
+    def _schedule_renewal(self) -> None:
+        """Schedules the background renewal shortly before the access token expires"""
+        self._cancel_scheduled_renewal()
+        expiration = self.smartmeter._access_token_expiration
+        if expiration is None:
+            return
+        delay = (expiration - datetime.now()).total_seconds() - TOKEN_RENEWAL_MARGIN \
+            - random.uniform(0, TOKEN_RENEWAL_JITTER)
+        delay = max(delay, TOKEN_RENEWAL_MIN_DELAY)
+        _LOGGER.debug("Scheduling token renewal in %.0f seconds", delay)
+        self._cancel_renewal_timer = async_call_later(self.hass, delay, self._handle_renewal_timer)
+
+    def _cancel_scheduled_renewal(self) -> None:
+        if self._cancel_renewal_timer is not None:
+            self._cancel_renewal_timer()
+            self._cancel_renewal_timer = None
+
+    @callback
+    def _handle_renewal_timer(self, _now) -> None:
+        self._cancel_renewal_timer = None
+        self.hass.async_create_background_task(self._async_background_renewal(), "wnsm token renewal")
+
+    async def _async_background_renewal(self) -> None:
+        try:
+            await self._renew(self.smartmeter.renew)
+        except Exception as exception:  # pylint: disable=broad-except
+            # The next caller (or the rescheduled renewal) tries again
+            _LOGGER.warning("Background token renewal failed: %s", exception)
 
-    async def login(self) -> Future:
-        async with self.login_lock:
-            return await self.hass.async_add_executor_job(self.smartmeter.login)
+    @callback
+    def async_stop(self) -> None:
+        """Stops the background token renewal"""
+        self._cancel_scheduled_renewal()
 
     async def get_meter_readings(self) -> dict[str, any]:
         """
         asynchronously get and parse /meterReadings response
         Returns response already sanitized of the specified zaehlpunkt in ctor
         """
-        response = await self.hass.async_add_executor_job(
-            self.smartmeter.historical_data,
-        )
+        response = await self._call("historical_data")
         if "Exception" in response:
             raise RuntimeError("Cannot access /meterReadings: ", response)
         return translate_dict(response, ATTRS_METERREADINGS_CALL)
@@ -41,7 +198,7 @@ class AsyncSmartmeter:
         asynchronously get and parse /baseInformation response
         Returns response already sanitized of the specified zaehlpunkt in ctor
         """
-        response = await self.hass.async_add_executor_job(self.smartmeter.base_information)
+        response = await self._call("base_information")
         if "Exception" in response:
             raise RuntimeError("Cannot access /baseInformation: ", response)
         return translate_dict(response, ATTRS_BASEINFORMATION_CALL)
@@ -64,23 +221,34 @@ class AsyncSmartmeter:
         asynchronously get and parse /zaehlpunkt response
         Returns response already sanitized of the specified zaehlpunkt in ctor
         """
-        contracts = await self.hass.async_add_executor_job(self.smartmeter.zaehlpunkte)
-        zaehlpunkte = self.contracts2zaehlpunkte(contracts, zaehlpunkt)
-        zp = [z for z in zaehlpunkte if z["zaehlpunktnummer"] == zaehlpunkt]
-        if len(zp) == 0:
-            raise RuntimeError(f"Zaehlpunkt {zaehlpunkt} not found")
+        try:
+            # served from the client's contract index, which is refreshed after its TTL
+            # (once for all meters asking concurrently)
+            if not self.smartmeter._is_zaehlpunkt_index_valid():
+                await self._call("zaehlpunkte")
+            info = await self.smartmeter.get_zaehlpunkt_info(zaehlpunkt)
+        except SmartmeterQueryError as exception:
+            raise RuntimeError(f"Zaehlpunkt {zaehlpunkt} not found") from exception
+        return translate_dict({**info.details, "geschaeftspartner": info.customer_id}, ATTRS_ZAEHLPUNKTE_CALL)
 
-        return (
-            translate_dict(zp[0], ATTRS_ZAEHLPUNKTE_CALL)
-            if len(zp) > 0
-            else None
-        )
+    async def get_zaehlpunkte_details(self) -> dict[str, dict[str, str]]:
+        """
+        Fetches the contracts once and returns the translated details (like get_zaehlpunkt) of all
+        zaehlpunkte by their zaehlpunktnummer, e.g. to share them between the meters of a refresh
+        """
+        contracts = await self._call("zaehlpunkte")
+        if not isinstance(contracts, list) or len(contracts) == 0:
+            raise RuntimeError("Cannot access Zaehlpunkte")
+        details = {}
+        for contract in contracts:
+            for zaehlpunkt in contract.get("zaehlpunkte") or []:
+                details.setdefault(zaehlpunkt["zaehlpunktnummer"], translate_dict(
+                    {**zaehlpunkt, "geschaeftspartner": contract.get("geschaeftspartner")}, ATTRS_ZAEHLPUNKTE_CALL))
+        return details
 
     async def get_consumption(self, customer_id: str, zaehlpunkt: str, start_date: datetime):
         """Return 24h of hourly consumption starting from a date"""
-        response = await self.hass.async_add_executor_job(
-            self.smartmeter.verbrauch, customer_id, zaehlpunkt, start_date
-        )
+        response = await self._call("verbrauch", customer_id, zaehlpunkt, start_date)
         if "Exception" in response:
             raise RuntimeError(f"Cannot access daily consumption: {response}")
 
@@ -88,9 +256,7 @@ class AsyncSmartmeter:
 
     async def get_consumption_raw(self, customer_id: str, zaehlpunkt: str, start_date: datetime):
         """Return daily consumptions from the given start date until today"""
-        response = await self.hass.async_add_executor_job(
-            self.smartmeter.verbrauchRaw, customer_id, zaehlpunkt, start_date
-        )
+        response = await self._call("verbrauchRaw", customer_id, zaehlpunkt, start_date)
         if "Exception" in response:
             raise RuntimeError(f"Cannot access daily consumption: {response}")
 
@@ -98,13 +264,7 @@ class AsyncSmartmeter:
 
     async def get_historic_data(self, zaehlpunkt: str, date_from: datetime = None, date_to: datetime = None, granularity: ValueType = ValueType.QUARTER_HOUR):
         """Return three years of historic quarter-hourly data"""
-        response = await self.hass.async_add_executor_job(
-            self.smartmeter.historical_data,
-            zaehlpunkt,
-            date_from,
-            date_to,
-            granularity
-        )
+        response = await self._call("historical_data", zaehlpunkt, date_from, date_to, granularity)
         if "Exception" in response:
             raise RuntimeError(f"Cannot access historic data: {response}")
         _LOGGER.debug(f"Raw historical data: {response}")
@@ -112,13 +272,7 @@ class AsyncSmartmeter:
 
     async def get_meter_reading_from_historic_data(self, zaehlpunkt: str, start_date: datetime, end_date: datetime) -> float:
         """Return daily meter readings from the given start date until today"""
-        response = await self.hass.async_add_executor_job(
-            self.smartmeter.historical_data,
-            zaehlpunkt,
-            start_date,
-            end_date,
-            ValueType.METER_READ
-        )
+        response = await self._call("historical_data", zaehlpunkt, start_date, end_date, ValueType.METER_READ)
         if "Exception" in response:
             raise RuntimeError(f"Cannot access historic data: {response}")
         _LOGGER.debug(f"Raw historical data: {response}")
@@ -138,26 +292,173 @@ class AsyncSmartmeter:
                 or zaehlpunkt_response["smartMeterReady"]
         )
 
-    async def get_bewegungsdaten(self, zaehlpunkt: str, start: datetime = None, end: datetime = None, granularity: ValueType = ValueType.QUARTER_HOUR):
-        """Return three years of historic quarter-hourly data"""
-        response = await self.hass.async_add_executor_job(
-            self.smartmeter.bewegungsdaten,
-            zaehlpunkt,
-            start,
-            end,
-            granularity
-        )
+    async def get_bewegungsdaten(self, zaehlpunkt: str, start: datetime = None, end: datetime = None,
+                                 granularity: ValueType = ValueType.QUARTER_HOUR, cached: bool = True):
+        """Return three years of historic quarter-hourly data (with cached False not served from the response cache)"""
+        response = await self._call("bewegungsdaten", zaehlpunkt, start, end, granularity, None, cached)
         if "Exception" in response:
             raise RuntimeError(f"Cannot access bewegungsdaten: {response}")
         _LOGGER.debug(f"Raw bewegungsdaten: {response}")
         return translate_dict(response, ATTRS_BEWEGUNGSDATEN)
 
+    async def stream_bewegungsdaten(
+            self, zaehlpunkt: str, start: datetime = None, end: datetime = None, granularity: ValueType = ValueType.QUARTER_HOUR
+    ) -> AsyncIterator[tuple[dict, list[dict]]]:
+        """
+        Like get_bewegungsdaten, but yields the values in batches while the response is received
+        as (translated bewegungsdaten without values, values). Not deduplicated with concurrent calls.
+        """
+        async for batch in self.smartmeter.bewegungsdaten_stream(zaehlpunkt, start, end, granularity):
+            head = translate_dict(batch.envelope or {}, ATTRS_BEWEGUNGSDATEN)
+            head.pop("values", None)
+            yield head, batch.values
+
+    async def iter_bewegungsdaten_windows(
+            self, zaehlpunkt: str, start: datetime, end: datetime, granularity: ValueType = ValueType.QUARTER_HOUR
+    ) -> AsyncIterator[tuple[datetime, date, dict, AsyncIterator[list[dict]]]]:
+        """
+        Fetches bewegungsdaten from start until (including) the day of end in windows of about a month.
+        Windows are requested concurrently (bounded by BACKFILL_CONCURRENCY), their size adapts to
+        the observed latency and payload and a window timing out is split and retried.
+        Yields (window start, last day of the window, translated bewegungsdaten without values, batches of
+        its values) in chronological order. The batches have to be consumed before the next window:
+        the window consumed is streamed, only the windows fetched ahead buffer their batches until then.
+        """
+        sizer = _WindowSizer()
+        last_day = end.date()
+        next_start = start
+        pending: deque[tuple[datetime, date, asyncio.Queue, asyncio.Task]] = deque()
+
+        def schedule() -> None:
+            nonlocal next_start
+            window_end = min(next_start.date() + timedelta(days=sizer.days - 1), last_day)
+            queue = asyncio.Queue()
+            task = self.hass.async_create_task(
+                self._stream_bewegungsdaten_window(zaehlpunkt, next_start, window_end, granularity, sizer, queue))
+            pending.append((next_start, window_end, queue, task))
+            next_start = datetime.combine(window_end + timedelta(days=1), datetime.min.time(), start.tzinfo)
+
+        async def batches(queue: asyncio.Queue) -> AsyncIterator[list[dict]]:
+            while (batch := _raise_failed(await queue.get())) is not _END_OF_WINDOW:
+                yield batch
+
+        try:
+            while pending or next_start.date() <= last_day:
+                while len(pending) < BACKFILL_CONCURRENCY and next_start.date() <= last_day:
+                    schedule()
+                window_start, window_end, queue, task = pending[0]
+                head = _raise_failed(await queue.get())
+                yield window_start, window_end, head, batches(queue)
+                # the window has been consumed
+                await task
+                pending.popleft()
+        finally:
+            for _, _, _, task in pending:
+                task.cancel()
+
+    async def _stream_bewegungsdaten_window(self, zaehlpunkt: str, start: datetime, last_day: date,
+                                            granularity: ValueType, sizer: _WindowSizer, queue: asyncio.Queue) -> None:
+        """
+        Puts the translated bewegungsdaten (without values) of the window into the queue, followed by
+        the batches of values and _END_OF_WINDOW (or the exception the window failed with)
+        """
+        try:
+            head, _ = await self._fetch_bewegungsdaten_window(zaehlpunkt, start, last_day, granularity, sizer, queue)
+            if head is None:
+                queue.put_nowait({})
+            queue.put_nowait(_END_OF_WINDOW)
+        except Exception as exception:  # pylint: disable=broad-except
+            # raised by the consumer of the window
+            queue.put_nowait(_WindowFailed(exception))
+
+    async def _fetch_bewegungsdaten_window(self, zaehlpunkt: str, start: datetime, last_day: date,
+                                           granularity: ValueType, sizer: _WindowSizer, queue: asyncio.Queue,
+                                           head: dict | None = None, skip: int = 0) -> tuple[dict | None, int]:
+        """
+        Streams the values of the window into the queue (preceded by the head, unless it is given already),
+        skipping the first skip values (put into the queue by a previous attempt).
+        Returns the head (if any) and the number of values of the window.
+        """
+        days = (last_day - start.date()).days + 1
+        seen = 0
+        try:
+            async with self._backfill_slots:
+                began = time.monotonic()
+                # streamed, so that only the values (and not the raw response) are held in memory
+                async for batch_head, batch in self.stream_bewegungsdaten(zaehlpunkt, start, last_day, granularity):
+                    if head is None:
+                        head = batch_head
+                        queue.put_nowait(head)
+                    if seen + len(batch) > skip:
+                        queue.put_nowait(batch[max(0, skip - seen):])
+                    seen += len(batch)
+                sizer.observe(days, time.monotonic() - began, seen)
+                return head, seen
+        except TimeoutError:
+            if days < 2:
+                raise
+            _LOGGER.debug("Window %s - %s of %s timed out, splitting it", start, last_day, zaehlpunkt)
+            sizer.shrink(days)
+            # the halves return the same values again, the ones already in the queue are skipped
+            skip = max(skip, seen)
+            middle = start.date() + timedelta(days=days // 2)
+            head, first = await self._fetch_bewegungsdaten_window(
+                zaehlpunkt, start, middle - timedelta(days=1), granularity, sizer, queue, head, skip)
+            head, second = await self._fetch_bewegungsdaten_window(
+                zaehlpunkt, datetime.combine(middle, datetime.min.time(), start.tzinfo), last_day, granularity, sizer,
+                queue, head, max(0, skip - first))
+            return head, first + second
+
+    async def find_first_data(self, zaehlpunkt: str, start: datetime, end: datetime) -> datetime | None:
+        """
+        Returns the start of the first day with measured values between start and end (None if there is none),
+        so that an initial import skips the years before the meter was installed.
+        The daily historical data is queried first, a binary search over days of bewegungsdaten is the fallback.
+        """
+        try:
+            daily = await self.get_historic_data(zaehlpunkt, start.date(), end.date(), ValueType.DAY)
+        except (SmartmeterError, RuntimeError) as exception:
+            _LOGGER.debug("Daily historical data of %s not available: %s", zaehlpunkt, exception)
+        else:
+            values = daily.get("values") or []
+            for value in values:
+                if value.get("messwert") is not None and value.get("zeitVon"):
+                    return max(start, dt_util.parse_datetime(value["zeitVon"]))
+            if values:
+                return None
+        return await self._search_first_bewegungsdaten(zaehlpunkt, start, end)
+
+    async def _search_first_bewegungsdaten(self, zaehlpunkt: str, start: datetime, end: datetime) -> datetime | None:
+        """Binary search for the first day with bewegungsdaten (values are assumed to be present from then on)"""
+
+        async def first_value(day: date) -> datetime | None:
+            day_start = max(start, datetime.combine(day, datetime.min.time(), start.tzinfo))
+            data = await self.get_bewegungsdaten(zaehlpunkt, day_start, day)
+            for value in data.get("values") or []:
+                if value.get("wert") is not None:
+                    return dt_util.parse_datetime(value["zeitpunktVon"])
+            return None
+
+        low, high = start.date(), end.date()
+        if await first_value(high) is None:
+            # the last day might not be published yet, try the one before
+            high -= timedelta(days=1)
+            if high < low or await first_value(high) is None:
+                return None
+        while low < high:
+            middle = low + (high - low) // 2
+            if await first_value(middle) is None:
+                low = middle + timedelta(days=1)
+            else:
+                high = middle
+        return await first_value(low)
+
     async def get_consumptions(self) -> dict[str, str]:
         """
         asynchronously get and parse /consumptions response
         Returns response already sanitized of the specified zaehlpunkt in ctor
         """
-        response = await self.hass.async_add_executor_job(self.smartmeter.consumptions)
+        response = await self._call("consumptions")
         if "Exception" in response:
             raise RuntimeError("Cannot access /consumptions: ", response)
-        return translate_dict(response, ATTRS_CONSUMPTIONS_CALL)
\ No newline at end of file
+        return translate_dict(response, ATTRS_CONSUMPTIONS_CALL)
@@ -1,9 +1,12 @@
 """Set up the Wiener Netze SmartMeter Integration component."""
 import logging
+import shutil
+from functools import partial
+
 from homeassistant import core, config_entries
 
 from .const import DOMAIN
-from .coordinator import WienerNetzeCoordinator
+from .coordinator import WienerNetzeCoordinator, response_cache_path
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -26,15 +29,29 @@ async def async_setup_entry(
     
     # Fetch initial data so we have data when entities subscribe
     # We do this AFTER adding to hass.data, just in case something needs it
-    try:
-        await coordinator.async_config_entry_first_refresh()
-        _LOGGER.debug("Coordinator refresh successful")
-    except Exception as e:
-        _LOGGER.warning("Initial coordinator refresh failed: %s", e)
-        # We continue anyway, the coordinator will retry
+    if await coordinator.async_restore_snapshot():
+        # The sensors start with the data from before the restart, the refresh runs in the background
+        entry.async_create_background_task(hass, coordinator.async_refresh(), f"{DOMAIN} first refresh")
+    else:
+        try:
+            await coordinator.async_config_entry_first_refresh()
+            _LOGGER.debug("Coordinator refresh successful")
+        except Exception as e:
+            _LOGGER.warning("Initial coordinator refresh failed: %s", e)
+            # We continue anyway, the coordinator will retry
 
     # Forward the setup to the sensor platform.
     await hass.config_entries.async_forward_entry_setups(entry, ["sensor"])
     _LOGGER.debug("Forwarded setup to sensor platform")
 
     return True
+
+
+async def async_remove_entry(
+        hass: core.HomeAssistant,
+        entry: config_entries.ConfigEntry
+) -> None:
+    """Remove the cached responses of a removed ConfigEntry."""
+    path = response_cache_path(hass, entry.entry_id)
+    await hass.async_add_executor_job(partial(shutil.rmtree, path, ignore_errors=True))
+    _LOGGER.debug("Removed the response cache %s", path)
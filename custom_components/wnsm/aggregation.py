@@ -0,0 +1,218 @@
+"""
+Aggregation of quarter hour bewegungsdaten into hourly statistics
+
+Works on whole arrays with NumPy (if available), otherwise falls back to plain Python.
+Both implementations behave the same:
+* values without a measurement ('wert' is None) are skipped
+* values older than a previous value (or the start) are skipped (out of order)
+* values not aligned to quarter hours are reported, but still added to their hour
+
+Energy is accounted in integer milli-Wh (exact for the three decimals of kWh the API reports),
+it is only converted to kWh for the statistics (see `from_milli_wh`).
+"""
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timezone
+from typing import Any, NamedTuple, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy ships with HA, but is not a requirement of this integration
+    np = None
+
+_LOGGER = logging.getLogger(__name__)
+
+QUARTER_HOUR_MS = 15 * 60 * 1000
+HOUR_MS = 60 * 60 * 1000
+
+MILLI_WH_PER_WH = 1000
+MILLI_WH_PER_KWH = 1000 * MILLI_WH_PER_WH
+
+
+def to_milli_wh(kwh: float | str) -> int:
+    """Converts kWh (e.g. the sum of a statistic) to integer milli-Wh"""
+    return round(float(kwh) * MILLI_WH_PER_KWH)
+
+
+def from_milli_wh(milli_wh: int) -> float:
+    """Converts integer milli-Wh to kWh (for the statistics)"""
+    return milli_wh / MILLI_WH_PER_KWH
+
+
+class HourlyStatistics(NamedTuple):
+    """Hourly usage and running sums (including the given offset) in milli-Wh in chronological order"""
+    hours: list[datetime]
+    usage: list[int]
+    sums: list[int]
+    estimated: int  #: number of estimated values
+    skipped: int  #: number of out of order values
+    latest: datetime | None = None  #: timestamp of the latest value in order (the start for following values)
+    estimated_hours: tuple[datetime, ...] = ()  #: hours containing estimated values
+    measured: tuple[tuple[datetime, datetime], ...] = ()  #: runs (start, end) of consecutive measured quarter hours
+
+
+def _epoch_ms(timestamp: str) -> int:
+    return int(datetime.fromisoformat(timestamp).timestamp() * 1000)
+
+
+def _hour(epoch_ms: int) -> datetime:
+    return datetime.fromtimestamp(epoch_ms // 1000, timezone.utc)
+
+
+def _runs(runs) -> tuple[tuple[datetime, datetime], ...]:
+    return tuple((_timestamp(int(start)), _timestamp(int(end))) for start, end in runs)
+
+
+def _timestamp(epoch_ms: int | None) -> datetime | None:
+    return None if epoch_ms is None else datetime.fromtimestamp(epoch_ms / 1000, timezone.utc)
+
+
+def aggregate_hourly(values: Sequence[dict[str, Any]], scale: int = MILLI_WH_PER_KWH, start: datetime = None,
+                     total: int = 0) -> HourlyStatistics:
+    """
+    Sums up the bewegungsdaten values ('zeitpunktVon', 'wert', 'geschaetzt') per hour (UTC).
+    scale converts a 'wert' to milli-Wh (MILLI_WH_PER_KWH or MILLI_WH_PER_WH).
+    Values before start are skipped, the running sums start at total (milli-Wh).
+    """
+    start_ms = None if start is None else int(start.timestamp() * 1000)
+    if np is not None:
+        return _aggregate_numpy(values, scale, start_ms, total)
+    return _aggregate_python(values, scale, start_ms, total)
+
+
+def _aggregate_python(values, scale, start_ms, total) -> HourlyStatistics:
+    hours, usage, sums = [], [], []
+    estimated = skipped = 0
+    estimated_hours = []
+    runs = []
+    last_ms = start_ms
+    for value in values:
+        ts = _epoch_ms(value["zeitpunktVon"])
+        if last_ms is not None and ts < last_ms:
+            skipped += 1
+            continue
+        last_ms = ts
+        if value.get("wert") is None:
+            continue
+        if ts % QUARTER_HOUR_MS != 0:
+            _LOGGER.warning("Unexpected time detected in historic data: %s", value)
+        if runs and runs[-1][1] >= ts:
+            runs[-1][1] = max(runs[-1][1], ts + QUARTER_HOUR_MS)
+        else:
+            runs.append([ts, ts + QUARTER_HOUR_MS])
+        hour = ts - ts % HOUR_MS
+        if value.get("geschaetzt"):
+            estimated += 1
+            if not estimated_hours or estimated_hours[-1] != hour:
+                estimated_hours.append(hour)
+        reading = round(value["wert"] * scale)
+        if usage and hours[-1] == hour:
+            usage[-1] += reading
+        else:
+            hours.append(hour)
+            usage.append(reading)
+    for hourly_usage in usage:
+        total += hourly_usage
+        sums.append(total)
+    return HourlyStatistics([_hour(hour) for hour in hours], usage, sums, estimated, skipped, _timestamp(last_ms),
+                            tuple(_hour(hour) for hour in estimated_hours), _runs(runs))
+
+
+def _parse_epochs_ms(timestamps: list[str]) -> np.ndarray:
+    """Parses ISO timestamps into an int64 array of epoch milliseconds"""
+    if all(timestamp.endswith("Z") for timestamp in timestamps):
+        # numpy only parses naive timestamps, they are UTC anyway
+        return np.array([timestamp[:-1] for timestamp in timestamps], dtype="datetime64[ms]").astype(np.int64)
+    return np.fromiter((_epoch_ms(timestamp) for timestamp in timestamps), dtype=np.int64, count=len(timestamps))
+
+
+def _aggregate_numpy(values, scale, start_ms, total) -> HourlyStatistics:
+    if len(values) == 0:
+        return HourlyStatistics([], [], [], 0, 0, _timestamp(start_ms))
+    ts = _parse_epochs_ms([value["zeitpunktVon"] for value in values])
+    readings = np.array([value.get("wert") for value in values], dtype=np.float64)  # None -> nan
+    estimated_flags = np.fromiter((bool(value.get("geschaetzt")) for value in values), dtype=bool, count=len(values))
+
+    # A value is in order if it is not older than any previous value (and the start)
+    lower_bound = np.iinfo(np.int64).min if start_ms is None else start_ms
+    previous_max = np.maximum(np.concatenate(([lower_bound], np.maximum.accumulate(ts)[:-1])), lower_bound)
+    in_order = ts >= previous_max
+    latest = _timestamp(max(int(ts.max()), start_ms if start_ms is not None else int(ts.max())))
+    measured = in_order & ~np.isnan(readings)
+
+    misaligned = measured & (ts % QUARTER_HOUR_MS != 0)
+    for index in np.flatnonzero(misaligned):
+        _LOGGER.warning("Unexpected time detected in historic data: %s", values[index])
+
+    ts, readings = ts[measured], np.rint(readings[measured] * scale).astype(np.int64)
+    if len(ts) == 0:
+        return HourlyStatistics([], [], [], 0, int((~in_order).sum()), latest)
+    hours = ts - ts % HOUR_MS
+    estimated_hours = np.unique(hours[estimated_flags[measured]])
+    # a run of measured quarter hours ends where the next value is more than a quarter hour later
+    breaks = np.flatnonzero(ts[1:] > ts[:-1] + QUARTER_HOUR_MS) + 1
+    runs = zip(ts[np.concatenate(([0], breaks))], ts[np.concatenate((breaks - 1, [len(ts) - 1]))] + QUARTER_HOUR_MS)
+    # values in order, hence each hour is a contiguous run
+    boundaries = np.flatnonzero(np.concatenate(([True], hours[1:] != hours[:-1])))
+    usage = np.add.reduceat(readings, boundaries)
+    sums = np.cumsum(usage) + int(total)
+    return HourlyStatistics(
+        [_hour(int(hour)) for hour in hours[boundaries]],
+        usage.tolist(),
+        sums.tolist(),
+        int((estimated_flags & measured).sum()),
+        int((~in_order).sum()),
+        latest,
+        tuple(_hour(int(hour)) for hour in estimated_hours),
+        _runs(runs),
+    )
+
+
+class HourlyAccumulator:
+    """
+    Aggregates a stream of value batches (e.g. of a streamed response) into hourly statistics.
+    The last hour of a batch may continue in the next one, hence it is only returned
+    by the following `feed` (or by `flush` at the end).
+    """
+
+    def __init__(self, scale: int = MILLI_WH_PER_KWH, start: datetime = None, total: int = 0):
+        self.scale = scale
+        self.total = total  #: sum (milli-Wh) of all hours returned so far
+        self.estimated = 0
+        self.skipped = 0
+        self.estimated_hours: set[datetime] = set()  #: hours containing estimated values
+        self.measured: list[tuple[datetime, datetime]] = []  #: runs of measured quarter hours
+        self._latest = start
+        self._carry: tuple[datetime, int] | None = None
+
+    def feed(self, values: Sequence[dict[str, Any]]) -> list[tuple[datetime, int, int]]:
+        """Adds a batch of values, returns the completed hours as (start, usage, sum)"""
+        hourly = aggregate_hourly(values, self.scale, self._latest)
+        self.estimated += hourly.estimated
+        self.skipped += hourly.skipped
+        self.estimated_hours.update(hourly.estimated_hours)
+        self.measured.extend(hourly.measured)
+        self._latest = hourly.latest
+        rows = list(zip(hourly.hours, hourly.usage))
+        if self._carry is not None:
+            if rows and rows[0][0] == self._carry[0]:
+                rows[0] = (self._carry[0], self._carry[1] + rows[0][1])
+            else:
+                rows.insert(0, self._carry)
+            self._carry = None
+        if rows:
+            self._carry = rows.pop()
+        return self._emit(rows)
+
+    def flush(self) -> list[tuple[datetime, int, int]]:
+        """Returns the last (carried over) hour"""
+        rows, self._carry = ([self._carry] if self._carry is not None else []), None
+        return self._emit(rows)
+
+    def _emit(self, rows: list[tuple[datetime, int]]) -> list[tuple[datetime, int, int]]:
+        result = []
+        for hour, usage in rows:
+            self.total += usage
+            result.append((hour, usage, self.total))
+        return result
@@ -2,10 +2,13 @@
 from importlib.metadata import version
 
 from .client import Smartmeter
+from .aio import AioSmartmeter
+from .response_cache import ResponseCache, FileResponseCache
+from .token_store import TokenStore, FileTokenStore
 
 try:
     __version__ = version(__name__)
 except Exception:  # pylint: disable=broad-except
     pass
 
-__all__ = ["Smartmeter"]
+__all__ = ["Smartmeter", "AioSmartmeter", "TokenStore", "FileTokenStore", "ResponseCache", "FileResponseCache"]
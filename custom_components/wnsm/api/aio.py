@@ -0,0 +1,240 @@
+"""Contains the asyncio Smartmeter API Client."""
+import asyncio
+import logging
+from datetime import datetime, date
+from typing import AsyncIterator
+
+import aiohttp
+
+from . import constants as const
+from .protocol import SmartmeterProtocol, HttpRequest, HttpResponse, BlockingCall, ReadChunk, Emit, ValuesBatch, ZaehlpunktInfo
+from .response_cache import ResponseCache
+from .token_store import TokenStore
+
+logger = logging.getLogger(__name__)
+
+
+class AioSmartmeter(SmartmeterProtocol):
+    """Smartmeter client (asyncio, based on aiohttp)."""
+
+    def __init__(self, username, password, input_code_verifier=None, token_store: TokenStore = None,
+                 session: aiohttp.ClientSession = None, response_cache: ResponseCache = None):
+        """Access the Smartmeter API.
+
+        Args:
+            username (str): Username used for API Login.
+            password (str): Password used for API Login.
+            token_store (TokenStore, optional): Persists tokens and API keys,
+                so that they can be reused by the next instance (e.g. after a restart).
+            session (aiohttp.ClientSession, optional): Session to send the requests with.
+                Its cookie jar is used for the login, so it should not be shared with other clients.
+                If None, an own session is created (and closed by `close`).
+            response_cache (ResponseCache, optional): Caches immutable days of historical data.
+        """
+        super().__init__(username, password, input_code_verifier, token_store, response_cache)
+        self.session = session
+        self._owns_session = session is None
+
+    def reset(self):
+        super().reset()
+        if self.session is not None:
+            self.session.cookie_jar.clear()
+
+    async def close(self):
+        """Closes the session, if it was created by this client"""
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _perform(self, effect):
+        if isinstance(effect, BlockingCall):
+            return await asyncio.get_running_loop().run_in_executor(None, effect.func, *effect.args)
+        if not isinstance(effect, HttpRequest):
+            raise TypeError(f"Unknown effect {effect!r}")
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        async with self.session.request(
+            effect.method,
+            effect.url,
+            headers=effect.headers,
+            data=effect.data,
+            json=effect.json,
+            allow_redirects=effect.allow_redirects,
+            timeout=aiohttp.ClientTimeout(total=effect.timeout),
+        ) as response:
+            content = await response.read()
+            return HttpResponse(response.status, response.headers, content, str(response.url))
+
+    async def _run_stream(self, flow) -> AsyncIterator:
+        """Drives a streaming flow, yields the items it emits"""
+        response = content = None
+        try:
+            effect = next(flow)
+            while True:
+                if isinstance(effect, Emit):
+                    yield effect.item
+                    effect = flow.send(None)
+                    continue
+                if isinstance(effect, ReadChunk) and content is None:
+                    raise RuntimeError("Cannot read a chunk before the streamed request was answered")
+                try:
+                    if isinstance(effect, ReadChunk):
+                        result = await content.read(const.STREAM_CHUNK_SIZE)
+                    elif isinstance(effect, HttpRequest) and effect.stream:
+                        if self.session is None:
+                            self.session = aiohttp.ClientSession()
+                        # the timeout applies to every read, not to the whole (large) response
+                        response = await self.session.request(
+                            effect.method,
+                            effect.url,
+                            headers=effect.headers,
+                            data=effect.data,
+                            json=effect.json,
+                            allow_redirects=effect.allow_redirects,
+                            timeout=aiohttp.ClientTimeout(sock_connect=effect.timeout, sock_read=effect.timeout),
+                        )
+                        content = response.content
+                        result = HttpResponse(response.status, response.headers, b"", str(response.url))
+                    else:
+                        result = await self._perform(effect)
+                except Exception as exception:  # pylint: disable=broad-except
+                    effect = flow.throw(exception)
+                else:
+                    effect = flow.send(result)
+        except StopIteration:
+            return
+        finally:
+            flow.close()
+            if response is not None:
+                response.release()
+
+    async def _run(self, flow):
+        """Drives a flow of the protocol until it returns"""
+        try:
+            effect = next(flow)
+            while True:
+                try:
+                    result = await self._perform(effect)
+                except Exception as exception:  # pylint: disable=broad-except
+                    effect = flow.throw(exception)
+                else:
+                    effect = flow.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+    async def refresh(self):
+        """
+        renew the access token with the refresh token (a single request)
+        """
+        return await self._run(self._refresh_flow())
+
+    async def renew(self):
+        """
+        renew the tokens ahead of their expiry: with the refresh token if possible,
+        otherwise with a full credentials login
+        """
+        return await self._run(self._renew_flow())
+
+    async def login(self):
+        """
+        login with credentials specified in ctor
+
+        An expired access token is renewed with the refresh token if possible,
+        the full credentials login is only performed if that is not possible.
+        """
+        return await self._run(self._login_flow())
+
+    async def get_zaehlpunkt(self, zaehlpunkt: str = None) -> tuple[str, str, const.AnlagenType]:
+        """Returns customer id, zaehlpunkt and anlagetype, looked up in the cached contracts."""
+        return await self._run(self._get_zaehlpunkt_flow(zaehlpunkt))
+
+    async def get_zaehlpunkt_info(self, zaehlpunkt: str = None) -> ZaehlpunktInfo:
+        """Returns the cached index entry (including the raw details) of a zaehlpunkt."""
+        return await self._run(self._zaehlpunkt_info_flow(zaehlpunkt))
+
+    async def zaehlpunkte(self):
+        """Returns zaehlpunkte for currently logged in user."""
+        return await self._run(self._zaehlpunkte_flow())
+
+    async def consumptions(self):
+        """Returns response from 'consumptions' endpoint."""
+        return await self._run(self._consumptions_flow())
+
+    async def base_information(self):
+        """Returns response from 'baseInformation' endpoint."""
+        return await self._run(self._base_information_flow())
+
+    async def meter_readings(self):
+        """Returns response from 'meterReadings' endpoint."""
+        return await self._run(self._meter_readings_flow())
+
+    async def verbrauch(
+        self,
+        customer_id: str,
+        zaehlpunkt: str,
+        date_from: datetime,
+        resolution: const.Resolution = const.Resolution.HOUR
+    ):
+        """Returns hourly or quarter hour consumptions for 24 hours after date_from."""
+        return await self._run(self._verbrauch_flow(customer_id, zaehlpunkt, date_from, resolution))
+
+    async def verbrauchRaw(
+        self,
+        customer_id: str,
+        zaehlpunkt: str,
+        date_from: datetime,
+        date_to: datetime = None,
+    ):
+        """Returns daily consumptions between date_from and date_to."""
+        return await self._run(self._verbrauch_raw_flow(customer_id, zaehlpunkt, date_from, date_to))
+
+    async def profil(self):
+        """Returns profile of a logged-in user."""
+        return await self._run(self._profil_flow())
+
+    async def ereignisse(
+        self, date_from: datetime, date_to: datetime = None, zaehlpunkt=None
+    ):
+        """Returns events between date_from and date_to of a specific smart meter."""
+        return await self._run(self._ereignisse_flow(date_from, date_to, zaehlpunkt))
+
+    async def create_ereignis(self, zaehlpunkt, name, date_from, date_to=None):
+        """Creates new event."""
+        return await self._run(self._create_ereignis_flow(zaehlpunkt, name, date_from, date_to))
+
+    async def delete_ereignis(self, ereignis_id):
+        """Deletes ereignis."""
+        return await self._run(self._delete_ereignis_flow(ereignis_id))
+
+    async def historical_data(
+        self,
+        zaehlpunktnummer: str = None,
+        date_from: date = None,
+        date_until: date = None,
+        valuetype: const.ValueType = const.ValueType.METER_READ
+    ):
+        """Query historical data in a batch (see `Smartmeter.historical_data`)."""
+        return await self._run(self._historical_data_flow(zaehlpunktnummer, date_from, date_until, valuetype))
+
+    async def bewegungsdaten(
+        self,
+        zaehlpunktnummer: str = None,
+        date_from: date = None,
+        date_until: date = None,
+        valuetype: const.ValueType = const.ValueType.QUARTER_HOUR,
+        aggregat: str = None,
+        cached: bool = True,
+    ):
+        """Query historical data in a batch (see `Smartmeter.bewegungsdaten`)."""
+        return await self._run(self._bewegungsdaten_flow(zaehlpunktnummer, date_from, date_until, valuetype, aggregat, cached))
+
+    def bewegungsdaten_stream(
+        self,
+        zaehlpunktnummer: str = None,
+        date_from: date = None,
+        date_until: date = None,
+        valuetype: const.ValueType = const.ValueType.QUARTER_HOUR,
+        aggregat: str = None,
+    ) -> AsyncIterator[ValuesBatch]:
+        """Query historical data streamed in batches (see `Smartmeter.bewegungsdaten_stream`)."""
+        return self._run_stream(self._bewegungsdaten_stream_flow(zaehlpunktnummer, date_from, date_until, valuetype, aggregat))
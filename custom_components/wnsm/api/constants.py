@@ -10,6 +10,10 @@ API_URL_ALT = "https://service.wienernetze.at/sm/api/"
 API_URL = "https://api.wstw.at/gateway/WN_SMART_METER_PORTAL_API_B2C/1.0"
 API_URL_B2B = "https://api.wstw.at/gateway/WN_SMART_METER_PORTAL_API_B2B/1.0"
 REDIRECT_URI = "https://smartmeter-web.wienernetze.at/"
+IMMUTABLE_AFTER_DAYS = 3  # days after which quarter hour/daily values are final (unless estimated) and get cached
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes read at once from streamed responses
+STREAM_CACHED_DAYS = 31  # cached days loaded at once while streaming
+ZAEHLPUNKT_INDEX_TTL = 3600  # seconds the contracts (zaehlpunkte) are cached for lookups by zaehlpunktnummer
 API_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 AUTH_URL = "https://log.wien/auth/realms/logwien/protocol/openid-connect/"  # noqa
 
@@ -89,6 +93,18 @@ def build_access_token_args(**kwargs):
     return args
 
 
+def build_refresh_token_args(**kwargs):
+    """
+    build refresh token grant args and add kwargs
+    """
+    args = {
+        "grant_type": "refresh_token",
+        "client_id": "wn-smartmeter",
+    }
+    args.update(**kwargs)
+    return args
+
+
 def build_verbrauchs_args(**kwargs):
     """
     build arguments for verbrauchs call and add kwargs
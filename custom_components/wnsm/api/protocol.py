@@ -0,0 +1,1127 @@
+"""Contains the I/O-free core of the Smartmeter API Client.
+
+Every operation is written as a generator ("flow") which yields the
+I/O it needs (an `HttpRequest` or a `BlockingCall`) and receives the result
+(an `HttpResponse` or the return value) from a driver. Errors raised by the
+driver are thrown into the flow. The flow's return value is the result of the operation.
+
+The drivers are `client.Smartmeter` (blocking, requests) and `aio.AioSmartmeter` (asyncio, aiohttp).
+"""
+import base64
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, date, time, timezone
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple
+from urllib import parse
+
+from dateutil.relativedelta import relativedelta
+from lxml import html
+
+from . import constants as const
+from .errors import (
+    SmartmeterError,
+    SmartmeterConnectionError,
+    SmartmeterLoginError,
+    SmartmeterQueryError,
+)
+from .response_cache import ResponseCache, DayPolicy, DayCollector, BEWEGUNGSDATEN_QUARTER_HOUR, HISTORICAL_DAILY, parse_timestamp
+from .streaming import JsonArrayStreamParser
+from .token_store import TokenStore
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class HttpRequest:
+    """A HTTP request to be sent by a driver."""
+    method: str
+    url: str
+    headers: Dict[str, str] = field(default_factory=dict)
+    data: Dict[str, Any] | None = None  #: form encoded body
+    json: Any = None  #: json encoded body
+    allow_redirects: bool = True
+    timeout: float | None = None
+    stream: bool = False  #: the body is not read, but handed back chunk by chunk (see `ReadChunk`)
+
+
+@dataclass
+class HttpResponse:
+    """The response to a `HttpRequest`, as handed back by a driver."""
+    status_code: int
+    headers: Mapping[str, str]
+    content: bytes
+    url: str = ""
+
+    def json(self):
+        return json.loads(self.content)
+
+
+@dataclass
+class BlockingCall:
+    """A blocking (non-HTTP) call, e.g. file I/O, to be performed by a driver."""
+    func: Callable
+    args: tuple = ()
+
+
+@dataclass
+class ReadChunk:
+    """Reads the next chunk of the body of the streamed response (b"" at its end), see `HttpRequest.stream`."""
+
+
+@dataclass
+class Emit:
+    """Hands an item to the consumer of a streaming flow, the driver sends back None."""
+    item: Any
+
+
+class ValuesBatch(NamedTuple):
+    """Values of a streamed response, together with the rest of the response (e.g. the descriptor)"""
+    envelope: Dict[str, Any]
+    values: List[Dict[str, Any]]
+
+
+class ZaehlpunktInfo(NamedTuple):
+    """Entry of the zaehlpunkt index built from the contracts"""
+    customer_id: str
+    zaehlpunkt: str
+    anlagetype: str
+    details: Dict[str, Any]
+
+
+class SmartmeterProtocol:
+    """Smartmeter client state, request building and response parsing."""
+
+    def __init__(self, username, password, input_code_verifier=None, token_store: TokenStore = None,
+                 response_cache: ResponseCache = None):
+        """Access the Smartmeter API.
+
+        Args:
+            username (str): Username used for API Login.
+            password (str): Password used for API Login.
+            token_store (TokenStore, optional): Persists tokens and API keys,
+                so that they can be reused by the next instance (e.g. after a restart).
+            response_cache (ResponseCache, optional): Caches immutable days of historical data
+                (bewegungsdaten in quarter hours, daily historical data). Disabled if None.
+        """
+        self.username = username
+        self.password = password
+        self._access_token = None
+        self._refresh_token = None
+        self._api_gateway_token = None
+        self._access_token_expiration = None
+        self._refresh_token_expiration = None
+        self._api_gateway_b2b_token = None
+
+        self._code_verifier = None
+        if input_code_verifier is not None:
+            if self.is_valid_code_verifier(input_code_verifier):
+                self._code_verifier = input_code_verifier
+        # keep a given code verifier across resets (re-logins)
+        self._input_code_verifier = self._code_verifier
+
+        self._code_challenge = None
+        self._local_login_args = None
+        self._token_store = token_store if token_store is not None else TokenStore()
+        self._tokens_restored = False
+        self._zaehlpunkt_index: Dict[str, ZaehlpunktInfo] = {}
+        self._zaehlpunkt_index_expiration = None
+        self._response_cache = response_cache
+
+    def reset(self):
+        self._access_token = None
+        self._refresh_token = None
+        self._api_gateway_token = None
+        self._access_token_expiration = None
+        self._refresh_token_expiration = None
+        self._api_gateway_b2b_token = None
+        self._code_verifier = self._input_code_verifier
+        self._code_challenge = None
+        self._local_login_args = None
+
+    def is_login_expired(self):
+        return self._access_token_expiration is not None and datetime.now() >= self._access_token_expiration
+
+    def is_logged_in(self):
+        return self._access_token is not None and not self.is_login_expired()
+
+    def is_refresh_token_expired(self):
+        return self._refresh_token_expiration is None or datetime.now() >= self._refresh_token_expiration
+
+    def can_refresh(self):
+        return self._refresh_token is not None and not self.is_refresh_token_expired()
+
+    def generate_code_verifier(self):
+        """
+        generate a code verifier
+        """
+        return base64.urlsafe_b64encode(os.urandom(32)).decode('utf-8').rstrip('=')
+
+    def generate_code_challenge(self, code_verifier):
+        """
+        generate a code challenge from the code verifier
+        """
+        code_challenge = hashlib.sha256(code_verifier.encode('utf-8')).digest()
+        return base64.urlsafe_b64encode(code_challenge).decode('utf-8').rstrip('=')
+
+    def is_valid_code_verifier(self, code_verifier):
+        if not (43 <= len(code_verifier) <= 128):
+            return False
+
+        pattern = r'^[A-Za-z0-9\-._~]+$'
+        if not re.match(pattern, code_verifier):
+            return False
+
+        return True
+
+    def _load_login_page_flow(self):
+        """
+        loads login page and extracts encoded login url
+        """
+
+        # generate a code verifier, which serves as a secure random value
+        if not hasattr(self, '_code_verifier') or self._code_verifier is None:
+            # only generate if it does not exist
+            self._code_verifier = self.generate_code_verifier()
+
+        # generate a code challenge from the code verifier to enhance security
+        self._code_challenge = self.generate_code_challenge(self._code_verifier)
+
+        # copy const.LOGIN_ARGS
+        self._local_login_args = copy.deepcopy(const.LOGIN_ARGS)
+
+        # add code_challenge in self._local_login_args
+        self._local_login_args["code_challenge"] = self._code_challenge
+
+        login_url = const.AUTH_URL + "auth?" + parse.urlencode(self._local_login_args)
+        try:
+            result = yield HttpRequest("GET", login_url)
+        except Exception as exception:
+            raise SmartmeterConnectionError("Could not load login page") from exception
+        if result.status_code != 200:
+            raise SmartmeterConnectionError(
+                f"Could not load login page. Error: {result.content}"
+            )
+        tree = html.fromstring(result.content)
+        forms = tree.xpath("(//form/@action)")
+
+        if not forms:
+            raise SmartmeterConnectionError("No form found on the login page.")
+
+        action = forms[0]
+        return action
+
+    def _credentials_login_flow(self, url):
+        """
+        login with credentials provided the login url
+        """
+        try:
+            result = yield HttpRequest(
+                "POST",
+                url,
+                data={
+                    "username": self.username,
+                    "login": " "
+                },
+                allow_redirects=False,
+            )
+            tree = html.fromstring(result.content)
+            action = tree.xpath("(//form/@action)")[0]
+
+            result = yield HttpRequest(
+                "POST",
+                action,
+                data={
+                    "username": self.username,
+                    "password": self.password,
+                },
+                allow_redirects=False,
+            )
+        except Exception as exception:
+            raise SmartmeterConnectionError(
+                "Could not login with credentials"
+            ) from exception
+
+        if "Location" not in result.headers:
+            raise SmartmeterLoginError("Login failed. Check username/password.")
+        location = result.headers["Location"]
+
+        parsed_url = parse.urlparse(location)
+
+        fragment_dict = dict(
+            [
+                x.split("=")
+                for x in parsed_url.fragment.split("&")
+                if len(x.split("=")) == 2
+            ]
+        )
+        if "code" not in fragment_dict:
+            raise SmartmeterLoginError(
+                "Login failed. Could not extract 'code' from 'Location'"
+            )
+
+        code = fragment_dict["code"]
+        return code
+
+    def _load_tokens_flow(self, code):
+        """
+        Provided the totp code loads access and refresh token
+        """
+        try:
+            result = yield HttpRequest(
+                "POST",
+                const.AUTH_URL + "token",
+                data=const.build_access_token_args(code=code, code_verifier=self._code_verifier)
+            )
+        except Exception as exception:
+            raise SmartmeterConnectionError(
+                "Could not obtain access token"
+            ) from exception
+
+        if result.status_code != 200:
+            raise SmartmeterConnectionError(
+                f"Could not obtain access token: {result.content}"
+            )
+        return self._parse_tokens(result)
+
+    def _refresh_tokens_flow(self):
+        """
+        Provided a still valid refresh token loads new access and refresh token
+        """
+        try:
+            result = yield HttpRequest(
+                "POST",
+                const.AUTH_URL + "token",
+                data=const.build_refresh_token_args(refresh_token=self._refresh_token)
+            )
+        except Exception as exception:
+            raise SmartmeterConnectionError(
+                "Could not refresh access token"
+            ) from exception
+
+        if result.status_code != 200:
+            raise SmartmeterConnectionError(
+                f"Could not refresh access token: {result.content}"
+            )
+        return self._parse_tokens(result)
+
+    @staticmethod
+    def _parse_tokens(result: HttpResponse):
+        tokens = result.json()
+        if tokens["token_type"] != "Bearer":
+            raise SmartmeterLoginError(
+                f'Bearer token required, but got {tokens["token_type"]!r}'
+            )
+        return tokens
+
+    def _set_tokens(self, tokens):
+        self._access_token = tokens["access_token"]
+        # keycloak may omit the refresh token on a refresh grant, keep the old one then
+        self._refresh_token = tokens.get("refresh_token", self._refresh_token)
+        now = datetime.now()
+        self._access_token_expiration = now + timedelta(seconds=tokens["expires_in"])
+        if "refresh_expires_in" in tokens:
+            self._refresh_token_expiration = now + timedelta(
+                seconds=tokens["refresh_expires_in"]
+            )
+        logger.debug("Access Token valid until %s" % self._access_token_expiration)
+
+    def _refresh_flow(self):
+        """
+        renew the access token with the refresh token (a single request)
+        """
+        self._set_tokens((yield from self._refresh_tokens_flow()))
+        yield from self._save_tokens_flow()
+        return self
+
+    def _renew_flow(self):
+        """
+        renew the tokens ahead of their expiry: with the refresh token if possible,
+        otherwise with a full credentials login
+        """
+        if self.can_refresh() and self._api_gateway_token is not None:
+            try:
+                return (yield from self._refresh_flow())
+            except SmartmeterError as exception:
+                logger.debug("Refreshing access token failed, re-login: %s", exception)
+        # the current tokens stay in place (and usable by concurrent requests) until the login succeeded
+        self._set_credentials_tokens((yield from self._credentials_tokens_flow()))
+        yield from self._save_tokens_flow()
+        return self
+
+    def _token_state(self) -> dict:
+        return {
+            "username": self.username,
+            "access_token": self._access_token,
+            "access_token_expiration": self._access_token_expiration.timestamp(),
+            "refresh_token": self._refresh_token,
+            "refresh_token_expiration": (
+                None if self._refresh_token_expiration is None else self._refresh_token_expiration.timestamp()
+            ),
+            "api_gateway_token": self._api_gateway_token,
+            "api_gateway_b2b_token": self._api_gateway_b2b_token,
+            "b2cApiUrl": const.API_URL,
+            "b2bApiUrl": const.API_URL_B2B,
+        }
+
+    def _save_tokens_flow(self):
+        """Hands the current tokens, API keys and API urls to the token store"""
+        if self._access_token is None:
+            return
+        yield BlockingCall(self._token_store.save, (self._token_state(),))
+
+    def _restore_tokens_flow(self):
+        """Restores tokens, API keys and API urls from the token store.
+        Returns True if a usable state was found."""
+        self._tokens_restored = True
+        data = yield BlockingCall(self._token_store.load)
+        return self._restore_token_state(data)
+
+    def _restore_token_state(self, data) -> bool:
+        if not data or data.get("username") != self.username:
+            return False
+        try:
+            access_token_expiration = datetime.fromtimestamp(data["access_token_expiration"])
+            refresh_token_expiration = (
+                None if data.get("refresh_token_expiration") is None
+                else datetime.fromtimestamp(data["refresh_token_expiration"])
+            )
+            access_token = data["access_token"]
+            api_gateway_token = data["api_gateway_token"]
+            api_gateway_b2b_token = data["api_gateway_b2b_token"]
+        except (KeyError, TypeError, ValueError) as exception:
+            logger.warning("Ignoring invalid token store content: %s", exception)
+            return False
+        if api_gateway_token is None or api_gateway_b2b_token is None:
+            return False
+
+        self._access_token = access_token
+        self._access_token_expiration = access_token_expiration
+        self._refresh_token = data.get("refresh_token")
+        self._refresh_token_expiration = refresh_token_expiration
+        self._api_gateway_token = api_gateway_token
+        self._api_gateway_b2b_token = api_gateway_b2b_token
+        if data.get("b2cApiUrl"):
+            const.API_URL = data["b2cApiUrl"]
+        if data.get("b2bApiUrl"):
+            const.API_URL_B2B = data["b2bApiUrl"]
+        logger.debug("Restored tokens, access token valid until %s", self._access_token_expiration)
+        return True
+
+    def _login_flow(self):
+        """
+        login with credentials specified in ctor
+
+        An expired access token is renewed with the refresh token if possible,
+        the full credentials login is only performed if that is not possible.
+        """
+        if not self._tokens_restored and self._access_token is None:
+            yield from self._restore_tokens_flow()
+        if self.is_login_expired():
+            if self.can_refresh() and self._api_gateway_token is not None:
+                try:
+                    return (yield from self._refresh_flow())
+                except SmartmeterError as exception:
+                    logger.debug("Refreshing access token failed, re-login: %s", exception)
+            self.reset()
+        if not self.is_logged_in():
+            self._set_credentials_tokens((yield from self._credentials_tokens_flow()))
+            yield from self._save_tokens_flow()
+        return self
+
+    def _credentials_tokens_flow(self):
+        """
+        full credentials login, returns the new tokens and API keys without touching the current ones
+        """
+        self._code_verifier = self._input_code_verifier
+        url = yield from self._load_login_page_flow()
+        code = yield from self._credentials_login_flow(url)
+        tokens = yield from self._load_tokens_flow(code)
+        api_keys = tuple((yield from self._fetch_api_key_flow(tokens["access_token"])))
+        return tokens, api_keys
+
+    def _set_credentials_tokens(self, login):
+        tokens, (self._api_gateway_token, self._api_gateway_b2b_token) = login
+        self._set_tokens(tokens)
+
+    def _access_valid_or_raise_flow(self):
+        """Checks if the access token is still valid, refreshes it if possible or raises an exception"""
+        if self._access_token_expiration is None:
+            raise SmartmeterConnectionError("Not logged in, please log in first!")
+        if datetime.now() >= self._access_token_expiration:
+            if self.can_refresh():
+                try:
+                    yield from self._refresh_flow()
+                    return
+                except SmartmeterError as exception:
+                    raise SmartmeterConnectionError(
+                        "Access Token is not valid anymore, please re-log!"
+                    ) from exception
+            raise SmartmeterConnectionError(
+                "Access Token is not valid anymore, please re-log!"
+            )
+
+    def _get_api_key_flow(self, token):
+        yield from self._access_valid_or_raise_flow()
+        return (yield from self._fetch_api_key_flow(token))
+
+    def _fetch_api_key_flow(self, token):
+        headers = {"Authorization": f"Bearer {token}"}
+        try:
+            result = (yield HttpRequest("GET", const.API_CONFIG_URL, headers=headers)).json()
+        except Exception as exception:
+            raise SmartmeterConnectionError("Could not obtain API key") from exception
+
+        find_keys = ["b2cApiKey", "b2bApiKey"]
+        for key in find_keys:
+            if key not in result:
+                raise SmartmeterConnectionError(f"{key} not found in response!")
+
+        # The b2bApiUrl and b2cApiUrl can also be gathered from the configuration
+        # TODO: reduce code duplication...
+        if "b2cApiUrl" in result and result["b2cApiUrl"] != const.API_URL:
+            const.API_URL = result["b2cApiUrl"]
+            logger.warning("The b2cApiUrl has changed to %s! Update API_URL!", const.API_URL)
+        if "b2bApiUrl" in result and result["b2bApiUrl"] != const.API_URL_B2B:
+            const.API_URL_B2B = result["b2bApiUrl"]
+            logger.warning("The b2bApiUrl has changed to %s! Update API_URL_B2B!", const.API_URL_B2B)
+
+        return (result[key] for key in find_keys)
+
+    @staticmethod
+    def _dt_string(datetime_string):
+        return datetime_string.strftime(const.API_DATE_FORMAT)[:-3] + "Z"
+
+    def _call_api_flow(
+        self,
+        endpoint,
+        base_url=None,
+        method="GET",
+        data=None,
+        query=None,
+        return_response=False,
+        timeout=60.0,
+        extra_headers=None,
+    ):
+        yield from self._access_valid_or_raise_flow()
+
+        request = self._api_request(endpoint, base_url, method, data, query, timeout, extra_headers)
+        response = yield request
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("\nAPI Request: %s\n%s\n\nAPI Response: %s" % (
+                request.url, ("" if data is None else "body: " + json.dumps(data, indent=2)),
+                None if response is None or response.json() is None else json.dumps(response.json(), indent=2)))
+
+        if return_response:
+            return response
+
+        return response.json()
+
+    def _call_api_stream_flow(self, endpoint, base_url=None, query=None, timeout=60.0, extra_headers=None,
+                              array_key="values", check_head: Callable[[Dict[str, Any]], None] = None):
+        """
+        Like `_call_api_flow`, but the response is parsed while it is received:
+        the elements of its array array_key are emitted in `ValuesBatch`es (one per chunk).
+        check_head is called with the response read until the array started (e.g. to validate the descriptor).
+        Returns the response without the elements of the array.
+        """
+        yield from self._access_valid_or_raise_flow()
+
+        request = self._api_request(endpoint, base_url, "GET", None, query, timeout, extra_headers)
+        request.stream = True
+        response = yield request
+        if response.status_code >= 400:
+            body = b""
+            while chunk := (yield ReadChunk()):
+                body += chunk
+            logger.debug("API Request: %s failed: %s", request.url, body)
+            raise SmartmeterQueryError(f"API request failed with status {response.status_code}")
+
+        parser = JsonArrayStreamParser(array_key)
+        head = None
+        try:
+            while chunk := (yield ReadChunk()):
+                values = parser.feed(chunk)
+                if head is None:
+                    head = parser.head()
+                    if head is not None and check_head is not None:
+                        check_head(head)
+                if values:
+                    yield Emit(ValuesBatch(head, values))
+            envelope = parser.envelope()
+        except ValueError as exception:
+            raise SmartmeterQueryError(f"Could not parse response of {endpoint}: {exception}") from exception
+        if check_head is not None:
+            check_head(envelope)
+        return envelope
+
+    def _api_request(self, endpoint, base_url, method, data, query, timeout, extra_headers) -> HttpRequest:
+        """Builds the (authorized) request to an API endpoint"""
+        if base_url is None:
+            base_url = const.API_URL
+        url = parse.urljoin(base_url, endpoint)
+
+        if query:
+            url += ("?" if "?" not in endpoint else "&") + parse.urlencode(query)
+
+        headers = {
+            "Authorization": f"Bearer {self._access_token}",
+        }
+
+        # For API calls to B2C or B2B, we need to add the Gateway-APIKey:
+        # TODO: This may be prone to errors if URLs are compared like this.
+        #       The Strings has to be exactly the same, but that may not be the case,
+        #       even though the URLs are the same.
+        if base_url == const.API_URL:
+            headers["X-Gateway-APIKey"] = self._api_gateway_token
+        elif base_url == const.API_URL_B2B:
+            headers["X-Gateway-APIKey"] = self._api_gateway_b2b_token
+
+        if extra_headers:
+            headers.update(extra_headers)
+
+        if data:
+            headers["Content-Type"] = "application/json"
+
+        return HttpRequest(method, url, headers=headers, json=data, timeout=timeout)
+
+    def invalidate_zaehlpunkt_index(self):
+        """Drops the cached contracts, the next lookup fetches them again"""
+        self._zaehlpunkt_index = {}
+        self._zaehlpunkt_index_expiration = None
+
+    def _is_zaehlpunkt_index_valid(self):
+        return self._zaehlpunkt_index_expiration is not None and datetime.now() < self._zaehlpunkt_index_expiration
+
+    def _build_zaehlpunkt_index(self, contracts):
+        index = {}
+        for contract in contracts or []:
+            for zp in contract.get("zaehlpunkte") or []:
+                # the first occurrence wins, as the former linear search did for the first contract
+                index.setdefault(zp["zaehlpunktnummer"], ZaehlpunktInfo(
+                    contract.get("geschaeftspartner"), zp["zaehlpunktnummer"], zp["anlage"]["typ"], zp
+                ))
+        self._zaehlpunkt_index = index
+        self._zaehlpunkt_index_expiration = datetime.now() + timedelta(seconds=const.ZAEHLPUNKT_INDEX_TTL)
+
+    def _zaehlpunkt_info_flow(self, zaehlpunkt: str = None):
+        """Looks up a zaehlpunkt (or the first one if None) in the (cached) contracts"""
+        if not self._is_zaehlpunkt_index_valid():
+            yield from self._zaehlpunkte_flow()
+        info = self._lookup_zaehlpunkt(zaehlpunkt)
+        if info is None:
+            # might be a new zaehlpunkt, the index is older than this lookup
+            yield from self._zaehlpunkte_flow()
+            info = self._lookup_zaehlpunkt(zaehlpunkt)
+        if info is None:
+            raise SmartmeterQueryError(f"Zaehlpunkt {zaehlpunkt} not found")
+        return info
+
+    def _lookup_zaehlpunkt(self, zaehlpunkt: str = None):
+        if zaehlpunkt is None:
+            return next(iter(self._zaehlpunkt_index.values()), None)
+        return self._zaehlpunkt_index.get(zaehlpunkt)
+
+    def _get_zaehlpunkt_flow(self, zaehlpunkt: str = None):
+        info = yield from self._zaehlpunkt_info_flow(zaehlpunkt)
+        return info.customer_id, info.zaehlpunkt, const.AnlagenType.from_str(info.anlagetype)
+
+    def _zaehlpunkte_flow(self):
+        """Returns zaehlpunkte for currently logged in user."""
+        contracts = yield from self._call_api_flow("zaehlpunkte")
+        if isinstance(contracts, list):
+            self._build_zaehlpunkt_index(contracts)
+        return contracts
+
+    def _consumptions_flow(self):
+        """Returns response from 'consumptions' endpoint."""
+        return (yield from self._call_api_flow("zaehlpunkt/consumptions"))
+
+    def _base_information_flow(self):
+        """Returns response from 'baseInformation' endpoint."""
+        return (yield from self._call_api_flow("zaehlpunkt/baseInformation"))
+
+    def _meter_readings_flow(self):
+        """Returns response from 'meterReadings' endpoint."""
+        return (yield from self._call_api_flow("zaehlpunkt/meterReadings"))
+
+    def _verbrauch_flow(
+        self,
+        customer_id: str,
+        zaehlpunkt: str,
+        date_from: datetime,
+        resolution: const.Resolution = const.Resolution.HOUR
+    ):
+        """Returns energy usage.
+
+        This returns hourly or quarter hour consumptions for a single day,
+        i.e., for 24 hours after the given date_from.
+
+        Args:
+            customer_id (str): Customer ID returned by zaehlpunkt call ("geschaeftspartner")
+            zaehlpunkt (str, optional): id for desired smartmeter.
+                If None, check for first meter in user profile.
+            date_from (datetime): Start date for energy usage request
+            date_to (datetime, optional): End date for energy usage request.
+                Defaults to datetime.now()
+            resolution (const.Resolution, optional): Specify either 1h or 15min resolution
+        Returns:
+            dict: JSON response of api call to
+                'messdaten/CUSTOMER_ID/ZAEHLPUNKT/verbrauchRaw'
+        """
+        if zaehlpunkt is None or customer_id is None:
+            customer_id, zaehlpunkt, anlagetype = yield from self._get_zaehlpunkt_flow()
+        endpoint = f"messdaten/{customer_id}/{zaehlpunkt}/verbrauch"
+        query = const.build_verbrauchs_args(
+            # This one does not have a dateTo...
+            dateFrom=self._dt_string(date_from),
+            dayViewResolution=resolution.value
+        )
+        return (yield from self._call_api_flow(endpoint, query=query))
+
+    def _verbrauch_raw_flow(
+        self,
+        customer_id: str,
+        zaehlpunkt: str,
+        date_from: datetime,
+        date_to: datetime = None,
+    ):
+        """Returns energy usage.
+        This can be used to query the daily consumption for a long period of time,
+        for example several months or a week.
+
+        Note: The minimal resolution is a single day.
+        For hourly consumptions use `verbrauch`.
+
+        Args:
+            customer_id (str): Customer ID returned by zaehlpunkt call ("geschaeftspartner")
+            zaehlpunkt (str, optional): id for desired smartmeter.
+                If None, check for first meter in user profile.
+            date_from (datetime): Start date for energy usage request
+            date_to (datetime, optional): End date for energy usage request.
+                Defaults to datetime.now()
+        Returns:
+            dict: JSON response of api call to
+                'messdaten/CUSTOMER_ID/ZAEHLPUNKT/verbrauchRaw'
+        """
+        if date_to is None:
+            date_to = datetime.now()
+        if zaehlpunkt is None or customer_id is None:
+            customer_id, zaehlpunkt, anlagetype = yield from self._get_zaehlpunkt_flow()
+        endpoint = f"messdaten/{customer_id}/{zaehlpunkt}/verbrauchRaw"
+        query = dict(
+            # These are the only three fields that are used for that endpoint:
+            dateFrom=self._dt_string(date_from),
+            dateTo=self._dt_string(date_to),
+            granularity="DAY",
+        )
+        return (yield from self._call_api_flow(endpoint, query=query))
+
+    def _profil_flow(self):
+        """Returns profile of a logged-in user.
+
+        Returns:
+            dict: JSON response of api call to 'user/profile'
+        """
+        return (yield from self._call_api_flow("user/profile", const.API_URL_ALT))
+
+    def _ereignisse_flow(
+        self, date_from: datetime, date_to: datetime = None, zaehlpunkt=None
+    ):
+        """Returns events between date_from and date_to of a specific smart meter.
+        Args:
+            date_from (datetime.datetime): Starting date for request
+            date_to (datetime.datetime, optional): Ending date for request.
+                Defaults to datetime.datetime.now().
+            zaehlpunkt (str, optional): id for desired smart meter.
+                If is None check for first meter in user profile.
+        Returns:
+            dict: JSON response of api call to 'user/ereignisse'
+        """
+        if date_to is None:
+            date_to = datetime.now()
+        if zaehlpunkt is None:
+            customer_id, zaehlpunkt, anlagetype = yield from self._get_zaehlpunkt_flow()
+        query = {
+            "zaehlpunkt": zaehlpunkt,
+            "dateFrom": self._dt_string(date_from),
+            "dateUntil": self._dt_string(date_to),
+        }
+        return (yield from self._call_api_flow("user/ereignisse", const.API_URL_ALT, query=query))
+
+    def _create_ereignis_flow(self, zaehlpunkt, name, date_from, date_to=None):
+        """Creates new event.
+        Args:
+            zaehlpunkt (str): Id for desired smartmeter.
+                If None, check for first meter in user profile
+            name (str): Event name
+            date_from (datetime.datetime): (Starting) date for request
+            date_to (datetime.datetime, optional): Ending date for request.
+        Returns:
+            dict: JSON response of api call to 'user/ereignis'
+        """
+        if date_to is None:
+            dto = None
+            typ = "ZEITPUNKT"
+        else:
+            dto = self._dt_string(date_to)
+            typ = "ZEITSPANNE"
+
+        data = {
+            "endAt": dto,
+            "name": name,
+            "startAt": self._dt_string(date_from),
+            "typ": typ,
+            "zaehlpunkt": zaehlpunkt,
+        }
+
+        return (yield from self._call_api_flow("user/ereignis", data=data, method="POST"))
+
+    def _delete_ereignis_flow(self, ereignis_id):
+        """Deletes ereignis."""
+        return (yield from self._call_api_flow(f"user/ereignis/{ereignis_id}", method="DELETE"))
+
+    def find_valid_obis_data(self, zaehlwerke: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Find and validate data with valid OBIS codes from a list of zaehlwerke.
+        """
+
+        # Check if any OBIS codes exist
+        all_obis_codes = [zaehlwerk.get("obisCode") for zaehlwerk in zaehlwerke]
+        if not any(all_obis_codes):
+            logger.debug("Returned zaehlwerke: %s", zaehlwerke)
+            raise SmartmeterQueryError("No OBIS codes found in the provided data.")
+
+        # Filter data for valid OBIS codes
+        valid_data = [
+            zaehlwerk for zaehlwerk in zaehlwerke
+            if zaehlwerk.get("obisCode") in const.VALID_OBIS_CODES
+        ]
+
+        if not valid_data:
+            logger.debug("Returned zaehlwerke: %s", zaehlwerke)
+            raise SmartmeterQueryError(f"No valid OBIS code found. OBIS codes in data: {all_obis_codes}")
+
+        # Check for empty or missing messwerte
+        for zaehlwerk in valid_data:
+            if not zaehlwerk.get("messwerte"):
+                obis = zaehlwerk.get("obisCode")
+                logger.debug(f"Valid OBIS code '{obis}' has empty or missing messwerte. Data is probably not available yet.")
+
+        # Log a warning if multiple valid OBIS codes are found
+        if len(valid_data) > 1:
+            found_valid_obis = [zaehlwerk["obisCode"] for zaehlwerk in valid_data]
+            logger.warning(f"Multiple valid OBIS codes found: {found_valid_obis}. Using the first one.")
+
+        return valid_data[0]
+
+    def _historical_data_flow(
+        self,
+        zaehlpunktnummer: str = None,
+        date_from: date = None,
+        date_until: date = None,
+        valuetype: const.ValueType = const.ValueType.METER_READ
+    ):
+        """
+        Query historical data in a batch
+        If no arguments are given, a span of three year is queried (same day as today but from current year - 3).
+        If date_from is not given but date_until, again a three year span is assumed.
+        """
+        # Resolve Zaehlpunkt
+        if zaehlpunktnummer is None:
+            customer_id, zaehlpunkt, anlagetype = yield from self._get_zaehlpunkt_flow()
+        else:
+            customer_id, zaehlpunkt, anlagetype = yield from self._get_zaehlpunkt_flow(zaehlpunktnummer)
+
+        # Set date range defaults
+        if date_until is None:
+            date_until = date.today()
+
+        if date_from is None:
+            date_from = date_until - relativedelta(years=3)
+
+        if self._response_cache is not None and valuetype in (const.ValueType.DAY, const.ValueType.METER_READ):
+            return (yield from self._day_cached_flow(
+                ("messwerte", zaehlpunkt, valuetype.value), HISTORICAL_DAILY, date_from, date_until,
+                lambda von, bis: self._historical_data_request_flow(customer_id, zaehlpunkt, von, bis, valuetype),
+            ))
+        return (yield from self._historical_data_request_flow(customer_id, zaehlpunkt, date_from, date_until, valuetype))
+
+    def _historical_data_request_flow(self, customer_id, zaehlpunkt, date_from, date_until, valuetype):
+        # Query parameters
+        query = {
+            "datumVon": date_from.strftime("%Y-%m-%d"),
+            "datumBis": date_until.strftime("%Y-%m-%d"),
+            "wertetyp": valuetype.value,
+        }
+
+        extra = {
+            # For this API Call, requesting json is important!
+            "Accept": "application/json"
+        }
+
+        # API Call
+        data = yield from self._call_api_flow(
+            f"zaehlpunkte/{customer_id}/{zaehlpunkt}/messwerte",
+            base_url=const.API_URL_B2B,
+            query=query,
+            extra_headers=extra,
+        )
+
+        # Sanity check: Validate returned zaehlpunkt
+        if data.get("zaehlpunkt") != zaehlpunkt:
+            logger.debug("Returned data: %s", data)
+            raise SmartmeterQueryError("Returned data does not match given zaehlpunkt!")
+
+        # Validate and extract valid OBIS data
+        zaehlwerke = data.get("zaehlwerke")
+        if not zaehlwerke:
+            logger.debug("Returned data: %s", data)
+            raise SmartmeterQueryError("Returned data does not contain any zaehlwerke or is empty.")
+
+        valid_obis_data = self.find_valid_obis_data(zaehlwerke)
+        return valid_obis_data
+
+    def _bewegungsdaten_flow(
+        self,
+        zaehlpunktnummer: str = None,
+        date_from: date = None,
+        date_until: date = None,
+        valuetype: const.ValueType = const.ValueType.QUARTER_HOUR,
+        aggregat: str = None,
+        cached: bool = True,
+    ):
+        """
+        Query historical data in a batch
+        If no arguments are given, a span of three year is queried (same day as today but from current year - 3).
+        If date_from is not given but date_until, again a three year span is assumed.
+        With cached False the whole range is requested, the cached days are replaced by the response.
+        """
+        customer_id, zaehlpunkt, rolle, date_from, date_until = yield from self._bewegungsdaten_args_flow(
+            zaehlpunktnummer, date_from, date_until, valuetype)
+
+        if self._is_bewegungsdaten_cached(rolle, aggregat):
+            return (yield from self._day_cached_flow(
+                ("bewegungsdaten", zaehlpunkt, rolle), BEWEGUNGSDATEN_QUARTER_HOUR, date_from, date_until,
+                lambda von, bis: self._bewegungsdaten_request_flow(customer_id, zaehlpunkt, rolle, von, bis, aggregat),
+                cached,
+            ))
+        return (yield from self._bewegungsdaten_request_flow(customer_id, zaehlpunkt, rolle, date_from, date_until, aggregat))
+
+    def _bewegungsdaten_args_flow(self, zaehlpunktnummer, date_from, date_until, valuetype):
+        """Resolves the zaehlpunkt, its role for the valuetype and the default date range"""
+        customer_id, zaehlpunkt, anlagetype = yield from self._get_zaehlpunkt_flow(zaehlpunktnummer)
+
+        if anlagetype == const.AnlagenType.FEEDING:
+            if valuetype == const.ValueType.DAY:
+                rolle = const.RoleType.DAILY_FEEDING.value
+            else:
+                rolle = const.RoleType.QUARTER_HOURLY_FEEDING.value
+        else:
+            if valuetype == const.ValueType.DAY:
+                rolle = const.RoleType.DAILY_CONSUMING.value
+            else:
+                rolle = const.RoleType.QUARTER_HOURLY_CONSUMING.value
+
+        if date_until is None:
+            date_until = date.today()
+
+        if date_from is None:
+            date_from = date_until - relativedelta(years=3)
+
+        return customer_id, zaehlpunkt, rolle, date_from, date_until
+
+    def _is_bewegungsdaten_cached(self, rolle, aggregat):
+        return self._response_cache is not None and aggregat in (None, "NONE") and rolle in (
+            const.RoleType.QUARTER_HOURLY_CONSUMING.value, const.RoleType.QUARTER_HOURLY_FEEDING.value)
+
+    @staticmethod
+    def _bewegungsdaten_query(customer_id, zaehlpunkt, rolle, date_from, date_until, aggregat):
+        return {
+            "geschaeftspartner": customer_id,
+            "zaehlpunktnummer": zaehlpunkt,
+            "rolle": rolle,
+            "zeitpunktVon": date_from.strftime("%Y-%m-%dT%H:%M:00.000Z"),  # we catch up from the exact date of the last import to compensate for time shift
+            "zeitpunktBis": date_until.strftime("%Y-%m-%dT23:59:59.999Z"),
+            "aggregat": aggregat or "NONE"
+        }
+
+    def _bewegungsdaten_request_flow(self, customer_id, zaehlpunkt, rolle, date_from, date_until, aggregat):
+        query = self._bewegungsdaten_query(customer_id, zaehlpunkt, rolle, date_from, date_until, aggregat)
+
+        extra = {
+            # For this API Call, requesting json is important!
+            "Accept": "application/json"
+        }
+
+        data = yield from self._call_api_flow(
+            "user/messwerte/bewegungsdaten",
+            base_url=const.API_URL_ALT,
+            query=query,
+            extra_headers=extra,
+        )
+        if data["descriptor"]["zaehlpunktnummer"] != zaehlpunkt:
+            raise SmartmeterQueryError("Returned data does not match given zaehlpunkt!")
+        return data
+
+    def _bewegungsdaten_stream_flow(
+        self,
+        zaehlpunktnummer: str = None,
+        date_from: date = None,
+        date_until: date = None,
+        valuetype: const.ValueType = const.ValueType.QUARTER_HOUR,
+        aggregat: str = None,
+    ):
+        """
+        Like `_bewegungsdaten_flow`, but emits the values in `ValuesBatch`es while the response is received
+        (so memory does not grow with the range). Cached days are emitted first, the rest is streamed.
+        """
+        customer_id, zaehlpunkt, rolle, date_from, date_until = yield from self._bewegungsdaten_args_flow(
+            zaehlpunktnummer, date_from, date_until, valuetype)
+
+        collector = None
+        live_from = date_from
+        if self._is_bewegungsdaten_cached(rolle, aggregat):
+            key = ("bewegungsdaten", zaehlpunkt, rolle)
+            live_from = yield from self._emit_cached_days_flow(key, BEWEGUNGSDATEN_QUARTER_HOUR, date_from, date_until)
+            if live_from is None:
+                return None
+            first_day = date_from.date() if isinstance(date_from, datetime) else date_from
+            partial_day = first_day if live_from == date_from and isinstance(date_from, datetime) \
+                and date_from.time() != time() else None
+            immutable_before = date.today() - timedelta(days=const.IMMUTABLE_AFTER_DAYS)
+            collector = DayCollector(BEWEGUNGSDATEN_QUARTER_HOUR, immutable_before, partial_day)
+
+        def check_head(head):
+            if (head.get("descriptor") or {}).get("zaehlpunktnummer") != zaehlpunkt:
+                raise SmartmeterQueryError("Returned data does not match given zaehlpunkt!")
+
+        flow = self._call_api_stream_flow(
+            "user/messwerte/bewegungsdaten",
+            base_url=const.API_URL_ALT,
+            query=self._bewegungsdaten_query(customer_id, zaehlpunkt, rolle, live_from, date_until, aggregat),
+            extra_headers={"Accept": "application/json"},
+            check_head=check_head,
+        )
+        if collector is None:
+            return (yield from flow)
+        # pass the effects of the request through, but store complete days in the cache on the way
+        try:
+            effect = next(flow)
+            while True:
+                if isinstance(effect, Emit):
+                    complete = collector.add(effect.item.values, effect.item.envelope)
+                    if complete:
+                        yield BlockingCall(self._response_cache.store_days, (key, complete))
+                try:
+                    result = yield effect
+                except Exception as exception:  # pylint: disable=broad-except
+                    effect = flow.throw(exception)
+                else:
+                    effect = flow.send(result)
+        except StopIteration as stop:
+            envelope = stop.value
+        complete = collector.finish()
+        if complete:
+            yield BlockingCall(self._response_cache.store_days, (key, complete))
+        return envelope
+
+    def _emit_cached_days_flow(self, key, policy: DayPolicy, date_from, date_until):
+        """
+        Emits the values of the cached days from date_from on (until the first day missing in the cache).
+        Returns where the request for the rest has to start (None if all days were cached).
+        """
+        first_day = date_from.date() if isinstance(date_from, datetime) else date_from
+        last_day = date_until.date() if isinstance(date_until, datetime) else date_until
+        immutable_before = date.today() - timedelta(days=const.IMMUTABLE_AFTER_DAYS)
+        since = None
+        if isinstance(date_from, datetime) and date_from.time() != time():
+            since = date_from if date_from.tzinfo is not None else date_from.replace(tzinfo=timezone.utc)
+
+        day = first_day
+        while day <= last_day and day < immutable_before:
+            days = [day + timedelta(days=i) for i in range(const.STREAM_CACHED_DAYS)]
+            days = [d for d in days if d <= last_day and d < immutable_before]
+            cached = yield BlockingCall(self._response_cache.load_days, (key, days))
+            for day in days:
+                if day not in cached:
+                    break
+                values = cached[day].get(policy.values_key) or []
+                if since is not None and day == first_day:
+                    values = [v for v in values if parse_timestamp(v[policy.start_key]) >= since]
+                envelope = {k: v for k, v in cached[day].items() if k != policy.values_key}
+                yield Emit(ValuesBatch(envelope, values))
+            else:
+                day = days[-1] + timedelta(days=1)
+                continue
+            break
+
+        if day > last_day:
+            return None
+        if day == first_day:
+            return date_from
+        if isinstance(date_from, datetime):
+            return datetime.combine(day, time(), date_from.tzinfo)
+        return day
+
+    def _day_cached_flow(self, key, policy: DayPolicy, date_from, date_until, fetch_flow, cached: bool = True):
+        """
+        Returns the response for the range date_from - date_until stitched from the cached days
+        and a single request (fetch_flow(date_from, date_until)) starting at the first day which is not cached.
+        Complete days older than IMMUTABLE_AFTER_DAYS without estimated or missing values are cached.
+        If cached is False, no day is served from the cache (but the requested days are stored again).
+        """
+        first_day = date_from.date() if isinstance(date_from, datetime) else date_from
+        last_day = date_until.date() if isinstance(date_until, datetime) else date_until
+        if last_day < first_day:
+            return (yield from fetch_flow(date_from, date_until))
+
+        days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+        immutable_before = date.today() - timedelta(days=const.IMMUTABLE_AFTER_DAYS)
+        cacheable = [day for day in days if day < immutable_before] if cached else []
+        cached = (yield BlockingCall(self._response_cache.load_days, (key, cacheable))) if cacheable else {}
+        missing = [day for day in days if day not in cached]
+        # the query may start within the first day (e.g. at the last imported quarter hour)
+        since = None
+        if isinstance(date_from, datetime) and date_from.time() != time():
+            since = date_from if date_from.tzinfo is not None else date_from.replace(tzinfo=timezone.utc)
+
+        envelope = None
+        live_values = []
+        if missing:
+            live_from = missing[0]
+            if live_from == first_day:
+                fetch_from = date_from
+            elif isinstance(date_from, datetime):
+                fetch_from = datetime.combine(live_from, time(), date_from.tzinfo)
+            else:
+                fetch_from = live_from
+            logger.debug("Requesting %s from %s, %d days served from cache", key, fetch_from, len(days) - len(missing))
+            live = yield from fetch_flow(fetch_from, date_until)
+            envelope = {k: v for k, v in live.items() if k != policy.values_key}
+            live_values = [v for v in live.get(policy.values_key) or [] if policy.day_of(v) >= live_from]
+
+            collector = DayCollector(policy, immutable_before, first_day if since is not None else None)
+            complete = collector.add(live_values, envelope)
+            complete.update(collector.finish())
+            if complete:
+                yield BlockingCall(self._response_cache.store_days, (key, complete))
+        else:
+            live_from = None
+
+        stitched = []
+        for day in days:
+            if day == live_from:
+                break
+            values = cached[day].get(policy.values_key) or []
+            if since is not None and day == first_day:
+                values = [v for v in values if parse_timestamp(v[policy.start_key]) >= since]
+            stitched.extend(values)
+        if envelope is None:
+            envelope = {k: v for k, v in cached[days[0]].items() if k != policy.values_key}
+        return {**envelope, policy.values_key: stitched + live_values}
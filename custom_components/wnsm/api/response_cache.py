@@ -0,0 +1,132 @@
+"""Per-day cache of historical API responses.
+
+Quarter hour and daily values do not change anymore once they are a few days old
+(and neither estimated nor missing), hence they are cached per day and only the
+mutable tail of a queried range has to be requested again.
+"""
+import json
+import logging
+import os
+import re
+from datetime import date, datetime, timezone, tzinfo
+from typing import Any, Callable, Dict, Iterable, NamedTuple
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+Key = tuple[str, str, str]  #: (endpoint, zaehlpunkt, role/value type)
+
+
+def parse_timestamp(timestamp: str) -> datetime:
+    """Parses an API timestamp (e.g. '2024-11-11T23:00:00.000Z') into an aware datetime"""
+    result = datetime.fromisoformat(timestamp)
+    return result if result.tzinfo is not None else result.replace(tzinfo=timezone.utc)
+
+
+class DayPolicy(NamedTuple):
+    """Describes how the values of an endpoint are assigned to days and when they are final"""
+    values_key: str  #: key of the list of values in the response
+    start_key: str  #: key of the start timestamp within a value
+    tz: tzinfo  #: timezone the days of the query refer to
+    values_per_day: int  #: number of values of a complete day
+    is_final: Callable[[Dict[str, Any]], bool]  #: whether a single value will not change anymore
+
+    def day_of(self, value: Dict[str, Any]) -> date:
+        return parse_timestamp(value[self.start_key]).astimezone(self.tz).date()
+
+
+# bewegungsdaten are queried by UTC timestamps (zeitpunktVon/zeitpunktBis)
+BEWEGUNGSDATEN_QUARTER_HOUR = DayPolicy(
+    "values", "zeitpunktVon", timezone.utc, 96,
+    lambda value: value.get("wert") is not None and not value.get("geschaetzt"),
+)
+# historical data is queried by local days (datumVon/datumBis)
+HISTORICAL_DAILY = DayPolicy(
+    "messwerte", "zeitVon", ZoneInfo("Europe/Vienna"), 1,
+    lambda value: value.get("messwert") is not None and value.get("qualitaet") == "VAL",
+)
+
+
+class ResponseCache:
+    """Interface of a per-day response cache."""
+
+    def load_days(self, key: Key, days: Iterable[date]) -> Dict[date, Dict[str, Any]]:
+        """Returns the cached responses of the given days (missing days are omitted)."""
+        raise NotImplementedError
+
+    def store_days(self, key: Key, responses: Dict[date, Dict[str, Any]]) -> None:
+        """Stores the responses of complete, immutable days."""
+        raise NotImplementedError
+
+
+class FileResponseCache(ResponseCache):
+    """Response cache storing one JSON file per endpoint, zaehlpunkt, role and day."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, key: Key, day: date | None = None) -> str:
+        parts = [re.sub(r"[^A-Za-z0-9_.-]", "_", str(part)) for part in key]
+        path = os.path.join(self.directory, *parts)
+        return path if day is None else os.path.join(path, f"{day.isoformat()}.json")
+
+    def load_days(self, key: Key, days: Iterable[date]) -> Dict[date, Dict[str, Any]]:
+        result = {}
+        for day in days:
+            try:
+                with open(self._path(key, day), encoding="utf-8") as file:
+                    result[day] = json.load(file)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError) as exception:
+                logger.warning("Ignoring unreadable cache entry %s: %s", self._path(key, day), exception)
+        return result
+
+    def store_days(self, key: Key, responses: Dict[date, Dict[str, Any]]) -> None:
+        if not responses:
+            return
+        os.makedirs(self._path(key), exist_ok=True)
+        for day, response in responses.items():
+            path = self._path(key, day)
+            with open(path + ".tmp", "w", encoding="utf-8") as file:
+                json.dump(response, file)
+            os.replace(path + ".tmp", path)
+
+
+class DayCollector:
+    """Groups the (chronological) values of a response by day and picks the days to be cached:
+    complete days before immutable_before without estimated or missing values."""
+
+    def __init__(self, policy: DayPolicy, immutable_before: date, partial_day: date | None = None):
+        self.policy = policy
+        self.immutable_before = immutable_before
+        self.partial_day = partial_day  #: a day the query started within (hence never complete)
+        self._envelope: Dict[str, Any] = {}
+        self._day = None
+        self._values = []
+
+    def add(self, values: Iterable[Dict[str, Any]], envelope: Dict[str, Any]) -> Dict[date, Dict[str, Any]]:
+        """Adds the next values, returns the days completed by them which may be cached"""
+        self._envelope = envelope
+        complete = {}
+        for value in values:
+            day = self.policy.day_of(value)
+            if day != self._day:
+                self._complete(complete)
+                self._day, self._values = day, []
+            self._values.append(value)
+        return complete
+
+    def finish(self) -> Dict[date, Dict[str, Any]]:
+        """Returns the last day, if it may be cached (to be called at the end of the response)"""
+        complete = {}
+        self._complete(complete)
+        self._day, self._values = None, []
+        return complete
+
+    def _complete(self, complete: Dict[date, Dict[str, Any]]) -> None:
+        day, values = self._day, self._values
+        if day is None or day >= self.immutable_before or day == self.partial_day:
+            return
+        if len(values) == self.policy.values_per_day and all(self.policy.is_final(v) for v in values):
+            complete[day] = {**self._envelope, self.policy.values_key: values}
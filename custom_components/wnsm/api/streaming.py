@@ -0,0 +1,138 @@
+"""Incremental parsing of large JSON responses (e.g. years of bewegungsdaten)."""
+import codecs
+import json
+import re
+from typing import Any, Dict, List
+
+# characters changing the structure outside of strings, and ending (or escaping within) a string
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_STRING_END = re.compile(r'["\\]')
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+class JsonArrayStreamParser:
+    """Push parser for a JSON object with one large array of objects (e.g. 'values').
+
+    Chunks of the body are handed to `feed`, which returns the array's elements completed by the chunk.
+    Everything else (the envelope, e.g. the descriptor) is collected and available via `envelope`
+    (with an empty array) once the body is complete. Memory is bounded by the envelope and one chunk.
+    """
+
+    def __init__(self, array_key: str = "values"):
+        self.array_key = array_key
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._envelope: List[str] = []
+        self._pending = ""  # undecoded (incomplete) elements of the array
+        self._depth = 0
+        self._in_array = False
+        self._in_string = False
+        self._escaped = False
+        self._key: List[str] | None = None  # a string at depth 1 being read (possibly the array's key)
+        self._last_key = None
+        self._head_text = None  # the envelope until the start of the array
+        self._head = None
+
+    def feed(self, chunk: bytes) -> List[Dict[str, Any]]:
+        """Parses the next chunk of the body, returns the array elements completed by it"""
+        text = self._decoder.decode(chunk)
+        elements = []
+        while text:
+            if self._in_array:
+                text = self._feed_array(text, elements)
+            else:
+                text = self._feed_envelope(text)
+        return elements
+
+    def _feed_array(self, text: str, elements: List[Dict[str, Any]]) -> str:
+        """Decodes complete elements, returns the text after the array (if it ended)"""
+        buffer = self._pending + text
+        position = 0
+        while True:
+            position = _SEPARATORS.match(buffer, position).end()
+            if position >= len(buffer):
+                self._pending = ""
+                return ""
+            if buffer[position] == "]":
+                self._pending = ""
+                self._in_array = False
+                self._depth -= 1
+                self._envelope.append("]")
+                return buffer[position + 1:]
+            if buffer[position] != "{":
+                raise ValueError(f"Expected an object in '{self.array_key}' at: {buffer[position:position + 20]!r}")
+            try:
+                element, position = self._json.raw_decode(buffer, position)
+            except ValueError:
+                # incomplete, wait for the next chunk
+                self._pending = buffer[position:]
+                return ""
+            elements.append(element)
+
+    def _feed_envelope(self, text: str) -> str:
+        """Collects the envelope, returns the text after the start of the array (if it started)"""
+        position, length = 0, len(text)
+        while position < length:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                    self._collect(text[position])
+                    position += 1
+                    continue
+                match = _STRING_END.search(text, position)
+                if match is None:
+                    self._collect(text[position:])
+                    return ""
+                self._collect(text[position:match.start()])
+                position = match.end()
+                if match.group() == "\\":
+                    self._collect("\\")
+                    self._escaped = True
+                else:
+                    self._in_string = False
+                    if self._key is not None:
+                        self._last_key = "".join(self._key)
+                        self._key = None
+                    self._collect('"')
+                continue
+
+            match = _STRUCTURE.search(text, position)
+            if match is None:
+                self._collect(text[position:])
+                return ""
+            self._collect(text[position:match.start()])
+            position = match.end()
+            char = match.group()
+            self._collect(char)
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    self._key = []
+            elif char in "{[":
+                self._depth += 1
+                if char == "[" and self._depth == 2 and self._last_key == self.array_key:
+                    self._in_array = True
+                    self._head_text = "".join(self._envelope)
+                    return text[position:]
+            else:
+                self._depth -= 1
+        return ""
+
+    def _collect(self, text: str) -> None:
+        if text:
+            self._envelope.append(text)
+            if self._key is not None and self._in_string:
+                self._key.append(text)
+
+    def head(self) -> Dict[str, Any] | None:
+        """The envelope read before the array (once the array started), e.g. to validate a descriptor early"""
+        if self._head is None and self._head_text is not None:
+            try:
+                self._head = json.loads(self._head_text + "]}")
+            except ValueError:
+                self._head = {}
+        return self._head
+
+    def envelope(self) -> Dict[str, Any]:
+        """The complete response without the array's elements"""
+        return json.loads("".join(self._envelope))
@@ -0,0 +1,63 @@
+"""Persistence of Smartmeter tokens and API keys."""
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Directory of the default token stores (of the blocking client), one file per username
+DEFAULT_TOKEN_DIRECTORY = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "wnsm")
+
+
+class TokenStore:
+    """Token store which does not persist anything.
+
+    Subclasses persist the state handed to `save` and hand it back in `load`,
+    so that a new Smartmeter instance can skip the login while its tokens are still valid.
+    """
+
+    def load(self) -> dict | None:
+        """Returns the previously saved state or None."""
+        return None
+
+    def save(self, data: dict | None) -> None:
+        """Persists the given state, None clears the store."""
+
+
+class FileTokenStore(TokenStore):
+    """Token store backed by a JSON file (readable by the owner only)."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> dict | None:
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exception:
+            logger.warning("Could not read token store %s: %s", self.path, exception)
+            return None
+
+    def save(self, data: dict | None) -> None:
+        if data is None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", mode=0o700, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+        os.replace(tmp_path, self.path)
+
+
+def default_token_store(username: str) -> FileTokenStore:
+    """File token store of username in DEFAULT_TOKEN_DIRECTORY (named by a hash, not the username)"""
+    name = hashlib.sha256(username.encode("utf-8")).hexdigest()[:16]
+    return FileTokenStore(os.path.join(DEFAULT_TOKEN_DIRECTORY, f"tokens-{name}.json"))
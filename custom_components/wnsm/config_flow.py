@@ -8,14 +8,20 @@ import homeassistant.helpers.config_validation as cv
 import voluptuous as vol
 from homeassistant import config_entries
 from homeassistant.const import CONF_USERNAME, CONF_PASSWORD
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.aiohttp_client import async_create_clientsession
 
-from .api import Smartmeter
+from .api import AioSmartmeter, TokenStore
 from .const import (
     ATTRS_ZAEHLPUNKTE_CALL,
+    DATA_FLOW_TOKENS,
     DOMAIN,
     CONF_ZAEHLPUNKTE,
     CONF_ZUSAMMENSETZUNG,
     CONF_ENABLE_OPTIMA_AKTIV,
+    CONF_METER_CONCURRENCY,
+    DEFAULT_METER_CONCURRENCY,
+    MAX_METER_CONCURRENCY,
 )
 from .utils import translate_dict
 
@@ -43,6 +49,38 @@ ZUSAMMENSETZUNG_SCHEMA = vol.Schema(
 )
 
 
+class FlowTokenStore(TokenStore):
+    """
+    Keeps the tokens of the login validating the credentials (in hass.data), so that the entry
+    created by the flow does not have to log in again (see HassTokenStore)
+    """
+
+    def __init__(self, hass: HomeAssistant, username: str) -> None:
+        self.hass = hass
+        self.username = username
+
+    def save(self, data: dict | None) -> None:
+        # Called from an executor thread by the client
+        self.hass.loop.call_soon_threadsafe(self._async_save, data)
+
+    def _async_save(self, data: dict | None) -> None:
+        tokens = self.hass.data.setdefault(DOMAIN, {}).setdefault(DATA_FLOW_TOKENS, {})
+        if data is None:
+            tokens.pop(self.username, None)
+        else:
+            tokens[self.username] = data
+
+
+def options_schema(meter_concurrency: int = DEFAULT_METER_CONCURRENCY) -> vol.Schema:
+    return vol.Schema(
+        {
+            vol.Required(CONF_METER_CONCURRENCY, default=meter_concurrency): vol.All(
+                vol.Coerce(int), vol.Range(min=1, max=MAX_METER_CONCURRENCY)
+            ),
+        }
+    )
+
+
 class WienerNetzeSmartMeterCustomConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     """Wiener Netze Smartmeter config flow"""
 
@@ -50,14 +88,25 @@ class WienerNetzeSmartMeterCustomConfigFlow(config_entries.ConfigFlow, domain=DO
 
     data: Optional[dict[str, Any]]
 
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry: config_entries.ConfigEntry) -> config_entries.OptionsFlow:
+        return WienerNetzeSmartMeterOptionsFlow(config_entry)
+
     async def validate_auth(self, username: str, password: str) -> list[dict]:
         """
         Validates credentials for smartmeter.
         Raises a ValueError if the auth credentials are invalid.
         """
-        smartmeter = Smartmeter(username, password)
-        await self.hass.async_add_executor_job(smartmeter.login)
-        contracts = await self.hass.async_add_executor_job(smartmeter.zaehlpunkte)
+        # a session of its own for the login cookies, detached once the credentials are checked
+        session = async_create_clientsession(self.hass, auto_cleanup=False)
+        try:
+            smartmeter = AioSmartmeter(username, password, token_store=FlowTokenStore(self.hass, username),
+                                       session=session)
+            await smartmeter.login()
+            contracts = await smartmeter.zaehlpunkte()
+        finally:
+            session.detach()
         zaehlpunkte = []
         if contracts is not None and isinstance(contracts, list) and len(contracts) > 0:
             for contract in contracts:
@@ -144,3 +193,21 @@ class WienerNetzeSmartMeterCustomConfigFlow(config_entries.ConfigFlow, domain=DO
                 "zusammensetzung": "Zusammensetzung"
             },
         )
+
+
+class WienerNetzeSmartMeterOptionsFlow(config_entries.OptionsFlow):
+    """Wiener Netze Smartmeter options flow, the options are read at every refresh"""
+
+    def __init__(self, config_entry: config_entries.ConfigEntry) -> None:
+        self.config_entry = config_entry
+
+    async def async_step_init(self, user_input: Optional[dict[str, Any]] = None):
+        """Ask for the number of meters refreshed concurrently."""
+        if user_input is not None:
+            return self.async_create_entry(title="", data=user_input)
+
+        return self.async_show_form(
+            step_id="init",
+            data_schema=options_schema(self.config_entry.options.get(
+                CONF_METER_CONCURRENCY, DEFAULT_METER_CONCURRENCY)),
+        )
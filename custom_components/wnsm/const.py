@@ -6,6 +6,19 @@ DOMAIN = "wnsm"
 CONF_ZAEHLPUNKTE = "zaehlpunkte"
 CONF_ZUSAMMENSETZUNG = "zusammensetzung"
 CONF_ENABLE_OPTIMA_AKTIV = "enable_optima_aktiv"
+# Number of meters of an account refreshed concurrently
+CONF_METER_CONCURRENCY = "meter_concurrency"
+DEFAULT_METER_CONCURRENCY = 4
+MAX_METER_CONCURRENCY = 10
+
+STORAGE_VERSION = 1
+STORAGE_KEY_TOKENS = f"{DOMAIN}.tokens"
+STORAGE_KEY_IMPORT = f"{DOMAIN}.import"
+STORAGE_KEY_SNAPSHOT = f"{DOMAIN}.snapshot"
+# Directory (in the config directory) of the response caches by entry, outside .storage so that backups stay small
+RESPONSE_CACHE_DIR = f".cache/{DOMAIN}"
+# Tokens of the config flow's login by username (in hass.data[DOMAIN]), taken over by the entry it creates
+DATA_FLOW_TOKENS = "flow_tokens"
 
 ATTRS_ZAEHLPUNKT_CALL = [
     ("zaehlpunktnummer", "zaehlpunktnummer"),
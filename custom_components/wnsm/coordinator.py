@@ -1,23 +1,70 @@
+import asyncio
 import logging
 from datetime import datetime, timedelta
 from typing import Any
 
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.config_entries import ConfigEntry
+from homeassistant.helpers.aiohttp_client import async_create_clientsession
+from homeassistant.helpers.storage import Store
 from homeassistant.helpers.update_coordinator import (
     DataUpdateCoordinator,
     UpdateFailed,
 )
 from homeassistant.const import CONF_USERNAME, CONF_PASSWORD, CONF_DEVICE_ID
 
-from .api import Smartmeter
+from .api import AioSmartmeter, FileResponseCache, TokenStore
 from .AsyncSmartmeter import AsyncSmartmeter
-from .const import DOMAIN, CONF_ZAEHLPUNKTE
+from .api.constants import ValueType
+from .const import DOMAIN, DATA_FLOW_TOKENS, CONF_ZAEHLPUNKTE, CONF_METER_CONCURRENCY, DEFAULT_METER_CONCURRENCY, STORAGE_VERSION, STORAGE_KEY_TOKENS, STORAGE_KEY_SNAPSHOT, RESPONSE_CACHE_DIR
 from .importer import Importer
-from .utils import before, today
+from .scheduler import ImportScheduler
+from .storage import ImportStateStore
 
 _LOGGER = logging.getLogger(__name__)
 
+# The sensors are refreshed this often (the imports are scheduled on their own, see ImportScheduler)
+UPDATE_INTERVAL = timedelta(hours=1)
+# The data of the last refresh is written after this many seconds (restored at the next start)
+SNAPSHOT_SAVE_DELAY = 10
+
+
+def response_cache_path(hass: HomeAssistant, entry_id: str) -> str:
+    """Directory of the response cache of an entry (removed with the entry)"""
+    return hass.config.path(RESPONSE_CACHE_DIR, entry_id)
+
+
+class HassTokenStore(TokenStore):
+    """
+    Token store persisting tokens and API keys in the HA storage (.storage).
+    Until it stored any, it takes over the tokens of the config flow's login of username.
+    """
+
+    def __init__(self, hass: HomeAssistant, entry_id: str, username: str | None = None) -> None:
+        self.hass = hass
+        self.username = username
+        self._store = Store(hass, STORAGE_VERSION, f"{STORAGE_KEY_TOKENS}.{entry_id}", private=True)
+        self._data = None
+        self._loaded = False
+
+    async def async_load(self) -> None:
+        """Load the stored tokens once, has to be awaited before the Smartmeter logs in."""
+        if not self._loaded:
+            self._data = await self._store.async_load()
+            if self._data is None and self.username is not None:
+                self._data = self.hass.data.get(DOMAIN, {}).get(DATA_FLOW_TOKENS, {}).pop(self.username, None)
+                if self._data is not None:
+                    self._store.async_delay_save(lambda: self._data, 1)
+            self._loaded = True
+
+    def load(self) -> dict | None:
+        return self._data
+
+    def save(self, data: dict | None) -> None:
+        # Called from an executor thread by the client
+        self._data = data
+        self.hass.loop.call_soon_threadsafe(self._store.async_delay_save, lambda: self._data, 1)
+
 
 class WienerNetzeCoordinator(DataUpdateCoordinator):
     """Class to manage fetching data from Wiener Netze."""
@@ -28,21 +75,53 @@ class WienerNetzeCoordinator(DataUpdateCoordinator):
         self.username = entry.data[CONF_USERNAME]
         self.password = entry.data[CONF_PASSWORD]
         
-        # Initialize Smartmeter API
-        self.smartmeter = Smartmeter(self.username, self.password)
+        # Initialize Smartmeter API, tokens are kept across restarts
+        self.token_store = HassTokenStore(hass, entry.entry_id, self.username)
+        # The login relies on cookies, hence a session with its own cookie jar (but HA's shared connector),
+        # detached when the entry is unloaded
+        session = async_create_clientsession(hass, auto_cleanup=False)
+        entry.async_on_unload(session.detach)
+        self.smartmeter = AioSmartmeter(
+            self.username, self.password, token_store=self.token_store,
+            session=session,
+            # immutable days of historical data are only requested once
+            response_cache=FileResponseCache(response_cache_path(hass, entry.entry_id)),
+        )
         self.async_smartmeter = AsyncSmartmeter(hass, self.smartmeter)
+        self.import_state = ImportStateStore(hass, entry.entry_id)
+        # The last data, so that the sensors have their state right after a restart
+        self._snapshot = Store(hass, STORAGE_VERSION, f"{STORAGE_KEY_SNAPSHOT}.{entry.entry_id}")
+        self.import_scheduler = ImportScheduler(hass, entry, self.async_smartmeter, self.import_state)
+        entry.async_on_unload(self.import_scheduler.async_stop)
+        entry.async_on_unload(self.async_smartmeter.async_stop)
         
         super().__init__(
             hass,
             _LOGGER,
             name=DOMAIN,
-            update_interval=timedelta(hours=1),
+            update_interval=UPDATE_INTERVAL,
+            # listeners are only notified about changed data (see async_update_listeners)
+            always_update=False,
         )
+        # Zaehlpunkte whose data changed in the last refresh (None: notify all listeners)
+        self._changed_contexts: set[str] | None = None
+        self._notified_success: bool | None = None
+
+    async def async_restore_snapshot(self) -> bool:
+        """Restores the data of the last refresh (before the restart), returns if there was any."""
+        data = await self._snapshot.async_load()
+        if not data:
+            return False
+        _LOGGER.debug("Restored data of %d zaehlpunkte from the snapshot", len(data))
+        self.async_set_updated_data(data)
+        return True
 
     async def _async_update_data(self) -> dict[str, Any]:
         """Update data via library."""
         try:
-            # Ensure we are logged in
+            # Ensure we are logged in (reusing stored tokens if still valid)
+            await self.token_store.async_load()
+            await self.import_state.async_load()
             await self.async_smartmeter.login()
 
             data = {}
@@ -52,64 +131,99 @@ class WienerNetzeCoordinator(DataUpdateCoordinator):
                 _LOGGER.warning("No zaehlpunkte configured")
                 return data
 
-            for zp_config in zaehlpunkte_config:
-                zp_id = zp_config["zaehlpunktnummer"]
-                try:
-                    # Fetch Zaehlpunkt details (attributes)
-                    zp_details = await self.async_smartmeter.get_zaehlpunkt(zp_id)
-                    
-                    meter_reading = None
-                    # Fetch latest meter reading (state)
-                    if self.async_smartmeter.is_active(zp_details):
-                        # Try getting reading from yesterday or day before
-                        reading_dates = [before(today(), 1), before(today(), 2)]
-                        for reading_date in reading_dates:
-                            meter_reading = await self.async_smartmeter.get_meter_reading_from_historic_data(
-                                zp_id, reading_date, datetime.now()
-                            )
-                            if meter_reading is not None:
-                                break
-                        
-                        if meter_reading is None:
-                            _LOGGER.warning(f"Could not retrieve meter reading for {zp_id}")
-                            
-                        # Trigger Importer for historical statistics
-                        # We do this here to ensure it runs regularly
-                        # Importer handles its own check if it needs to run (< 24h check)
-                        # We need unit_of_measurement and granularity. 
-                        # Attributes might not be fully available here if we just fetched zp_details.
-                        # wnsm_sensor used self.unit_of_measurement which defaults to KWH
-                        # and self.granularity() from attributes.
-                        
-                        granularity = zp_details.get("granularity", "QUARTER_HOUR") if zp_details else "QUARTER_HOUR"
-                        # Default to KWh as in WNSMSensor
-                        unit = "kWh" 
-                        
-                        from .api.constants import ValueType
-                        val_type = ValueType.from_str(granularity)
-                        
-                        importer = Importer(self.hass, self.async_smartmeter, zp_id, unit, val_type)
-                        await importer.async_import()
-
-                    data[zp_id] = {
-                        "details": zp_details,
-                        "reading": meter_reading,
-                        "timestamp": datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-                    }
-                    
-                except Exception as e:
-                    _LOGGER.error(f"Error updating zaehlpunkt {zp_id}: {e}")
-                    # We continue to next zaehlpunkt instead of failing everything
-                    # Include error so we can see it in sensor attributes
-                    data[zp_id] = {
-                        "error": str(e),
-                        "details": None,
-                        "reading": None,
-                         "timestamp": datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-                    }
+            # Meters are refreshed concurrently, an error of one does not affect the others
+            # (as many as set in the options)
+            slots = asyncio.Semaphore(self.entry.options.get(CONF_METER_CONCURRENCY, DEFAULT_METER_CONCURRENCY))
+
+            # The contracts are fetched once per refresh for all meters
+            zp_details = await self.async_smartmeter.get_zaehlpunkte_details()
+
+            async def update(zp_id: str) -> dict[str, Any]:
+                async with slots:
+                    return await self._async_update_zaehlpunkt(zp_id, zp_details.get(zp_id))
+
+            zp_ids = [zp_config["zaehlpunktnummer"] for zp_config in zaehlpunkte_config]
+            previous = self.data or {}
+            changed = set()
+            for zp_id, zp_data in zip(zp_ids, await asyncio.gather(*(update(zp_id) for zp_id in zp_ids))):
+                if zp_id in previous and _content(previous[zp_id]) == _content(zp_data):
+                    # unchanged, keeps the time of its last change
+                    zp_data["changed"] = previous[zp_id].get("changed", previous[zp_id].get("timestamp"))
+                else:
+                    zp_data["changed"] = zp_data["timestamp"]
+                    changed.add(zp_id)
+                data[zp_id] = zp_data
+            self._changed_contexts = changed
+
+            if changed:
+                self._snapshot.async_delay_save(lambda: data, SNAPSHOT_SAVE_DELAY)
 
             return data
 
         except Exception as e:
+            self._changed_contexts = None
             _LOGGER.exception("Error updating Wiener Netze data")
             raise UpdateFailed(e) from e
+
+    @callback
+    def async_update_listeners(self) -> None:
+        """Notifies only the listeners (by their context, the zaehlpunkt) whose data changed."""
+        changed, self._changed_contexts = self._changed_contexts, None
+        notify_all = changed is None or self.last_update_success != self._notified_success
+        self._notified_success = self.last_update_success
+        if not notify_all and not changed:
+            # only the volatile refresh times differ
+            return
+        for update_callback, context in list(self._listeners.values()):
+            if notify_all or context is None or context in changed:
+                update_callback()
+
+    async def _async_update_zaehlpunkt(self, zp_id: str, zp_details: dict[str, str] | None) -> dict[str, Any]:
+        """Fetches the reading of a zaehlpunkt (given its details) and schedules the import of its statistics."""
+        try:
+            if zp_details is None:
+                raise RuntimeError(f"Zaehlpunkt {zp_id} not found")
+
+            meter_reading = None
+            if self.async_smartmeter.is_active(zp_details):
+                # We need unit_of_measurement and granularity.
+                # wnsm_sensor used self.unit_of_measurement which defaults to KWH
+                # and self.granularity() from attributes.
+                granularity = zp_details.get("granularity", "QUARTER_HOUR") if zp_details else "QUARTER_HOUR"
+                # Default to KWh as in WNSMSensor
+                unit = "kWh"
+                val_type = ValueType.from_str(granularity)
+
+                # Latest meter reading (state), derived from the imported statistics
+                # (the meter readings are only requested once a day)
+                importer = Importer(self.hass, self.async_smartmeter, zp_id, unit, val_type, self.import_state)
+                meter_reading = await importer.async_meter_reading()
+                if meter_reading is None:
+                    _LOGGER.warning(f"Could not retrieve meter reading for {zp_id}")
+
+                # Schedule the import of historical statistics, it runs in the background
+                # (a long backfill must not hold up the sensors)
+                # Importer handles its own check if it needs to run (< 24h check)
+                self.import_scheduler.async_schedule(zp_id, zp_details, unit, val_type)
+
+            return {
+                "details": zp_details,
+                "reading": meter_reading,
+                "timestamp": datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+            }
+
+        except Exception as e:
+            _LOGGER.error(f"Error updating zaehlpunkt {zp_id}: {e}")
+            # We continue with the other zaehlpunkte instead of failing everything
+            # Include error so we can see it in sensor attributes
+            return {
+                "error": str(e),
+                "details": None,
+                "reading": None,
+                "timestamp": datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+            }
+
+
+def _content(zp_data: dict[str, Any]) -> dict[str, Any]:
+    """The data of a zaehlpunkt compared between refreshes (without the volatile times of its refresh and change)"""
+    return {key: value for key, value in zp_data.items() if key not in ("timestamp", "changed")}
@@ -0,0 +1,63 @@
+"""
+Coverage of the imported statistics: which (quarter hour) intervals have been imported with measured values
+"""
+from __future__ import annotations
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+
+
+class IntervalSet:
+    """
+    A set of half-open intervals [start, end) of epoch seconds, kept sorted and merged
+    (adjacent intervals are joined), e.g. a meter's imported quarter hours.
+    Serialized as a list of [start, end] for the import state.
+    """
+
+    def __init__(self, intervals: list[list[int]] | None = None):
+        self._starts: list[int] = []
+        self._ends: list[int] = []
+        for start, end in intervals or []:
+            self.add(start, end)
+
+    def __bool__(self) -> bool:
+        return bool(self._starts)
+
+    def add(self, start: int, end: int) -> None:
+        if start >= end:
+            return
+        # all intervals overlapping or adjacent to [start, end) are merged with it
+        first = bisect_left(self._ends, start)
+        last = bisect_right(self._starts, end)
+        if first < last:
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+
+    def add_datetimes(self, start: datetime, end: datetime) -> None:
+        self.add(int(start.timestamp()), int(end.timestamp()))
+
+    def gaps(self, start: int, end: int) -> list[tuple[int, int]]:
+        """The intervals within [start, end) that are not covered"""
+        gaps = []
+        position = start
+        for index in range(bisect_right(self._ends, start), len(self._starts)):
+            if self._starts[index] >= end:
+                break
+            if self._starts[index] > position:
+                gaps.append((position, self._starts[index]))
+            position = max(position, self._ends[index])
+        if position < end:
+            gaps.append((position, end))
+        return gaps
+
+    def bounds(self) -> tuple[datetime, datetime] | None:
+        """The start of the first and the end of the last interval"""
+        if not self:
+            return None
+        return (datetime.fromtimestamp(self._starts[0], timezone.utc),
+                datetime.fromtimestamp(self._ends[-1], timezone.utc))
+
+    def to_list(self) -> list[list[int]]:
+        return [[start, end] for start, end in zip(self._starts, self._ends)]
@@ -1,8 +1,6 @@
 import logging
-from collections import defaultdict
-from datetime import timedelta, timezone, datetime
-from decimal import Decimal
-from operator import itemgetter
+from datetime import timedelta, timezone, datetime, date
+from typing import AsyncIterator, Iterable, Iterator
 
 from homeassistant.components.recorder import get_instance
 from homeassistant.components.recorder.models import (
@@ -10,34 +8,213 @@ from homeassistant.components.recorder.models import (
     StatisticMetaData,
 )
 from homeassistant.components.recorder.statistics import (
-    get_last_statistics, async_add_external_statistics,
+    get_last_statistics, async_add_external_statistics, statistics_during_period,
 )
 from homeassistant.core import HomeAssistant
 from homeassistant.util import dt as dt_util
 
 from .AsyncSmartmeter import AsyncSmartmeter
+from .aggregation import HourlyAccumulator, aggregate_hourly, from_milli_wh, to_milli_wh, MILLI_WH_PER_KWH, MILLI_WH_PER_WH
 from .api.constants import ValueType
 from .const import DOMAIN
+from .coverage import IntervalSet
+from .storage import ImportStateStore
 
 _LOGGER = logging.getLogger(__name__)
 
+# Hourly statistics handed to the recorder at a time, it has to catch up before the next batch is queued
+STATISTICS_BATCH_SIZE = 7 * 24
+# Progress of an import is logged (at least) in these steps
+PROGRESS_LOG_PERCENT = 10
+# Hours with estimated values are queried again (at most) this often, until they are measured or this old
+ESTIMATED_RECHECK_INTERVAL = timedelta(hours=24)
+ESTIMATED_MAX_AGE = timedelta(days=60)
+# Gaps (quarter hours imported without a measured value) are searched (at most) this often, back to this age
+GAP_RECHECK_INTERVAL = timedelta(hours=24)
+GAP_MAX_AGE = timedelta(days=90)
+# The imported statistics are compared with the daily meter readings (at most) this often, back to this age
+RECONCILE_INTERVAL = timedelta(hours=24)
+RECONCILE_MAX_AGE = timedelta(days=3 * 365)
+# Deviation (milli-Wh) of a day's consumption from the meter readings that is tolerated (rounding)
+RECONCILE_TOLERANCE = 10 * MILLI_WH_PER_WH
+# The meter reading is derived from an anchor (a METER_READ value) and the imported consumption since,
+# the anchor is renewed after this time
+ANCHOR_MAX_AGE = timedelta(hours=24)
+
+
+class StatisticsWriter:
+    """
+    Writes statistics to the recorder in batches of (at most) batch_size, waiting for the recorder
+    to commit a batch before the next one is queued. This bounds the recorder's queue during large
+    imports, so that the recording of everything else does not stall.
+    """
+
+    def __init__(self, hass: HomeAssistant, metadata: StatisticMetaData, expected: int = None,
+                 batch_size: int = STATISTICS_BATCH_SIZE):
+        self.hass = hass
+        self.metadata = metadata
+        self.expected = expected  #: number of statistics expected in total (for the progress), if known
+        self.batch_size = batch_size
+        self.written = 0
+        self.last: StatisticData | None = None  #: the latest statistic written
+        self._buffer: list[StatisticData] = []
+        self._queued = False
+        self._logged_percent = 0
+
+    async def write(self, statistics: Iterable[StatisticData]) -> None:
+        self._buffer.extend(statistics)
+        while len(self._buffer) >= self.batch_size:
+            batch, self._buffer = self._buffer[:self.batch_size], self._buffer[self.batch_size:]
+            await self._write_batch(batch)
+
+    async def flush(self) -> None:
+        """Writes the buffered statistics and waits until the recorder committed them"""
+        if self._buffer:
+            batch, self._buffer = self._buffer, []
+            await self._write_batch(batch)
+        await self._drain()
+
+    async def _drain(self) -> None:
+        if self._queued:
+            await get_instance(self.hass).async_block_till_done()
+            self._queued = False
+
+    async def _write_batch(self, batch: list[StatisticData]) -> None:
+        await self._drain()
+        _LOGGER.debug(f"Importing statistics from {batch[0]} to {batch[-1]}")
+        async_add_external_statistics(self.hass, self.metadata, batch)
+        self._queued = True
+        self.written += len(batch)
+        self.last = batch[-1]
+        self._log_progress()
+
+    def _log_progress(self) -> None:
+        if not self.expected:
+            return
+        percent = min(100, self.written * 100 // self.expected)
+        if percent >= self._logged_percent + PROGRESS_LOG_PERCENT:
+            self._logged_percent = percent - percent % PROGRESS_LOG_PERCENT
+            _LOGGER.info("Imported %d of about %d hourly statistics of %s (%d%%)",
+                         self.written, self.expected, self.metadata["statistic_id"], percent)
+
+
 class Importer:
 
-    def __init__(self, hass: HomeAssistant, async_smartmeter: AsyncSmartmeter, zaehlpunkt: str, unit_of_measurement: str, granularity: ValueType = ValueType.QUARTER_HOUR):
+    def __init__(self, hass: HomeAssistant, async_smartmeter: AsyncSmartmeter, zaehlpunkt: str, unit_of_measurement: str, granularity: ValueType = ValueType.QUARTER_HOUR,
+                 import_state: ImportStateStore = None):
         self.id = f'{DOMAIN}:{zaehlpunkt.lower()}'
         self.zaehlpunkt = zaehlpunkt
         self.granularity = granularity
         self.unit_of_measurement = unit_of_measurement
         self.hass = hass
         self.async_smartmeter = async_smartmeter
+        # Persists the progress of running imports, so that they are resumed (after a failure or restart)
+        self.import_state = import_state
+
+    def get_checkpoint(self):
+        """Returns (start, end, sum) of an interrupted import or None"""
+        if self.import_state is None:
+            return None
+        checkpoint = self.import_state.get(self.id, "checkpoint")
+        if not checkpoint:
+            return None
+        try:
+            pending = checkpoint["pending"][0]
+            return (dt_util.parse_datetime(pending[0]), dt_util.parse_datetime(pending[1]),
+                    int(checkpoint["sum_mwh"]))
+        except (KeyError, IndexError, TypeError, ValueError, ArithmeticError):
+            _LOGGER.warning("Ignoring invalid import checkpoint of %s: %s", self.id, checkpoint)
+            self.import_state.set(self.id, "checkpoint", None)
+            return None
+
+    async def _save_checkpoint(self, last_day: date, start: datetime, end: datetime, total_usage: int,
+                               last_end: datetime | None):
+        """
+        Records that everything until (including) last_day has been imported, start - end is still pending.
+        The statistics have to be committed (see StatisticsWriter.flush) before the checkpoint claims them to be.
+        The last statistic (ending at last_end) is remembered along, it is checked against the recorder after a restart.
+        """
+        if self.import_state is None:
+            return
+        if last_end is not None:
+            self._remember_last_statistic(last_end, total_usage)
+        self.import_state.set(self.id, "checkpoint", {
+            "last_day": last_day.isoformat(),
+            "sum_mwh": total_usage,
+            "pending": [[start.isoformat(), end.isoformat()]],
+        })
+        await self.import_state.async_save()
+
+    def _clear_checkpoint(self):
+        if self.import_state is not None:
+            self.import_state.set(self.id, "checkpoint", None)
+
+    async def _async_get_last_statistic(self):
+        """
+        Returns the last imported statistic like get_last_statistics does. It is remembered (and persisted)
+        after every import, the recorder is only queried if it is unknown (first start) and once after every start,
+        in case the statistics have been modified externally meanwhile (e.g. by utils/purge_last_x_days.py)
+        """
+        last = self.import_state.get(self.id, "last") if self.import_state is not None else None
+        if last and self.id in self.import_state.verified:
+            try:
+                return {self.id: [{"end": dt_util.parse_datetime(last["end"]).timestamp(),
+                                   "sum": from_milli_wh(int(last["sum_mwh"]))}]}
+            except (KeyError, TypeError, ValueError, AttributeError):
+                _LOGGER.warning("Ignoring invalid last statistic of %s: %s", self.id, last)
+        # Query the statistics database for the last value
+        # It is crucial to use get_instance here!
+        last_inserted_stat = await get_instance(
+            self.hass
+        ).async_add_executor_job(
+            get_last_statistics,
+            self.hass,
+            1,  # Get at most one entry
+            self.id,  # of this sensor
+            True,  # convert the units
+            # XXX: since HA core 2022.12 need to specify this:
+            {"sum", "state"},  # the fields we want to query (state might be used in the future)
+        )
+        start_off_point = None
+        if self.is_last_inserted_stat_valid(last_inserted_stat):
+            start_off_point = self._parse_last_inserted_stat(last_inserted_stat)
+        if self.import_state is None:
+            return last_inserted_stat
+        if last and not self._is_remembered(last, start_off_point):
+            # the import continues from the recorder, an interrupted import would continue from a stale sum
+            _LOGGER.warning("The last statistic of %s remembered (%s) does not match the recorder's (%s), "
+                            "the statistics were modified externally", self.id, last, start_off_point)
+            self._clear_checkpoint()
+        if start_off_point is not None:
+            self._remember_last_statistic(*start_off_point)
+        else:
+            self.import_state.set(self.id, "last", None)
+        self.import_state.verified.add(self.id)
+        return last_inserted_stat
+
+    @staticmethod
+    def _is_remembered(last: dict, start_off_point: tuple[datetime, int] | None) -> bool:
+        """Whether the remembered last statistic is the (end, sum) found in the recorder"""
+        if start_off_point is None:
+            return False
+        try:
+            return dt_util.parse_datetime(last["end"]) == start_off_point[0] \
+                and abs(int(last["sum_mwh"]) - start_off_point[1]) <= 1
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    def _remember_last_statistic(self, end: datetime, total_usage: int):
+        if self.import_state is not None:
+            self.import_state.set(self.id, "last", {"end": end.isoformat(), "sum_mwh": total_usage})
 
     def is_last_inserted_stat_valid(self, last_inserted_stat):
         return len(last_inserted_stat) == 1 and len(last_inserted_stat[self.id]) == 1 and \
             "sum" in last_inserted_stat[self.id][0] and "end" in last_inserted_stat[self.id][0]
 
-    def prepare_start_off_point(self, last_inserted_stat):
+    def _parse_last_inserted_stat(self, last_inserted_stat):
+        """Returns the (end, sum) of the last inserted statistic, None if the end cannot be parsed"""
         # Previous data found in the statistics table
-        _sum = Decimal(last_inserted_stat[self.id][0]["sum"])
+        _sum = to_milli_wh(last_inserted_stat[self.id][0]["sum"])
         # The next start is the previous end
         # XXX: since HA core 2022.12, we get a datetime and not a str...
         # XXX: since HA core 2023.03, we get a float and not a datetime...
@@ -54,53 +231,60 @@ class Importer:
                           last_inserted_stat,
                           type(last_inserted_stat[self.id][0]["end"]))
             return None
+        return start, _sum
+
+    def prepare_start_off_point(self, last_inserted_stat):
+        start_off_point = self._parse_last_inserted_stat(last_inserted_stat)
+        if start_off_point is None:
+            return None
+        start, _sum = start_off_point
         _LOGGER.debug("New starting datetime: %s", start)
 
         # Extra check to not strain the API too much:
-        # If the last insert date is less than 24h away, simply exit here,
-        # because we will not get any data from the API
-        min_wait = timedelta(hours=24)
-        delta_t = datetime.now(timezone.utc).replace(microsecond=0) - start.replace(microsecond=0)
-        if delta_t <= min_wait:
-            _LOGGER.debug(
-                "Not querying the API, because last update is not older than 24 hours. Earliest update in %s" % (
-                        min_wait - delta_t))
+        # Days are only published once they are over, if everything until today has been imported
+        # simply exit here, because we will not get any data from the API
+        # (when to try again is up to the ImportScheduler, which learns when days are published)
+        if start >= dt_util.start_of_local_day():
+            _LOGGER.debug("Not querying the API, because everything until %s has been imported already", start)
             return None
         return start, _sum
 
-    async def async_import(self):
-        # Query the statistics database for the last value
-        # It is crucial to use get_instance here!
-        last_inserted_stat = await get_instance(
-            self.hass
-        ).async_add_executor_job(
-            get_last_statistics,
-            self.hass,
-            1,  # Get at most one entry
-            self.id,  # of this sensor
-            True,  # convert the units
-            # XXX: since HA core 2022.12 need to specify this:
-            {"sum", "state"},  # the fields we want to query (state might be used in the future)
-        )
+    async def async_import(self, zaehlpunkt_details: dict = None):
+        """
+        Imports the statistics, zaehlpunkt_details (see AsyncSmartmeter.get_zaehlpunkt) are fetched if not given.
+        Errors of the API are logged and raised, so that the ImportScheduler retries after a back-off.
+        """
+        last_inserted_stat = await self._async_get_last_statistic()
         _LOGGER.debug("Last inserted stat: %s" % last_inserted_stat)
         try:
             await self.async_smartmeter.login()
-            zaehlpunkt = await (self.async_smartmeter.get_zaehlpunkt(self.zaehlpunkt))
+            zaehlpunkt = zaehlpunkt_details
+            if zaehlpunkt is None:
+                zaehlpunkt = await self.async_smartmeter.get_zaehlpunkt(self.zaehlpunkt)
 
             if not self.async_smartmeter.is_active(zaehlpunkt):
                 _LOGGER.debug("Smartmeter %s is not active" % zaehlpunkt)
                 return
 
-            if not self.is_last_inserted_stat_valid(last_inserted_stat):
+            await self._revise_estimated_hours()
+
+            checkpoint = self.get_checkpoint()
+            if checkpoint is not None:
+                start, end, _sum = checkpoint
+                _LOGGER.info("Resuming import of historical data of %s from %s", self.zaehlpunkt, start)
+                _sum = await self._import_statistics(start=start, end=end, total_usage=_sum)
+            elif not self.is_last_inserted_stat_valid(last_inserted_stat):
                 # No previous data - start from scratch
                 _LOGGER.warning("Starting import of historical data. This might take some time.")
                 _sum = await self._initial_import_statistics()
             else:
                 start_off_point = self.prepare_start_off_point(last_inserted_stat)
-                if start_off_point is None:
-                    return
-                start, _sum = start_off_point
-                _sum = await self._incremental_import_statistics(start, _sum)
+                if start_off_point is not None:
+                    start, _sum = start_off_point
+                    _sum = await self._incremental_import_statistics(start, _sum)
+
+            await self._fill_gaps()
+            await self._reconcile()
 
             # XXX: Note that the state of this sensor must never be an integer value, such as 0!
             # If it is set to any number, home assistant will assume that a negative consumption
@@ -110,19 +294,341 @@ class Importer:
             # same time.
             # Due to None, the sensor will always show "unkown" - but that is currently the only way
             # how historical data can be imported without rewriting the database on our own...
-            last_inserted_stat = await get_instance(self.hass).async_add_executor_job(
-                get_last_statistics,
-                self.hass,
-                1,  # Get at most one entry
-                self.id,  # of this sensor's statistics
-                True,  # convert the units
-                {"sum"}  # the fields we want to query
-            )
-            _LOGGER.debug("Last inserted stat: %s", last_inserted_stat)
+            if self.import_state is not None:
+                _LOGGER.debug("Last inserted stat: %s", self.import_state.get(self.id, "last"))
         except TimeoutError as e:
             _LOGGER.warning("Error retrieving data from smart meter api - Timeout: %s" % e)
+            raise
         except RuntimeError as e:
             _LOGGER.exception("Error retrieving data from smart meter api - Error: %s" % e)
+            raise
+
+    def _track_estimated_hours(self, accumulator: HourlyAccumulator, hourly: Iterable[list[tuple[datetime, int, int]]]):
+        """Passes the hourly rows through, remembering those with estimated values (to revise them later)"""
+        for rows in hourly:
+            if self.import_state is not None and accumulator.estimated_hours:
+                estimated = dict(self.import_state.get(self.id, "estimated") or {})
+                for hour, usage, _sum in rows:
+                    if hour in accumulator.estimated_hours:
+                        estimated[hour.isoformat()] = [usage, _sum]
+                self.import_state.set(self.id, "estimated", estimated)
+            yield rows
+
+    async def _revise_estimated_hours(self):
+        """
+        Queries the days of hours imported with estimated values again and replaces the hours
+        whose values were replaced by measured ones (or changed) since.
+        """
+        if self.import_state is None or not self.import_state.get(self.id, "estimated"):
+            return
+        now = dt_util.utcnow()
+        checked = dt_util.parse_datetime(self.import_state.get(self.id, "estimated_checked") or "")
+        if checked is not None and now - checked < ESTIMATED_RECHECK_INTERVAL:
+            return
+        self.import_state.set(self.id, "estimated_checked", now.isoformat())
+
+        known = {}
+        for hour, (usage, _sum) in self.import_state.get(self.id, "estimated").items():
+            hour = dt_util.parse_datetime(hour)
+            if hour is not None and now - hour < ESTIMATED_MAX_AGE:
+                known[hour] = (usage, _sum)
+        still_estimated, revised = set(), {}
+        for window_start, last_day in _day_windows(known):
+            bewegungsdaten = await self.async_smartmeter.get_bewegungsdaten(
+                self.zaehlpunkt, window_start, last_day, self.granularity)
+            hourly = aggregate_hourly(bewegungsdaten.get('values') or [], _scale(bewegungsdaten))
+            fetched = dict(zip(hourly.hours, hourly.usage))
+            for hour in known:
+                if window_start.date() <= hour.date() <= last_day:
+                    if hour not in fetched or hour in hourly.estimated_hours:
+                        still_estimated.add(hour)
+                    if hour in fetched:
+                        revised[hour] = fetched[hour]
+        _LOGGER.debug("Revising %d hours of %s with estimated values, %d still estimated",
+                      len(known), self.id, len(still_estimated))
+        known = await self._replace_hours(known, revised)
+        self.import_state.set(self.id, "estimated", {
+            hour.isoformat(): list(known[hour]) for hour in sorted(still_estimated)
+        } or None)
+
+    async def _replace_hours(self, known: dict[datetime, tuple[int, int]], usage: dict[datetime, int]):
+        """
+        Replaces the usage (milli-Wh) of imported hours, known are their current (usage, sum).
+        The changes are accumulated once: the statistics from the first to the last changed hour are
+        rewritten with their shifted sums in one go, the sums of all following statistics are shifted
+        by the total change in a single adjustment (async_adjust_statistics).
+        Returns known with the new usage and sums.
+        """
+        changes = [(hour, usage[hour] - known[hour][0]) for hour in sorted(known)
+                   if hour in usage and usage[hour] != known[hour][0]]
+        result, changed, delta = {}, dict(changes), 0
+        for hour in sorted(known):
+            old_usage, old_sum = known[hour]
+            delta += changed.get(hour, 0)
+            result[hour] = (old_usage + changed.get(hour, 0), old_sum + delta)
+        if not changes:
+            return result
+        first, last = changes[0][0], changes[-1][0]
+        _LOGGER.info("Replacing %d hourly statistics of %s, the sum changes by %s",
+                     len(changes), self.id, from_milli_wh(delta))
+
+        # the statistics between the changed hours are shifted by the changes before them
+        affected = await self._async_get_hourly_rows(first, last + timedelta(hours=1))
+        affected.update({hour: known[hour] for hour in changed})
+        statistics, delta = [], 0
+        for hour in sorted(affected):
+            old_usage, old_sum = affected[hour]
+            delta += changed.get(hour, 0)
+            statistics.append(StatisticData(start=hour, sum=from_milli_wh(old_sum + delta),
+                                            state=from_milli_wh(old_usage + changed.get(hour, 0))))
+        get_instance(self.hass).async_adjust_statistics(
+            self.id, last + timedelta(hours=1), from_milli_wh(delta), self.unit_of_measurement)
+        writer = StatisticsWriter(self.hass, self.get_statistics_metadata())
+        await writer.write(statistics)
+        await writer.flush()
+        self._shift_sums(changes)
+        return result
+
+    def _shift_sums(self, changes: list[tuple[datetime, int]]):
+        """The statistics changed by (hour, change in milli-Wh), so do the sums remembered of them"""
+        if self.import_state is None:
+            return
+        delta = sum(change for _, change in changes)
+        estimated = self.import_state.get(self.id, "estimated")
+        if estimated:
+            shifted = {}
+            for hour, (usage, _sum) in estimated.items():
+                parsed = dt_util.parse_datetime(hour)
+                shifted[hour] = [usage, _sum + sum(change for at, change in changes if parsed is not None and at <= parsed)]
+            self.import_state.set(self.id, "estimated", shifted)
+        anchor = self.import_state.get(self.id, "anchor")
+        if anchor and any(hour < dt_util.parse_datetime(anchor["at"]) for hour, _ in changes):
+            # the sum at the anchor changed, hence the derived reading would drift
+            self.import_state.set(self.id, "anchor", None)
+        last = self.import_state.get(self.id, "last")
+        if last:
+            self.import_state.set(self.id, "last", {**last, "sum_mwh": int(last["sum_mwh"]) + delta})
+        checkpoint = self.import_state.get(self.id, "checkpoint")
+        if checkpoint:
+            self.import_state.set(self.id, "checkpoint", {**checkpoint, "sum_mwh": int(checkpoint["sum_mwh"]) + delta})
+
+    def _record_coverage(self, measured: Iterable[tuple[datetime, datetime]]):
+        """Records the imported runs of measured quarter hours (to find the gaps later)"""
+        if self.import_state is None or self.granularity != ValueType.QUARTER_HOUR:
+            return
+        coverage = IntervalSet(self.import_state.get(self.id, "coverage"))
+        for start, end in measured:
+            coverage.add_datetimes(start, end)
+        self.import_state.set(self.id, "coverage", coverage.to_list() or None)
+
+    async def _fill_gaps(self):
+        """
+        Fetches the days with quarter hours that were imported without a measured value (missing or
+        out of order) again, merged into windows of consecutive days, and replaces the affected hours.
+        Quarter hours still missing afterwards are recorded as unfillable and not fetched again.
+        """
+        if self.import_state is None or self.granularity != ValueType.QUARTER_HOUR:
+            return
+        coverage = IntervalSet(self.import_state.get(self.id, "coverage"))
+        now = dt_util.utcnow()
+        checked = dt_util.parse_datetime(self.import_state.get(self.id, "gaps_checked") or "")
+        if not coverage or (checked is not None and now - checked < GAP_RECHECK_INTERVAL):
+            return
+        self.import_state.set(self.id, "gaps_checked", now.isoformat())
+
+        first, last = coverage.bounds()
+        unfillable = IntervalSet(self.import_state.get(self.id, "unfillable"))
+        gaps = IntervalSet(coverage.to_list() + unfillable.to_list()).gaps(
+            int(max(first, now - GAP_MAX_AGE).timestamp()), int(last.timestamp()))
+        gap_hours = set()
+        for gap_start, gap_end in gaps:
+            hour = gap_start - gap_start % 3600
+            while hour < gap_end:
+                gap_hours.add(dt_util.utc_from_timestamp(hour))
+                hour += 3600
+        if not gap_hours:
+            return
+        _LOGGER.debug("Found %d hours of %s with missing quarter hours", len(gap_hours), self.id)
+
+        for start, end in await self._refetch_hours(gap_hours):
+            coverage.add_datetimes(start, end)
+        self.import_state.set(self.id, "coverage", coverage.to_list())
+
+        for gap_start, gap_end in gaps:
+            for missing_start, missing_end in coverage.gaps(gap_start, gap_end):
+                unfillable.add(missing_start, missing_end)
+        cutoff = int((now - GAP_MAX_AGE).timestamp())
+        unfillable = [[start, end] for start, end in unfillable.to_list() if end > cutoff]
+        _LOGGER.debug("%d intervals of %s are still missing quarter hours", len(unfillable), self.id)
+        self.import_state.set(self.id, "unfillable", unfillable or None)
+
+    async def _refetch_hours(self, hours: set[datetime], cached: bool = True) -> list[tuple[datetime, datetime]]:
+        """
+        Fetches the bewegungsdaten of the days of the given hours again (merged into windows of consecutive days)
+        and replaces the hours whose usage changed. Returns the runs of measured quarter hours fetched.
+        With cached False the days are requested from the API even if they are in the response cache.
+        """
+        measured = []
+        for window_start, last_day in _day_windows(hours):
+            bewegungsdaten = await self.async_smartmeter.get_bewegungsdaten(
+                self.zaehlpunkt, window_start, last_day, self.granularity, cached)
+            hourly = aggregate_hourly(bewegungsdaten.get('values') or [], _scale(bewegungsdaten))
+            usage = {hour: hourly_usage for hour, hourly_usage in zip(hourly.hours, hourly.usage) if hour in hours}
+            if usage:
+                window_end = datetime.combine(last_day + timedelta(days=1), datetime.min.time(), timezone.utc)
+                known = await self._async_get_hourly_statistics(window_start, window_end, usage.keys())
+                await self._replace_hours(known, {hour: usage[hour] for hour in known})
+            measured.extend(hourly.measured)
+        return measured
+
+    async def _reconcile(self):
+        """
+        Compares the daily consumption of the meter readings (METER_READ) with the daily change
+        of the imported statistics. Only the days that differ are fetched again (in quarter hours)
+        and replaced. A day that still differs afterwards is not fetched again, unless its readings change.
+        """
+        if self.import_state is None:
+            return
+        now = dt_util.utcnow()
+        checked = dt_util.parse_datetime(self.import_state.get(self.id, "reconciled") or "")
+        if checked is not None and now - checked < RECONCILE_INTERVAL:
+            return
+        self.import_state.set(self.id, "reconciled", now.isoformat())
+
+        today = dt_util.as_local(now).date()
+        start = dt_util.start_of_local_day(today - RECONCILE_MAX_AGE)
+        end = dt_util.start_of_local_day(today)
+        readings = await self.async_smartmeter.get_historic_data(self.zaehlpunkt, start.date(), today, ValueType.METER_READ)
+        expected = _daily_consumption(readings)
+        imported = await self._async_get_daily_changes(start, end)
+
+        unreconcilable = self.import_state.get(self.id, "unreconcilable") or {}
+        differing = {}
+        for day, consumption in expected.items():
+            # days not imported (yet) are left to the import and the gap detection
+            if day in imported and abs(imported[day] - consumption) > RECONCILE_TOLERANCE:
+                if unreconcilable.get(day.isoformat()) != consumption:
+                    differing[day] = consumption
+        if not differing:
+            return
+        _LOGGER.info("Daily consumption of %d days of %s differs from the meter readings, fetching them again: %s",
+                     len(differing), self.id, sorted(differing))
+        hours = set()
+        for day in differing:
+            hour, day_end = dt_util.start_of_local_day(day), dt_util.start_of_local_day(day + timedelta(days=1))
+            while hour < day_end:
+                hours.add(dt_util.as_utc(hour))
+                hour += timedelta(hours=1)
+        # the cached days are the ones that may be stale, hence they are requested again
+        await self._refetch_hours(hours, cached=False)
+
+        imported = await self._async_get_daily_changes(start, end)
+        for day, consumption in differing.items():
+            if abs(imported.get(day, 0) - consumption) > RECONCILE_TOLERANCE:
+                unreconcilable[day.isoformat()] = consumption
+            else:
+                unreconcilable.pop(day.isoformat(), None)
+        _LOGGER.debug("%d days of %s still differ from the meter readings", len(unreconcilable), self.id)
+        cutoff = (today - RECONCILE_MAX_AGE).isoformat()
+        self.import_state.set(self.id, "unreconcilable", {day: consumption for day, consumption in unreconcilable.items() if day >= cutoff})
+
+    async def _async_get_daily_changes(self, start: datetime, end: datetime) -> dict[date, int]:
+        """Returns the change (milli-Wh) of the imported statistics per local day between start and end"""
+        rows = await get_instance(self.hass).async_add_executor_job(
+            statistics_during_period, self.hass, start, end, {self.id}, "day", None, {"change"})
+        changes = {}
+        for row in rows.get(self.id, []):
+            row_start = row["start"]
+            if isinstance(row_start, (int, float)):
+                row_start = dt_util.utc_from_timestamp(row_start)
+            changes[dt_util.as_local(row_start).date()] = to_milli_wh(row.get("change") or 0)
+        return changes
+
+    async def _async_get_hourly_statistics(self, start: datetime, end: datetime, hours: Iterable[datetime]):
+        """
+        Returns the current (usage, sum) in milli-Wh of the given hours between start and end.
+        Hours without a statistic have no usage and the sum of the statistic before, hours before
+        the first statistic are left out.
+        """
+        imported = await self._async_get_hourly_rows(start - timedelta(hours=1), end)
+        known, previous_sum = {}, None
+        for hour in sorted(set(imported) | set(hours)):
+            if hour in imported:
+                previous_sum = imported[hour][1]
+                known[hour] = imported[hour]
+            elif previous_sum is not None:
+                known[hour] = (0, previous_sum)
+        return {hour: known[hour] for hour in hours if hour in known}
+
+    async def _async_get_hourly_rows(self, start: datetime, end: datetime) -> dict[datetime, tuple[int, int]]:
+        """Returns the (usage, sum) in milli-Wh of the hourly statistics between start and end"""
+        rows = await get_instance(self.hass).async_add_executor_job(
+            statistics_during_period, self.hass, start, end, {self.id}, "hour", None, {"state", "sum"})
+        imported = {}
+        for row in rows.get(self.id, []):
+            row_start = row["start"]
+            if isinstance(row_start, (int, float)):
+                row_start = dt_util.utc_from_timestamp(row_start)
+            imported[row_start] = (to_milli_wh(row.get("state") or 0), to_milli_wh(row.get("sum") or 0))
+        return imported
+
+    async def async_meter_reading(self) -> float | None:
+        """
+        Returns the meter reading (kWh) derived from an anchor, a METER_READ value and the sum of the
+        statistics at its time, plus the consumption imported since. Hence the meter readings are only
+        requested once a day (or if the imported statistics changed before the anchor).
+        """
+        now = dt_util.utcnow()
+        anchor = self.import_state.get(self.id, "anchor") if self.import_state is not None else None
+        if anchor and now - dt_util.parse_datetime(anchor["anchored"]) < ANCHOR_MAX_AGE:
+            reading = self._derive_meter_reading(anchor)
+            if reading is not None:
+                return from_milli_wh(reading)
+
+        readings = await self.async_smartmeter.get_historic_data(
+            self.zaehlpunkt, dt_util.as_local(now).date() - timedelta(days=2), dt_util.as_local(now).date(),
+            ValueType.METER_READ)
+        scale = _scale(readings)
+        latest = None
+        for value in readings.get('values') or []:
+            taken = dt_util.parse_datetime(value.get('zeitBis') or value.get('zeitVon') or "")
+            if taken is not None and value.get('messwert') is not None and (latest is None or taken > latest[0]):
+                latest = (taken, round(value['messwert'] * scale))
+        if latest is None:
+            return None
+        taken, reading = latest
+        if self.import_state is None:
+            return from_milli_wh(reading)
+
+        # the sum of the statistics at the time of the reading (the end of the hour before)
+        rows = await get_instance(self.hass).async_add_executor_job(
+            statistics_during_period, self.hass, taken - timedelta(hours=1), taken, {self.id}, "hour", None, {"sum"})
+        if not rows.get(self.id):
+            # not imported until the reading, yet
+            return from_milli_wh(reading)
+        if anchor:
+            derived = self._derive_meter_reading(anchor, to_milli_wh(rows[self.id][-1]["sum"]))
+            if derived is not None and abs(derived - reading) > RECONCILE_TOLERANCE:
+                _LOGGER.warning("Meter reading of %s derived from the statistics drifted by %s kWh, re-anchoring",
+                                self.zaehlpunkt, from_milli_wh(reading - derived))
+        anchor = {"at": taken.isoformat(), "reading_mwh": reading, "sum_mwh": to_milli_wh(rows[self.id][-1]["sum"]),
+                  "anchored": now.isoformat()}
+        self.import_state.set(self.id, "anchor", anchor)
+        derived = self._derive_meter_reading(anchor)
+        return from_milli_wh(derived if derived is not None else reading)
+
+    def _derive_meter_reading(self, anchor: dict, sum_mwh: int = None) -> int | None:
+        """The reading (milli-Wh) at the sum (by default the sum of the last imported statistic)"""
+        if sum_mwh is None:
+            last = self.import_state.get(self.id, "last")
+            if not last:
+                return None
+            sum_mwh = int(last["sum_mwh"])
+        consumption = sum_mwh - int(anchor["sum_mwh"])
+        if consumption < 0:
+            # the statistics changed, the anchor is not valid anymore
+            return None
+        return int(anchor["reading_mwh"]) + consumption
 
     def get_statistics_metadata(self):
         return StatisticMetaData(
@@ -135,13 +641,22 @@ class Importer:
         )
 
     async def _initial_import_statistics(self):
-        return await self._import_statistics()
+        start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=365 * 3)
+        end = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        # Skip the (possibly years of) empty data before the meter was installed
+        first = await self.async_smartmeter.find_first_data(self.zaehlpunkt, start, end)
+        if first is None:
+            _LOGGER.debug(f"No data of {self.zaehlpunkt} found since {start}. Seems there is nothing to import, yet.")
+            return None
+        start = max(start, first.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0))
+        _LOGGER.debug(f"First data of {self.zaehlpunkt} found at {first}, importing from {start}")
+        return await self._import_statistics(start=start, end=end)
 
-    async def _incremental_import_statistics(self, start: datetime, total_usage: Decimal):
+    async def _incremental_import_statistics(self, start: datetime, total_usage: int):
         return await self._import_statistics(start=start, total_usage=total_usage)
 
-    async def _import_statistics(self, start: datetime = None, end: datetime = None, total_usage: Decimal = Decimal(0)):
-        """Import statistics"""
+    async def _import_statistics(self, start: datetime = None, end: datetime = None, total_usage: int = 0):
+        """Import statistics, total_usage is the sum (in milli-Wh) the imported statistics continue from"""
 
         start = start if start is not None else datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=365 * 3)
         end = end if end is not None else datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
@@ -154,53 +669,101 @@ class Importer:
             _LOGGER.warning(f"Ignoring async update since last import happened in the future (should not happen) {start} > {end}")
             return
 
-        bewegungsdaten = await self.async_smartmeter.get_bewegungsdaten(self.zaehlpunkt, start, end, self.granularity)
-        _LOGGER.debug(f"Mapped historical data: {bewegungsdaten}")
-        
-        # Handle missing unitOfMeasurement key
-        unit_of_measurement = bewegungsdaten.get('unitOfMeasurement', 'KWH')  # Default to KWH if not present
-        if unit_of_measurement == 'WH':
-            factor = 1e-3
-        elif unit_of_measurement == 'KWH':
-            factor = 1.0
-        else:
-            _LOGGER.warning(f'Unknown unit "{unit_of_measurement}", defaulting to KWH factor')
-            factor = 1.0
-
-        dates = defaultdict(Decimal)
-        if 'values' not in bewegungsdaten:
-            raise ValueError("WienerNetze does not report historical data (yet)")
-        total_consumption = sum([v.get("wert", 0) for v in bewegungsdaten['values']])
-        # Can actually check, if the whole batch can be skipped.
-        if total_consumption == 0:
+        writer = StatisticsWriter(self.hass, self.get_statistics_metadata(),
+                                  expected=int((end + timedelta(days=1) - start).total_seconds() // 3600))
+        # fetched in windows of about a month (concurrently) instead of a single huge response,
+        # every imported window is checkpointed
+        async for window_start, last_day, bewegungsdaten, batches in self.async_smartmeter.iter_bewegungsdaten_windows(
+                self.zaehlpunkt, start, end, self.granularity):
+            total_usage = await self._import_window(writer, window_start, bewegungsdaten, batches, total_usage)
+            # committed before the window is checkpointed
+            await writer.flush()
+            next_start = datetime.combine(last_day + timedelta(days=1), datetime.min.time(), start.tzinfo)
+            last_end = writer.last["start"] + timedelta(hours=1) if writer.last is not None else None
+            if next_start <= end:
+                await self._save_checkpoint(last_day, next_start, end, total_usage, last_end)
+        if writer.last is not None:
+            # the importer knows the last statistic, hence the next import does not have to query the recorder
+            self._remember_last_statistic(writer.last["start"] + timedelta(hours=1), total_usage)
+        self._clear_checkpoint()
+        return total_usage
+
+    async def _import_window(self, writer: StatisticsWriter, start: datetime, bewegungsdaten: dict,
+                             batches: AsyncIterator[list[dict]], total_usage: int) -> int:
+        """
+        Imports the hourly sums of a window of bewegungsdaten (without values) whose values arrive in batches,
+        returns the new total (milli-Wh)
+        """
+        # parse -> validate -> hourly buckets -> batches of statistics, a batch at a time
+        accumulator = HourlyAccumulator(_scale(bewegungsdaten), start, total_usage)
+        hours = 0
+        async for rows in _hourly_stream(accumulator, batches):
+            hours += len(rows)
+            for statistics in _statistics(self._track_estimated_hours(accumulator, [rows])):
+                await writer.write(statistics)
+        if not hours:
             _LOGGER.debug(f"Batch of data starting at {start} does not contain any bewegungsdaten. Seems there is nothing to import, yet.")
-            return
+        if accumulator.skipped:
+            # This should prevent any issues with ambiguous values though...
+            _LOGGER.warning(f"Ignored {accumulator.skipped} values with a timestamp less than a previously collected one")
+        if accumulator.estimated:
+            _LOGGER.debug(f"Not seen that before: {accumulator.estimated} estimated values found starting at {start}")
+        self._record_coverage(accumulator.measured)
+        return accumulator.total
 
-        last_ts = start
-        for value in bewegungsdaten['values']:
-            ts = dt_util.parse_datetime(value['zeitpunktVon'])
-            if ts < last_ts:
-                # This should prevent any issues with ambiguous values though...
-                _LOGGER.warning(f"Timestamp from API ({ts}) is less than previously collected timestamp ({last_ts}), ignoring value!")
-                continue
-            last_ts = ts
-            if value['wert'] is None:
-                # Usually this means that the measurement is not yet in the WSTW database.
-                continue
-            reading = Decimal(value['wert'] * factor)
-            if ts.minute % 15 != 0 or ts.second != 0 or ts.microsecond != 0:
-                _LOGGER.warning(f"Unexpected time detected in historic data: {value}")
-            dates[ts.replace(minute=0)] += reading
-            if value['geschaetzt']:
-                _LOGGER.debug(f"Not seen that before: Estimated Value found for {ts}: {reading}")
-
-        statistics = []
-        metadata = self.get_statistics_metadata()
-
-        for ts, usage in sorted(dates.items(), key=itemgetter(0)):
-            total_usage += usage
-            statistics.append(StatisticData(start=ts, sum=total_usage, state=float(usage)))
-        if len(statistics) > 0:
-            _LOGGER.debug(f"Importing statistics from {statistics[0]} to {statistics[-1]}")
-        async_add_external_statistics(self.hass, metadata, statistics)
-        return total_usage
+
+def _scale(bewegungsdaten: dict) -> int:
+    """The factor converting the values of bewegungsdaten to milli-Wh"""
+    # Handle missing unitOfMeasurement key
+    unit_of_measurement = bewegungsdaten.get('unitOfMeasurement', 'KWH')  # Default to KWH if not present
+    if unit_of_measurement == 'WH':
+        return MILLI_WH_PER_WH
+    if unit_of_measurement != 'KWH':
+        _LOGGER.warning(f'Unknown unit "{unit_of_measurement}", defaulting to KWH factor')
+    return MILLI_WH_PER_KWH
+
+
+def _daily_consumption(readings: dict) -> dict[date, int]:
+    """
+    The consumption (milli-Wh) of each (local) day from the deltas of consecutive daily meter readings,
+    a reading is taken at its 'zeitBis' (the end of its day)
+    """
+    scale = _scale(readings)
+    points = []
+    for value in readings.get('values') or []:
+        taken = dt_util.parse_datetime(value.get('zeitBis') or value.get('zeitVon') or "")
+        if taken is not None and value.get('messwert') is not None:
+            points.append((taken, round(value['messwert'] * scale)))
+    points.sort()
+    return {
+        dt_util.as_local(previous_taken).date(): reading - previous_reading
+        for (previous_taken, previous_reading), (taken, reading) in zip(points, points[1:])
+        if dt_util.as_local(taken).date() - dt_util.as_local(previous_taken).date() == timedelta(days=1)
+    }
+
+
+def _day_windows(hours: Iterable[datetime]) -> Iterator[tuple[datetime, date]]:
+    """Merges the (UTC) days of the given hours into windows of consecutive days: (start, last day)"""
+    days = sorted({hour.date() for hour in hours})
+    first = None
+    for day, following in zip(days, days[1:] + [None]):
+        first = first or day
+        if following != day + timedelta(days=1):
+            yield datetime.combine(first, datetime.min.time(), timezone.utc), day
+            first = None
+
+
+async def _hourly_stream(accumulator: HourlyAccumulator,
+                         batches: AsyncIterator[list[dict]]) -> AsyncIterator[list[tuple[datetime, int, int]]]:
+    """Hourly (start, usage, sum) in milli-Wh of each batch of values, the last hour is completed by the end"""
+    async for values in batches:
+        if rows := accumulator.feed(values):
+            yield rows
+    if rows := accumulator.flush():
+        yield rows
+
+
+def _statistics(hourly: Iterable[list[tuple[datetime, int, int]]]) -> Iterator[list[StatisticData]]:
+    # milli-Wh are converted to kWh only here
+    for rows in hourly:
+        yield [StatisticData(start=ts, sum=from_milli_wh(_sum), state=from_milli_wh(usage)) for ts, usage, _sum in rows]
@@ -0,0 +1,215 @@
+"""
+Runs the statistics imports in the background, independent of the refresh of the sensors
+"""
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from statistics import median
+
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.event import async_track_point_in_utc_time
+from homeassistant.util import dt as dt_util
+
+from .AsyncSmartmeter import AsyncSmartmeter
+from .api.constants import ValueType
+from .importer import Importer
+from .storage import ImportStateStore
+
+_LOGGER = logging.getLogger(__name__)
+
+# Imports running at the same time (of all meters of an account)
+IMPORT_CONCURRENCY = 2
+# A failed import is retried with an exponential back-off
+BACKOFF_MIN = timedelta(minutes=15)
+BACKOFF_MAX = timedelta(hours=6)
+# While a meter's next day is overdue, it is polled again after as long as it is overdue (within these bounds)
+OVERDUE_POLL_MIN = timedelta(minutes=15)
+OVERDUE_POLL_MAX = timedelta(hours=6)
+# Assumed time (after midnight) a day is published at, until it has been observed
+DEFAULT_PUBLICATION_OFFSET = timedelta(hours=6)
+# Number of observed publications the expected time of the next one is learned from
+PUBLICATION_SAMPLES = 14
+
+
+class PublicationSchedule:
+    """
+    Learns when the data of a day is published (as offset from the midnight after the day)
+    from the times the days were first seen complete.
+    """
+
+    def __init__(self, offsets: list[float] | None = None) -> None:
+        self.offsets: list[float] = list(offsets or [])[-PUBLICATION_SAMPLES:]
+
+    def observe(self, day: date, now: datetime) -> None:
+        """The data of day was found (complete) for the first time at now"""
+        offset = (now - dt_util.start_of_local_day(day + timedelta(days=1))).total_seconds()
+        if offset >= 0:
+            self.offsets = (self.offsets + [offset])[-PUBLICATION_SAMPLES:]
+
+    def expected(self, day: date) -> datetime:
+        """When the data of day is expected to be published"""
+        offset = timedelta(seconds=median(self.offsets)) if self.offsets else DEFAULT_PUBLICATION_OFFSET
+        return dt_util.start_of_local_day(day + timedelta(days=1)) + offset
+
+
+class ImportScheduler:
+    """
+    Queue of the meters whose statistics have to be imported, worked off by a bounded number
+    of background tasks. Scheduling a meter never waits for its import, so a long backfill
+    does not hold up the refresh of the sensors (or the setup of the integration).
+    A meter is only imported again once its next day is expected to be published (learned from the
+    previous publications) and polled while the day is overdue, a failed import is retried with an
+    exponential back-off. The scheduler wakes up on its own when the next meter is due, independent
+    of the refresh of the sensors.
+    """
+
+    def __init__(self, hass: HomeAssistant, entry: ConfigEntry, async_smartmeter: AsyncSmartmeter,
+                 import_state: ImportStateStore, concurrency: int = IMPORT_CONCURRENCY) -> None:
+        self.hass = hass
+        self.entry = entry
+        self.async_smartmeter = async_smartmeter
+        self.import_state = import_state
+        self.concurrency = concurrency
+        self._queue: asyncio.Queue[str] = asyncio.Queue()
+        # the latest arguments of the meters queued or running, by zaehlpunkt
+        self._jobs: dict[str, tuple[dict, str, ValueType]] = {}
+        # the latest arguments of every meter scheduled, to queue it again when it is due
+        self._args: dict[str, tuple[dict, str, ValueType]] = {}
+        self._next_run: dict[str, datetime] = {}
+        self._failures: dict[str, int] = {}
+        # start of the last import of each meter that did not find its next day yet
+        self._missed: dict[str, datetime] = {}
+        self._workers: list[asyncio.Task] = []
+        self._cancel_wakeup = None
+
+    @callback
+    def async_schedule(self, zaehlpunkt: str, details: dict, unit_of_measurement: str, granularity: ValueType) -> bool:
+        """Queues the import of a meter, unless it is queued (or running) already or nothing new is expected"""
+        self._args[zaehlpunkt] = (details, unit_of_measurement, granularity)
+        if zaehlpunkt in self._jobs:
+            self._jobs[zaehlpunkt] = (details, unit_of_measurement, granularity)
+            return False
+        next_run = self._next_run.get(zaehlpunkt)
+        if next_run is not None and dt_util.utcnow() < next_run:
+            return False
+        self._enqueue(zaehlpunkt)
+        return True
+
+    @callback
+    def _enqueue(self, zaehlpunkt: str) -> None:
+        self._jobs[zaehlpunkt] = self._args[zaehlpunkt]
+        self._queue.put_nowait(zaehlpunkt)
+        self._start_workers()
+
+    @callback
+    def _start_workers(self) -> None:
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        while len(self._workers) < min(self.concurrency, self._queue.qsize() + len(self._workers)):
+            self._workers.append(self.entry.async_create_background_task(
+                self.hass, self._work(), f"{self.entry.domain} statistics import"))
+
+    async def _work(self) -> None:
+        while not self._queue.empty():
+            zaehlpunkt = self._queue.get_nowait()
+            details, unit_of_measurement, granularity = self._jobs[zaehlpunkt]
+            importer = Importer(self.hass, self.async_smartmeter, zaehlpunkt, unit_of_measurement,
+                                granularity, self.import_state)
+            failed, before, started = True, None, dt_util.utcnow()
+            try:
+                await self.import_state.async_load()
+                before = self.import_state.get(importer.id, "last")
+                await importer.async_import(details)
+                failed = False
+            except (TimeoutError, RuntimeError):
+                # logged by the importer, the next scheduling retries (after the back-off)
+                pass
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Error importing statistics of %s", zaehlpunkt)
+            finally:
+                del self._jobs[zaehlpunkt]
+            self._plan(zaehlpunkt, importer.id, before, started, failed)
+            self._schedule_wakeup()
+
+    @callback
+    def _plan(self, zaehlpunkt: str, statistic_id: str, before: dict | None, started: datetime, failed: bool) -> None:
+        """
+        Chooses when to import the meter next, before is its last statistic before the import started.
+        Only a failed import grows the back-off, an import that did not find the next day (yet) polls again.
+        """
+        now = dt_util.utcnow()
+        if failed:
+            failures = self._failures.get(zaehlpunkt, 0)
+            self._failures[zaehlpunkt] = failures + 1
+            self._next_run[zaehlpunkt] = now + min(BACKOFF_MIN * 2 ** failures, BACKOFF_MAX)
+            _LOGGER.debug("Import of %s failed, retried at %s", zaehlpunkt, self._next_run[zaehlpunkt])
+            return
+        self._failures.pop(zaehlpunkt, None)
+
+        last = self.import_state.get(statistic_id, "last")
+        if not last:
+            # nothing published yet
+            self._next_run[zaehlpunkt] = now + OVERDUE_POLL_MAX
+            _LOGGER.debug("Next import of %s at %s", zaehlpunkt, self._next_run[zaehlpunkt])
+            return
+        end = dt_util.as_local(dt_util.parse_datetime(last["end"]))
+        # the day (or the rest of it) the next import waits for
+        waiting_for = end.date()
+        schedule = PublicationSchedule(self.import_state.get(statistic_id, "publication"))
+        if before is None or before.get("end") == last["end"]:
+            self._missed[zaehlpunkt] = started
+        else:
+            missed = self._missed.pop(zaehlpunkt, None)
+            published = waiting_for - timedelta(days=1)
+            if end == dt_util.start_of_local_day(end) \
+                    and dt_util.parse_datetime(before["end"]) == dt_util.start_of_local_day(published):
+                # exactly the day waited for was published since the previous import
+                schedule.observe(published, _first_seen(published, missed, started))
+                self.import_state.set(statistic_id, "publication", schedule.offsets)
+
+        expected = schedule.expected(waiting_for)
+        if expected > now:
+            self._next_run[zaehlpunkt] = expected
+        else:
+            self._next_run[zaehlpunkt] = now + min(max(now - expected, OVERDUE_POLL_MIN), OVERDUE_POLL_MAX)
+        _LOGGER.debug("Next import of %s at %s", zaehlpunkt, self._next_run[zaehlpunkt])
+
+    @callback
+    def _schedule_wakeup(self) -> None:
+        """Wakes up when the next meter (not queued or running) is due"""
+        if self._cancel_wakeup is not None:
+            self._cancel_wakeup()
+            self._cancel_wakeup = None
+        planned = [next_run for zaehlpunkt, next_run in self._next_run.items()
+                   if zaehlpunkt not in self._jobs and zaehlpunkt in self._args]
+        if planned:
+            self._cancel_wakeup = async_track_point_in_utc_time(self.hass, self._handle_wakeup, min(planned))
+
+    @callback
+    def _handle_wakeup(self, now: datetime) -> None:
+        self._cancel_wakeup = None
+        for zaehlpunkt, next_run in list(self._next_run.items()):
+            if next_run <= now and zaehlpunkt in self._args and zaehlpunkt not in self._jobs:
+                self._enqueue(zaehlpunkt)
+        self._schedule_wakeup()
+
+    @callback
+    def async_stop(self) -> None:
+        """Cancels the running imports (they resume from their checkpoint) and the next wake-up"""
+        if self._cancel_wakeup is not None:
+            self._cancel_wakeup()
+            self._cancel_wakeup = None
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+
+def _first_seen(day: date, missed: datetime | None, found: datetime) -> datetime:
+    """
+    When the data of day was published, given the start of the import that found it and of the previous
+    one that did not (if known): the middle between them, so that sparse polling does not bias it late
+    """
+    if missed is None:
+        return found
+    published_from = max(missed, dt_util.start_of_local_day(day + timedelta(days=1)))
+    return published_from + (found - published_from) / 2
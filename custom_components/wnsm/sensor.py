@@ -148,7 +148,8 @@ class WNSMCoordinatedSensor(CoordinatorEntity, SensorEntity):
 
     def __init__(self, coordinator: WienerNetzeCoordinator, zaehlpunkt: str) -> None:
         """Initialize the sensor."""
-        super().__init__(coordinator)
+        # only notified if the data of its zaehlpunkt changed
+        super().__init__(coordinator, context=zaehlpunkt)
         self.zaehlpunkt = zaehlpunkt
         self._name = zaehlpunkt
         
@@ -189,6 +190,9 @@ class WNSMCoordinatedSensor(CoordinatorEntity, SensorEntity):
         if not self.available:
             return {}
         data = self.coordinator.data[self.zaehlpunkt]
-        attributes = data.get("details") or {}
+        # a copy, the coordinator's data is compared with the next refresh
+        attributes = dict(data.get("details") or {})
         attributes["last_update"] = data.get("timestamp")
+        # the sensor is only updated if its data changed, last_update is the time of that refresh
+        attributes["last_changed"] = data.get("changed", data.get("timestamp"))
         return attributes
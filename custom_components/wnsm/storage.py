@@ -0,0 +1,55 @@
+"""
+Persistent state of the statistics imports (per statistic id) in the HA storage (.storage)
+"""
+import logging
+from typing import Any
+
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.storage import Store
+
+from .const import STORAGE_VERSION, STORAGE_KEY_IMPORT
+
+_LOGGER = logging.getLogger(__name__)
+
+# Changes are written after this many seconds (unless saved explicitly)
+SAVE_DELAY = 10
+
+
+class ImportStateStore:
+    """
+    Keeps the import state of every statistic id (e.g. the checkpoint of a running backfill)
+    as {statistic_id: {key: value}}, values have to be JSON serializable.
+    """
+
+    def __init__(self, hass: HomeAssistant, entry_id: str) -> None:
+        self._store = Store(hass, STORAGE_VERSION, f"{STORAGE_KEY_IMPORT}.{entry_id}")
+        self._data: dict[str, dict[str, Any]] = {}
+        self._loaded = False
+        # statistic ids whose remembered last statistic was checked against the recorder since the start
+        self.verified: set[str] = set()
+
+    async def async_load(self) -> None:
+        """Load the stored state once, has to be awaited before the state is used."""
+        if not self._loaded:
+            self._data = await self._store.async_load() or {}
+            self._loaded = True
+
+    def get(self, statistic_id: str, key: str, default: Any = None) -> Any:
+        return self._data.get(statistic_id, {}).get(key, default)
+
+    def set(self, statistic_id: str, key: str, value: Any) -> None:
+        """Sets (or removes, if value is None) an entry and schedules saving the store."""
+        if value is None:
+            self._data.get(statistic_id, {}).pop(key, None)
+        else:
+            self._data.setdefault(statistic_id, {})[key] = value
+        self._store.async_delay_save(lambda: self._data, SAVE_DELAY)
+
+    def remove(self, statistic_id: str) -> None:
+        """Drops the whole state of a statistic id."""
+        if self._data.pop(statistic_id, None) is not None:
+            self._store.async_delay_save(lambda: self._data, SAVE_DELAY)
+
+    async def async_save(self) -> None:
+        """Writes the state immediately (e.g. after a checkpoint)."""
+        await self._store.async_save(self._data)
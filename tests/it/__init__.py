@@ -332,7 +332,7 @@ def bewegungsdaten(count=24, timestamp=None, interval='h'):
 
 def bewegungsdaten_response(customer_id: str, zp: str,
                             granularity: ValueType = ValueType.QUARTER_HOUR, anlagetype: AnlagenType = AnlagenType.CONSUMING,
-                            wrong_zp: bool = False, values_count: int = 10):
+                            wrong_zp: bool = False, values_count: int = 10, values: list = None):
     if granularity == ValueType.QUARTER_HOUR:
         gran = "QH"
         if anlagetype == AnlagenType.CONSUMING:
@@ -348,7 +348,8 @@ def bewegungsdaten_response(customer_id: str, zp: str,
     if wrong_zp:
         zp = zp + "9"
 
-    values = [] if values_count == 0 else bewegungsdaten(count=values_count, timestamp=datetime(2022,8,7,0,0,0), interval=gran)
+    if values is None:
+        values = [] if values_count == 0 else bewegungsdaten(count=values_count, timestamp=datetime(2022,8,7,0,0,0), interval=gran)
 
     return {
         "descriptor": {
@@ -363,8 +364,11 @@ def bewegungsdaten_response(customer_id: str, zp: str,
     }
 
 
-def smartmeter(username=USERNAME, password=PASSWORD, code_verifier=CODE_VERIFIER):
-    return api.client.Smartmeter(username=username, password=password, input_code_verifier=code_verifier)
+def smartmeter(username=USERNAME, password=PASSWORD, code_verifier=CODE_VERIFIER, token_store=None,
+               response_cache=None):
+    # without a token store, nothing is persisted (instead of the default store in the user's cache directory)
+    return api.client.Smartmeter(username=username, password=password, input_code_verifier=code_verifier,
+                                 token_store=token_store or api.TokenStore(), response_cache=response_cache)
 
 
 @pytest.mark.usefixtures("requests_mock")
@@ -453,6 +457,32 @@ def mock_token(requests_mock: Mocker, code=RESPONSE_CODE, access_token=ACCESS_TO
         }), json={}, status_code=status)
 
 
+@pytest.mark.usefixtures("requests_mock")
+def mock_refresh_token(requests_mock: Mocker, refresh_token=REFRESH_TOKEN, access_token=ACCESS_TOKEN,
+                       status: int | None = 200, expires: int = 300):
+    response = {
+        "access_token": access_token,
+        "expires_in": expires,
+        "refresh_expires_in": 6 * expires,
+        "refresh_token": refresh_token,
+        "token_type": "Bearer",
+        "id_token": ID_TOKEN,
+        "not-before-policy": 0,
+        "session_state": "949e0f0d-b447-4208-bfef-273d694dc633",
+        "scope": "openid email profile"
+    }
+    matcher = post_data_matcher({
+        "grant_type": "refresh_token",
+        "client_id": "wn-smartmeter",
+        "refresh_token": refresh_token,
+    })
+    if status is None:
+        requests_mock.post(f'{AUTH_URL}/token', additional_matcher=matcher, exc=requests.exceptions.ConnectTimeout)
+    else:
+        requests_mock.post(f'{AUTH_URL}/token', additional_matcher=matcher,
+                           json=response if status == 200 else {}, status_code=status)
+
+
 @pytest.mark.usefixtures("requests_mock")
 def mock_authenticate(requests_mock: Mocker, username, password, code=RESPONSE_CODE, status: int | None = 302):
     """
@@ -574,7 +604,7 @@ def expect_history(
 @pytest.mark.usefixtures("requests_mock")
 def expect_bewegungsdaten(requests_mock: Mocker, customer_id: str, zp: str, dateFrom: dt.datetime, dateTo: dt.datetime,
                           granularity:ValueType = ValueType.QUARTER_HOUR, anlagetype: AnlagenType = AnlagenType.CONSUMING,
-                          wrong_zp: bool = False, values_count=10):
+                          wrong_zp: bool = False, values_count=10, values: list = None):
     if anlagetype== AnlagenType.FEEDING:
         if granularity == ValueType.DAY: 
             rolle = RoleType.DAILY_FEEDING.value 
@@ -599,4 +629,4 @@ def expect_bewegungsdaten(requests_mock: Mocker, customer_id: str, zp: str, date
                           "Authorization": f"Bearer {ACCESS_TOKEN}",
                           "Accept": "application/json"
                       },
-                      json=bewegungsdaten_response(customer_id, zp, granularity, anlagetype, wrong_zp, values_count))
+                      json=bewegungsdaten_response(customer_id, zp, granularity, anlagetype, wrong_zp, values_count, values))
@@ -0,0 +1,91 @@
+import datetime as dt
+
+import pytest
+
+from it import bewegungsdaten
+from wnsm import aggregation
+from wnsm.aggregation import HourlyAccumulator, aggregate_hourly, from_milli_wh, to_milli_wh, MILLI_WH_PER_WH
+
+START = dt.datetime(2023, 4, 21, 0, 0, tzinfo=dt.timezone.utc)
+
+
+@pytest.fixture(params=["numpy", "python"])
+def engine(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(aggregation, "np", None)
+    return request.param
+
+
+def test_aggregate_hourly_sums_quarter_hours(engine):
+    values = bewegungsdaten(count=8, timestamp=START.replace(tzinfo=None), interval='qh')
+
+    hourly = aggregate_hourly(values, start=START, total=to_milli_wh(10.0))
+
+    assert [START, START + dt.timedelta(hours=1)] == hourly.hours
+    assert sum(to_milli_wh(v['wert']) for v in values[:4]) == hourly.usage[0]
+    assert to_milli_wh(10.0) + sum(to_milli_wh(v['wert']) for v in values) == hourly.sums[-1]
+    assert all(isinstance(usage, int) for usage in hourly.usage + hourly.sums)
+
+
+def test_aggregate_hourly_skips_missing_and_out_of_order_values(engine):
+    values = bewegungsdaten(count=8, timestamp=START.replace(tzinfo=None), interval='qh')
+    values[1]['wert'] = None
+    values.insert(6, dict(values[0]))  # older than its predecessor
+    values[7]['geschaetzt'] = True
+
+    hourly = aggregate_hourly(values, scale=MILLI_WH_PER_WH, start=START)
+
+    assert 1 == hourly.skipped
+    assert 1 == hourly.estimated
+    assert (START + dt.timedelta(hours=1),) == hourly.estimated_hours
+    assert ((START, START + dt.timedelta(minutes=15)), (START + dt.timedelta(minutes=30), START + dt.timedelta(hours=2))) \
+        == hourly.measured
+    assert (values[0]['wert'] + values[2]['wert'] + values[3]['wert']) * 1e-3 == pytest.approx(from_milli_wh(hourly.usage[0]))
+
+
+def test_aggregate_hourly_skips_values_before_start(engine):
+    values = bewegungsdaten(count=8, timestamp=START.replace(tzinfo=None), interval='qh')
+
+    hourly = aggregate_hourly(values, start=START + dt.timedelta(hours=1))
+
+    assert [START + dt.timedelta(hours=1)] == hourly.hours
+    assert 4 == hourly.skipped
+
+
+def test_aggregate_hourly_reports_misaligned_values(engine, caplog):
+    values = bewegungsdaten(count=4, timestamp=START.replace(tzinfo=None), interval='qh')
+    values[2]['zeitpunktVon'] = '2023-04-21T00:31:00Z'
+
+    hourly = aggregate_hourly(values, start=START)
+
+    assert 'Unexpected time detected in historic data' in caplog.text
+    assert sum(v['wert'] for v in values) == pytest.approx(from_milli_wh(hourly.usage[0]))
+
+
+def test_aggregate_hourly_empty(engine):
+    assert [] == aggregate_hourly([], start=START).hours
+
+
+def test_aggregate_hourly_sums_are_exact(engine):
+    values = [{'zeitpunktVon': f'2023-04-21T00:{15 * i:02d}:00Z', 'wert': 0.1, 'geschaetzt': False} for i in range(4)]
+
+    hourly = aggregate_hourly(values, start=START, total=to_milli_wh(0.2))
+
+    assert [400000] == hourly.usage
+    assert 0.6 == from_milli_wh(hourly.sums[0])
+
+
+def test_hourly_accumulator_matches_whole_array(engine):
+    values = bewegungsdaten(count=40, timestamp=START.replace(tzinfo=None), interval='qh')
+    values.insert(13, dict(values[2]))  # out of order, across batches
+    expected = aggregate_hourly(values, start=START, total=to_milli_wh(1.0))
+
+    accumulator = HourlyAccumulator(start=START, total=to_milli_wh(1.0))
+    rows = []
+    for offset in range(0, len(values), 7):  # batches ending within hours
+        rows += accumulator.feed(values[offset:offset + 7])
+    rows += accumulator.flush()
+
+    assert list(zip(expected.hours, expected.usage, expected.sums)) == rows
+    assert expected.skipped == accumulator.skipped
+    assert expected.sums[-1] == accumulator.total
@@ -0,0 +1,280 @@
+import datetime as dt
+import json
+from importlib.resources import files
+from urllib import parse
+
+import pytest
+from homeassistant.const import CONF_PASSWORD, CONF_USERNAME
+from homeassistant.helpers.aiohttp_client import async_create_clientsession
+from pytest_homeassistant_custom_component.common import MockConfigEntry
+from pytest_homeassistant_custom_component.test_util.aiohttp import AiohttpClientMocker, AiohttpClientMockResponse
+
+from it import (
+    ACCESS_TOKEN,
+    API_CONFIG_URL,
+    API_URL_ALT,
+    API_URL_B2B,
+    API_URL_B2C,
+    AUTH_URL,
+    CODE_VERIFIER,
+    PASSWORD,
+    REDIRECT_URI,
+    REFRESH_TOKEN,
+    RESPONSE_CODE,
+    USERNAME,
+    bewegungsdaten,
+    bewegungsdaten_response,
+    enabled,
+    history_response,
+    zaehlpunkt,
+    zaehlpunkt_response,
+)
+from wnsm.api import AioSmartmeter
+from wnsm.api.errors import SmartmeterLoginError, SmartmeterQueryError
+from wnsm.api.protocol import ReadChunk
+from wnsm.config_flow import WienerNetzeSmartMeterCustomConfigFlow
+from wnsm.const import DOMAIN
+from wnsm.coordinator import HassTokenStore, WienerNetzeCoordinator
+
+AUTHENTICATE_URL = "https://log.wien/auth/realms/logwien/login-actions/authenticate"
+
+
+def _tokens(expires: int = 300) -> dict:
+    return {
+        "access_token": ACCESS_TOKEN,
+        "expires_in": expires,
+        "refresh_expires_in": 6 * expires,
+        "refresh_token": REFRESH_TOKEN,
+        "token_type": "Bearer",
+    }
+
+
+def expect_login(aioclient_mock: AiohttpClientMocker, password: str = PASSWORD, refresh_status: int = 200):
+    """Mocks the credentials login, the token endpoint answers the refresh grant with refresh_status"""
+    aioclient_mock.get(AUTH_URL + "/auth", text=files('test_resources').joinpath('auth.html').read_text())
+
+    async def authenticate(method, url, data):
+        if "password" not in data:
+            return AiohttpClientMockResponse(method, url, text=files('test_resources').joinpath('auth.html').read_text())
+        if data["password"] != password:
+            return AiohttpClientMockResponse(method, url, status=403)
+        location = f"{REDIRECT_URI}/#state=cb142d1b&session_state=949e0f0d&code={RESPONSE_CODE}"
+        return AiohttpClientMockResponse(method, url, status=302, headers={"Location": location})
+
+    async def token(method, url, data):
+        if data["grant_type"] == "refresh_token":
+            assert REFRESH_TOKEN == data["refresh_token"]
+            return AiohttpClientMockResponse(method, url, status=refresh_status,
+                                             json=_tokens() if refresh_status == 200 else {})
+        assert RESPONSE_CODE == data["code"]
+        return AiohttpClientMockResponse(method, url, json=_tokens())
+
+    aioclient_mock.post(AUTHENTICATE_URL, side_effect=authenticate)
+    aioclient_mock.post(AUTH_URL + "/token", side_effect=token)
+    aioclient_mock.get(API_CONFIG_URL, text=files('test_resources').joinpath('app-config.json').read_text())
+
+
+def expect_zaehlpunkte(aioclient_mock: AiohttpClientMocker):
+    aioclient_mock.get(parse.urljoin(API_URL_B2C, 'zaehlpunkte'), json=zaehlpunkt_response([enabled(zaehlpunkt())]))
+
+
+def smartmeter(hass) -> AioSmartmeter:
+    return AioSmartmeter(USERNAME, PASSWORD, input_code_verifier=CODE_VERIFIER, session=async_create_clientsession(hass))
+
+
+def _calls(aioclient_mock: AiohttpClientMocker, url: str) -> list:
+    return [call for call in aioclient_mock.mock_calls if str(call[1]).startswith(url)]
+
+
+async def test_login(hass, aioclient_mock: AiohttpClientMocker):
+    expect_login(aioclient_mock)
+
+    sm = await smartmeter(hass).login()
+
+    assert sm.is_logged_in()
+    assert ACCESS_TOKEN == sm._access_token
+    assert sm._api_gateway_token is not None and sm._api_gateway_b2b_token is not None
+    assert f"Bearer {ACCESS_TOKEN}" == _calls(aioclient_mock, API_CONFIG_URL)[0][3]["Authorization"]
+
+
+async def test_login_with_wrong_password(hass, aioclient_mock: AiohttpClientMocker):
+    expect_login(aioclient_mock, password="WrongPassword")
+
+    with pytest.raises(SmartmeterLoginError):
+        await smartmeter(hass).login()
+
+
+async def test_login_refreshes_expired_access_token(hass, aioclient_mock: AiohttpClientMocker):
+    expect_login(aioclient_mock)
+    sm = await smartmeter(hass).login()
+    sm._access_token_expiration = dt.datetime.now() - dt.timedelta(seconds=1)
+    aioclient_mock.mock_calls.clear()
+
+    await sm.login()
+
+    assert sm.is_logged_in()
+    assert [("POST", "refresh_token")] == [(call[0], call[2]["grant_type"]) for call in aioclient_mock.mock_calls]
+
+
+async def test_renew_falls_back_to_credentials_if_refresh_fails(hass, aioclient_mock: AiohttpClientMocker):
+    expect_login(aioclient_mock, refresh_status=400)
+    sm = await smartmeter(hass).login()
+    aioclient_mock.mock_calls.clear()
+
+    await sm.renew()
+
+    assert sm.is_logged_in()
+    assert ["refresh_token", "authorization_code"] == [
+        call[2]["grant_type"] for call in _calls(aioclient_mock, AUTH_URL + "/token")]
+
+
+async def test_zaehlpunkte(hass, aioclient_mock: AiohttpClientMocker):
+    expect_login(aioclient_mock)
+    expect_zaehlpunkte(aioclient_mock)
+    sm = await smartmeter(hass).login()
+
+    contracts = await sm.zaehlpunkte()
+
+    assert zaehlpunkt()["zaehlpunktnummer"] == contracts[0]["zaehlpunkte"][0]["zaehlpunktnummer"]
+    headers = _calls(aioclient_mock, parse.urljoin(API_URL_B2C, 'zaehlpunkte'))[0][3]
+    assert f"Bearer {ACCESS_TOKEN}" == headers["Authorization"]
+    assert sm._api_gateway_token == headers["X-Gateway-APIKey"]
+
+
+async def test_historical_data(hass, aioclient_mock: AiohttpClientMocker):
+    z = zaehlpunkt_response([enabled(zaehlpunkt())])[0]
+    zp = z["zaehlpunkte"][0]["zaehlpunktnummer"]
+    expect_login(aioclient_mock)
+    expect_zaehlpunkte(aioclient_mock)
+    aioclient_mock.get(parse.urljoin(API_URL_B2B, f'zaehlpunkte/{z["geschaeftspartner"]}/{zp}/messwerte'),
+                       json=history_response(zp))
+    sm = await smartmeter(hass).login()
+
+    hist = await sm.historical_data(zp)
+
+    assert 1 == len(hist['messwerte'])
+    assert '1-1:1.8.0' == hist['obisCode']
+    assert sm._api_gateway_b2b_token == _calls(aioclient_mock, parse.urljoin(API_URL_B2B, 'zaehlpunkte'))[0][3]["X-Gateway-APIKey"]
+
+
+async def test_historical_data_of_wrong_zaehlpunkt(hass, aioclient_mock: AiohttpClientMocker):
+    z = zaehlpunkt_response([enabled(zaehlpunkt())])[0]
+    zp = z["zaehlpunkte"][0]["zaehlpunktnummer"]
+    expect_login(aioclient_mock)
+    expect_zaehlpunkte(aioclient_mock)
+    aioclient_mock.get(parse.urljoin(API_URL_B2B, f'zaehlpunkte/{z["geschaeftspartner"]}/{zp}/messwerte'),
+                       json=history_response(zp, wrong_zp=True))
+    sm = await smartmeter(hass).login()
+
+    with pytest.raises(SmartmeterQueryError):
+        await sm.historical_data(zp)
+
+
+def expect_bewegungsdaten(aioclient_mock: AiohttpClientMocker, values: list[dict]):
+    z = zaehlpunkt_response([enabled(zaehlpunkt())])[0]
+    response = bewegungsdaten_response(z["geschaeftspartner"], z["zaehlpunkte"][0]["zaehlpunktnummer"], values=values)
+    aioclient_mock.get(parse.urljoin(API_URL_ALT, 'user/messwerte/bewegungsdaten'), text=json.dumps(response))
+
+
+async def test_bewegungsdaten(hass, aioclient_mock: AiohttpClientMocker):
+    date_from = dt.datetime(2023, 4, 21)
+    values = bewegungsdaten(count=96, timestamp=date_from, interval='qh')
+    expect_login(aioclient_mock)
+    expect_zaehlpunkte(aioclient_mock)
+    expect_bewegungsdaten(aioclient_mock, values)
+    sm = await smartmeter(hass).login()
+
+    response = await sm.bewegungsdaten(None, date_from, date_from.date())
+
+    assert values == response["values"]
+    query = parse.parse_qs(_calls(aioclient_mock, API_URL_ALT)[0][1].query_string)
+    assert ["2023-04-21T00:00:00.000Z"] == query["zeitpunktVon"]
+    assert ["2023-04-21T23:59:59.999Z"] == query["zeitpunktBis"]
+
+
+async def test_bewegungsdaten_stream(hass, aioclient_mock: AiohttpClientMocker, monkeypatch):
+    # small chunks, so that the values arrive in several batches
+    monkeypatch.setattr("wnsm.api.constants.STREAM_CHUNK_SIZE", 512)
+    date_from = dt.datetime(2023, 4, 21)
+    values = bewegungsdaten(count=96, timestamp=date_from, interval='qh')
+    expect_login(aioclient_mock)
+    expect_zaehlpunkte(aioclient_mock)
+    expect_bewegungsdaten(aioclient_mock, values)
+    sm = await smartmeter(hass).login()
+
+    batches = [batch async for batch in sm.bewegungsdaten_stream(None, date_from, date_from.date())]
+
+    assert 1 < len(batches)
+    assert values == [value for batch in batches for value in batch.values]
+    assert zaehlpunkt()["zaehlpunktnummer"] == batches[0].envelope["descriptor"]["zaehlpunktnummer"]
+
+
+async def test_stream_reading_before_the_request_fails(hass):
+    def flow():
+        yield ReadChunk()
+
+    with pytest.raises(RuntimeError, match="before the streamed request was answered"):
+        [item async for item in smartmeter(hass)._run_stream(flow())]
+
+
+@pytest.fixture
+def sessions(hass, monkeypatch) -> list:
+    """The sessions created by the config flow and the coordinator"""
+    created = []
+
+    def create(hass, *args, **kwargs):
+        created.append(async_create_clientsession(hass, *args, **kwargs))
+        return created[-1]
+
+    monkeypatch.setattr("wnsm.config_flow.async_create_clientsession", create)
+    monkeypatch.setattr("wnsm.coordinator.async_create_clientsession", create)
+    return created
+
+
+async def test_config_flow_closes_its_session(hass, aioclient_mock: AiohttpClientMocker, sessions):
+    expect_login(aioclient_mock)
+    expect_zaehlpunkte(aioclient_mock)
+    flow = WienerNetzeSmartMeterCustomConfigFlow()
+    flow.hass = hass
+
+    assert 1 == len(await flow.validate_auth(USERNAME, PASSWORD))
+    aioclient_mock.clear_requests()
+    expect_login(aioclient_mock, password="WrongPassword")
+    with pytest.raises(SmartmeterLoginError):
+        await flow.validate_auth(USERNAME, PASSWORD)
+
+    assert 2 == len(sessions)
+    assert all(session.closed for session in sessions)
+
+
+async def test_coordinator_closes_its_session_on_unload(hass, sessions):
+    entry = MockConfigEntry(domain=DOMAIN, data={CONF_USERNAME: USERNAME, CONF_PASSWORD: PASSWORD})
+    WienerNetzeCoordinator(hass, entry)
+    assert not sessions[0].closed
+
+    await entry._async_process_on_unload(hass)
+    await hass.async_block_till_done()
+
+    assert sessions[0].closed
+
+
+async def test_entry_takes_over_the_tokens_of_the_config_flow(hass, aioclient_mock: AiohttpClientMocker):
+    expect_login(aioclient_mock)
+    expect_zaehlpunkte(aioclient_mock)
+    flow = WienerNetzeSmartMeterCustomConfigFlow()
+    flow.hass = hass
+    await flow.validate_auth(USERNAME, PASSWORD)
+    await hass.async_block_till_done()
+    aioclient_mock.clear_requests()
+
+    store = HassTokenStore(hass, "entry", USERNAME)
+    await store.async_load()
+    sm = await AioSmartmeter(USERNAME, PASSWORD, token_store=store, session=async_create_clientsession(hass)).login()
+
+    assert sm.is_logged_in()
+    assert ACCESS_TOKEN == store.load()["access_token"]
+    assert 0 == aioclient_mock.call_count
+    # taken over once
+    other = HassTokenStore(hass, "other", USERNAME)
+    await other.async_load()
+    assert other.load() is None
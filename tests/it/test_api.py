@@ -18,12 +18,17 @@ from it import (
     disabled,
     mock_login_page,
     mock_authenticate,
+    CODE_VERIFIER,
     PASSWORD,
     USERNAME,
     mock_token,
+    mock_refresh_token,
     mock_get_api_key,
-    expect_history, expect_bewegungsdaten, zaehlpunkt_response,
+    expect_history, expect_bewegungsdaten, zaehlpunkt_response, bewegungsdaten,
 )
+from wnsm.api.response_cache import FileResponseCache
+from wnsm.api import Smartmeter, token_store
+from wnsm.api.token_store import FileTokenStore
 from wnsm.api.errors import SmartmeterConnectionError, SmartmeterLoginError, SmartmeterQueryError
 import wnsm.api.constants as const
 
@@ -175,6 +180,170 @@ def test_access_key_expired(requests_mock):
     assert 'Access Token is not valid anymore' in str(exc_info.value)
 
 
+def _expire_access_token(sm):
+    sm._access_token_expiration = dt.datetime.now() - dt.timedelta(seconds=1)
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_login_refreshes_expired_access_token(requests_mock: Mocker):
+    expect_login(requests_mock)
+    sm = smartmeter().login()
+    _expire_access_token(sm)
+    requests_mock.reset_mock()
+    mock_refresh_token(requests_mock)
+
+    sm.login()
+
+    assert 1 == requests_mock.call_count
+    assert 'grant_type=refresh_token' in requests_mock.last_request.body
+    assert sm.is_logged_in()
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_access_valid_or_raise_refreshes_expired_access_token(requests_mock: Mocker):
+    expect_login(requests_mock)
+    sm = smartmeter().login()
+    _expire_access_token(sm)
+    mock_refresh_token(requests_mock)
+
+    sm._access_valid_or_raise()
+
+    assert sm.is_logged_in()
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_login_falls_back_to_credentials_if_refresh_fails(requests_mock: Mocker):
+    expect_login(requests_mock)
+    sm = smartmeter().login()
+    _expire_access_token(sm)
+    mock_refresh_token(requests_mock, status=400)
+
+    sm.login()
+
+    assert sm.is_logged_in()
+    assert 'grant_type=authorization_code' in requests_mock.request_history[-2].body
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_renew_refreshes_valid_access_token(requests_mock: Mocker):
+    expect_login(requests_mock)
+    sm = smartmeter().login()
+    requests_mock.reset_mock()
+    mock_refresh_token(requests_mock)
+
+    sm.renew()
+
+    assert 1 == requests_mock.call_count
+    assert 'grant_type=refresh_token' in requests_mock.last_request.body
+    assert sm.is_logged_in()
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_renew_falls_back_to_credentials_if_refresh_fails(requests_mock: Mocker):
+    expect_login(requests_mock)
+    sm = smartmeter().login()
+    mock_refresh_token(requests_mock, status=400)
+
+    sm.renew()
+
+    assert sm.is_logged_in()
+    assert sm._api_gateway_token is not None and sm._api_gateway_b2b_token is not None
+    assert 'grant_type=authorization_code' in requests_mock.request_history[-2].body
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_renew_keeps_valid_tokens_if_fallback_login_fails(requests_mock: Mocker):
+    expect_login(requests_mock)
+    sm = smartmeter().login()
+    tokens = (sm._access_token, sm._access_token_expiration, sm._api_gateway_token, sm._api_gateway_b2b_token)
+    mock_refresh_token(requests_mock, status=400)
+    mock_login_page(requests_mock, 404)
+
+    with pytest.raises(SmartmeterConnectionError):
+        sm.renew()
+
+    # the still valid tokens remain usable, e.g. by requests running concurrently
+    assert tokens == (sm._access_token, sm._access_token_expiration, sm._api_gateway_token, sm._api_gateway_b2b_token)
+    assert sm.is_logged_in()
+    sm._access_valid_or_raise()
+
+
+def test_access_valid_or_raise_without_login():
+    with pytest.raises(SmartmeterConnectionError):
+        smartmeter()._access_valid_or_raise()
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_login_without_valid_refresh_token_performs_credentials_login(requests_mock: Mocker):
+    expect_login(requests_mock)
+    sm = smartmeter().login()
+    _expire_access_token(sm)
+    sm._refresh_token_expiration = dt.datetime.now() - dt.timedelta(seconds=1)
+    requests_mock.reset_mock()
+
+    sm.login()
+
+    assert sm.is_logged_in()
+    assert not any('grant_type=refresh_token' in (r.body or '') for r in requests_mock.request_history)
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_login_reuses_stored_tokens(requests_mock: Mocker, tmp_path):
+    store = FileTokenStore(str(tmp_path / "tokens.json"))
+    expect_login(requests_mock)
+    smartmeter(token_store=store).login()
+    requests_mock.reset_mock()
+
+    sm = smartmeter(token_store=store).login()
+
+    assert 0 == requests_mock.call_count
+    assert sm.is_logged_in()
+    assert sm._api_gateway_token is not None and sm._api_gateway_b2b_token is not None
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_login_refreshes_expired_stored_tokens(requests_mock: Mocker, tmp_path):
+    store = FileTokenStore(str(tmp_path / "tokens.json"))
+    expect_login(requests_mock)
+    sm = smartmeter(token_store=store).login()
+    _expire_access_token(sm)
+    sm.save_tokens()
+    requests_mock.reset_mock()
+    mock_refresh_token(requests_mock)
+
+    smartmeter(token_store=store).login()
+
+    assert 1 == requests_mock.call_count
+    assert 'grant_type=refresh_token' in requests_mock.last_request.body
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_login_reuses_the_tokens_of_the_default_store(requests_mock: Mocker, tmp_path, monkeypatch):
+    monkeypatch.setattr(token_store, "DEFAULT_TOKEN_DIRECTORY", str(tmp_path / "wnsm"))
+    expect_login(requests_mock)
+    Smartmeter(USERNAME, PASSWORD, input_code_verifier=CODE_VERIFIER).login()
+    requests_mock.reset_mock()
+
+    sm = Smartmeter(USERNAME, PASSWORD, input_code_verifier=CODE_VERIFIER).login()
+
+    assert 0 == requests_mock.call_count
+    assert sm.is_logged_in()
+    stored = list((tmp_path / "wnsm").iterdir())
+    assert 1 == len(stored) and USERNAME not in stored[0].name
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_login_ignores_stored_tokens_of_other_user(requests_mock: Mocker, tmp_path):
+    store = FileTokenStore(str(tmp_path / "tokens.json"))
+    store.save({"username": "someone.else@example.com", "access_token": "x"})
+    expect_login(requests_mock)
+
+    smartmeter_with_store = smartmeter(token_store=store).login()
+
+    assert smartmeter_with_store._access_token != "x"
+    assert USERNAME == store.load()["username"]
+
+
 @pytest.mark.usefixtures("requests_mock")
 def test_zaehlpunkte(requests_mock: Mocker):
     expect_login(requests_mock)
@@ -186,6 +355,33 @@ def test_zaehlpunkte(requests_mock: Mocker):
     assert not zps[0]['zaehlpunkte'][1]['isActive']
 
 
+@pytest.mark.usefixtures("requests_mock")
+def test_get_zaehlpunkt_uses_cached_contracts(requests_mock: Mocker):
+    expect_login(requests_mock)
+    expect_zaehlpunkte(requests_mock, [enabled(zaehlpunkt()), enabled(zaehlpunkt_feeding())])
+    sm = smartmeter().login()
+    requests_mock.reset_mock()
+
+    customer_id, zp, anlagetype = sm.get_zaehlpunkt()
+    assert ("1234567890", "AT0010000000000000001000011111111", const.AnlagenType.CONSUMING) == (customer_id, zp, anlagetype)
+    customer_id, zp, anlagetype = sm.get_zaehlpunkt("AT0010000000000000001000011111112")
+    assert ("1234567890", "AT0010000000000000001000011111112", const.AnlagenType.FEEDING) == (customer_id, zp, anlagetype)
+    assert 1 == requests_mock.call_count
+
+    sm.invalidate_zaehlpunkt_index()
+    sm.get_zaehlpunkt("AT0010000000000000001000011111112")
+    assert 2 == requests_mock.call_count
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_get_zaehlpunkt_unknown(requests_mock: Mocker):
+    expect_login(requests_mock)
+    expect_zaehlpunkte(requests_mock, [enabled(zaehlpunkt())])
+    with pytest.raises(SmartmeterQueryError) as exc_info:
+        smartmeter().login().get_zaehlpunkt("AT0010000000000000001000099999999")
+    assert 'Zaehlpunkt AT0010000000000000001000099999999 not found' == str(exc_info.value)
+
+
 @pytest.mark.usefixtures("requests_mock")
 def test_history(requests_mock: Mocker):
     z = zaehlpunkt_response([enabled(zaehlpunkt())])[0]
@@ -420,6 +616,137 @@ def test_bewegungsdaten_wrong_zp(requests_mock: Mocker):
     assert 'Returned data does not match given zaehlpunkt!' == str(exc_info.value)
 
 
+@pytest.mark.usefixtures("requests_mock")
+def test_bewegungsdaten_serves_immutable_days_from_cache(requests_mock: Mocker, tmp_path):
+    z = zaehlpunkt_response([enabled(zaehlpunkt())])[0]
+    dateFrom = dt.datetime(2023, 4, 21, 00, 00, 00, 0)
+    dateTo = dt.datetime(2023, 4, 21, 23, 59, 59, 999999)
+    zpn = z["zaehlpunkte"][0]['zaehlpunktnummer']
+    values = bewegungsdaten(count=96, timestamp=dateFrom, interval='qh')
+    expect_login(requests_mock)
+    expect_zaehlpunkte(requests_mock, [enabled(zaehlpunkt())])
+    expect_bewegungsdaten(requests_mock, z["geschaeftspartner"], zpn, dateFrom, dateTo, values=values)
+    cache = FileResponseCache(str(tmp_path))
+
+    assert values == smartmeter(response_cache=cache).login().bewegungsdaten(None, dateFrom, dateTo)['values']
+    requests_mock.reset_mock()
+    hist = smartmeter(response_cache=cache).login().bewegungsdaten(None, dateFrom, dateTo)
+
+    assert values == hist['values']
+    assert zpn == hist['descriptor']['zaehlpunktnummer']
+    assert not any('bewegungsdaten' in r.url for r in requests_mock.request_history)
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_bewegungsdaten_uncached_replaces_cached_days(requests_mock: Mocker, tmp_path):
+    z = zaehlpunkt_response([enabled(zaehlpunkt())])[0]
+    dateFrom = dt.datetime(2023, 4, 21, 00, 00, 00, 0)
+    dateTo = dt.datetime(2023, 4, 21, 23, 59, 59, 999999)
+    zpn = z["zaehlpunkte"][0]['zaehlpunktnummer']
+    stale = bewegungsdaten(count=96, timestamp=dateFrom, interval='qh')
+    corrected = [{**value, "wert": value["wert"] + 0.001} for value in stale]
+    expect_login(requests_mock)
+    expect_zaehlpunkte(requests_mock, [enabled(zaehlpunkt())])
+    expect_bewegungsdaten(requests_mock, z["geschaeftspartner"], zpn, dateFrom, dateTo, values=stale)
+    cache = FileResponseCache(str(tmp_path))
+    smartmeter(response_cache=cache).login().bewegungsdaten(None, dateFrom, dateTo)
+    expect_bewegungsdaten(requests_mock, z["geschaeftspartner"], zpn, dateFrom, dateTo, values=corrected)
+    requests_mock.reset_mock()
+
+    sm = smartmeter(response_cache=cache).login()
+    assert corrected == sm.bewegungsdaten(None, dateFrom, dateTo, cached=False)['values']
+    assert 1 == sum('bewegungsdaten' in r.url for r in requests_mock.request_history)
+    # the cache holds the corrected day from now on
+    assert corrected == sm.bewegungsdaten(None, dateFrom, dateTo)['values']
+    assert 1 == sum('bewegungsdaten' in r.url for r in requests_mock.request_history)
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_bewegungsdaten_requests_only_days_missing_in_cache(requests_mock: Mocker, tmp_path):
+    z = zaehlpunkt_response([enabled(zaehlpunkt())])[0]
+    dateFrom = dt.datetime(2023, 4, 21, 00, 00, 00, 0)
+    dateTo = dt.datetime(2023, 4, 22, 23, 59, 59, 999999)
+    zpn = z["zaehlpunkte"][0]['zaehlpunktnummer']
+    first_day = bewegungsdaten(count=96, timestamp=dateFrom, interval='qh')
+    second_day = bewegungsdaten(count=96, timestamp=dateFrom + dt.timedelta(days=1), interval='qh')
+    second_day[-1]['geschaetzt'] = True
+    expect_login(requests_mock)
+    expect_zaehlpunkte(requests_mock, [enabled(zaehlpunkt())])
+    expect_bewegungsdaten(requests_mock, z["geschaeftspartner"], zpn, dateFrom, dateTo, values=first_day + second_day)
+    cache = FileResponseCache(str(tmp_path))
+    smartmeter(response_cache=cache).login().bewegungsdaten(None, dateFrom, dateTo)
+
+    # the estimated day is not cached, hence requested again
+    expect_bewegungsdaten(requests_mock, z["geschaeftspartner"], zpn, dateFrom + dt.timedelta(days=1), dateTo,
+                          values=second_day)
+    requests_mock.reset_mock()
+    hist = smartmeter(response_cache=cache).login().bewegungsdaten(None, dateFrom, dateTo)
+
+    assert first_day + second_day == hist['values']
+    assert ['2023-04-22T00:00:00.000Z'] == [
+        r.qs['zeitpunktvon'][0].upper() for r in requests_mock.request_history if 'bewegungsdaten' in r.url
+    ]
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_bewegungsdaten_stream(requests_mock: Mocker):
+    z = zaehlpunkt_response([enabled(zaehlpunkt())])[0]
+    dateFrom = dt.datetime(2023, 4, 21, 00, 00, 00, 0)
+    dateTo = dt.datetime(2023, 5, 1, 23, 59, 59, 999999)
+    zpn = z["zaehlpunkte"][0]['zaehlpunktnummer']
+    values = bewegungsdaten(count=2000, timestamp=dateFrom, interval='qh')
+    expect_login(requests_mock)
+    expect_bewegungsdaten(requests_mock, z["geschaeftspartner"], zpn, dateFrom, dateTo, values=values)
+    expect_zaehlpunkte(requests_mock, [enabled(zaehlpunkt())])
+
+    batches = list(smartmeter().login().bewegungsdaten_stream(None, dateFrom, dateTo))
+
+    assert len(batches) > 1
+    assert values == [value for batch in batches for value in batch.values]
+    assert zpn == batches[0].envelope['descriptor']['zaehlpunktnummer']
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_bewegungsdaten_stream_wrong_zp(requests_mock: Mocker):
+    z = zaehlpunkt_response([enabled(zaehlpunkt())])[0]
+    dateFrom = dt.datetime(2023, 4, 21, 00, 00, 00, 0)
+    dateTo = dt.datetime(2023, 5, 1, 23, 59, 59, 999999)
+    zpn = z["zaehlpunkte"][0]['zaehlpunktnummer']
+    expect_login(requests_mock)
+    expect_bewegungsdaten(requests_mock, z["geschaeftspartner"], zpn, dateFrom, dateTo, wrong_zp=True, values_count=COUNT)
+    expect_zaehlpunkte(requests_mock, [enabled(zaehlpunkt())])
+    with pytest.raises(SmartmeterQueryError) as exc_info:
+        list(smartmeter().login().bewegungsdaten_stream(None, dateFrom, dateTo))
+    assert 'Returned data does not match given zaehlpunkt!' == str(exc_info.value)
+
+
+@pytest.mark.usefixtures("requests_mock")
+def test_bewegungsdaten_stream_uses_cache(requests_mock: Mocker, tmp_path):
+    z = zaehlpunkt_response([enabled(zaehlpunkt())])[0]
+    dateFrom = dt.datetime(2023, 4, 21, 00, 00, 00, 0)
+    dateTo = dt.datetime(2023, 4, 22, 23, 59, 59, 999999)
+    zpn = z["zaehlpunkte"][0]['zaehlpunktnummer']
+    first_day = bewegungsdaten(count=96, timestamp=dateFrom, interval='qh')
+    second_day = bewegungsdaten(count=96, timestamp=dateFrom + dt.timedelta(days=1), interval='qh')
+    second_day[-1]['geschaetzt'] = True
+    expect_login(requests_mock)
+    expect_zaehlpunkte(requests_mock, [enabled(zaehlpunkt())])
+    expect_bewegungsdaten(requests_mock, z["geschaeftspartner"], zpn, dateFrom, dateTo, values=first_day + second_day)
+    cache = FileResponseCache(str(tmp_path))
+    streamed = list(smartmeter(response_cache=cache).login().bewegungsdaten_stream(None, dateFrom, dateTo))
+    assert first_day + second_day == [value for batch in streamed for value in batch.values]
+
+    expect_bewegungsdaten(requests_mock, z["geschaeftspartner"], zpn, dateFrom + dt.timedelta(days=1), dateTo,
+                          values=second_day)
+    requests_mock.reset_mock()
+    streamed = list(smartmeter(response_cache=cache).login().bewegungsdaten_stream(None, dateFrom, dateTo))
+
+    assert first_day + second_day == [value for batch in streamed for value in batch.values]
+    assert ['2023-04-22T00:00:00.000Z'] == [
+        r.qs['zeitpunktvon'][0].upper() for r in requests_mock.request_history if 'bewegungsdaten' in r.url
+    ]
+
+
 @pytest.mark.usefixtures("requests_mock")
 def test_verbrauch_raw(requests_mock: Mocker):
 
@@ -0,0 +1,391 @@
+import asyncio
+import datetime as dt
+
+import pytest
+from homeassistant.util import dt as dt_util
+from pytest_homeassistant_custom_component.common import async_fire_time_changed
+
+import it  # noqa: F401
+from wnsm import AsyncSmartmeter as async_smartmeter
+from wnsm.AsyncSmartmeter import (
+    BACKFILL_MAX_WINDOW_DAYS,
+    BACKFILL_MIN_WINDOW_DAYS,
+    BACKFILL_WINDOW_DAYS,
+    TOKEN_RENEWAL_MARGIN,
+    AsyncSmartmeter,
+    _WindowSizer,
+)
+from wnsm.api.errors import SmartmeterConnectionError, SmartmeterQueryError
+from wnsm.api.protocol import ValuesBatch
+
+
+class FakeSmartmeter:
+    """Token handling of the client, logins and renewals block until released"""
+
+    def __init__(self, expires_in: int | None = None):
+        self._access_token_expiration = None
+        if expires_in is not None:
+            self._access_token_expiration = dt.datetime.now() + dt.timedelta(seconds=expires_in)
+        self.logins = 0
+        self.renewals = 0
+        self.release = asyncio.Event()
+        self.fail = False
+
+    def is_logged_in(self):
+        return self._access_token_expiration is not None and dt.datetime.now() < self._access_token_expiration
+
+    async def _authenticate(self):
+        await self.release.wait()
+        if self.fail:
+            raise SmartmeterConnectionError("Could not load login page")
+        self._access_token_expiration = dt.datetime.now() + dt.timedelta(seconds=300)
+        return self
+
+    async def login(self):
+        self.logins += 1
+        return await self._authenticate()
+
+    async def renew(self):
+        self.renewals += 1
+        return await self._authenticate()
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(async_smartmeter.random, "uniform", lambda a, b: 0)
+
+
+async def test_login_with_valid_token_schedules_renewal(hass):
+    smartmeter = FakeSmartmeter(expires_in=300)
+    async_sm = AsyncSmartmeter(hass, smartmeter)
+
+    assert smartmeter is await async_sm.login()
+
+    assert 0 == smartmeter.logins
+    assert async_sm._cancel_renewal_timer is not None
+    async_sm.async_stop()
+
+
+async def test_concurrent_callers_share_one_login(hass):
+    smartmeter = FakeSmartmeter()
+    async_sm = AsyncSmartmeter(hass, smartmeter)
+
+    callers = [hass.async_create_task(async_sm.login()) for _ in range(3)]
+    await asyncio.sleep(0)
+    smartmeter.release.set()
+    await asyncio.gather(*callers)
+
+    assert 1 == smartmeter.logins
+    assert async_sm._cancel_renewal_timer is not None
+    async_sm.async_stop()
+
+
+async def test_renewal_runs_ahead_of_expiry(hass):
+    smartmeter = FakeSmartmeter(expires_in=300)
+    smartmeter.release.set()
+    async_sm = AsyncSmartmeter(hass, smartmeter)
+    await async_sm.login()
+
+    async_fire_time_changed(hass, dt_util.utcnow() + dt.timedelta(seconds=300 - TOKEN_RENEWAL_MARGIN - 60))
+    await hass.async_block_till_done()
+    assert 0 == smartmeter.renewals
+
+    async_fire_time_changed(hass, dt_util.utcnow() + dt.timedelta(seconds=300 - TOKEN_RENEWAL_MARGIN + 1))
+    await hass.async_block_till_done()
+    assert 1 == smartmeter.renewals
+    assert 0 == smartmeter.logins
+    async_sm.async_stop()
+
+
+async def test_callers_with_valid_token_do_not_wait_for_renewal(hass):
+    smartmeter = FakeSmartmeter(expires_in=300)
+    async_sm = AsyncSmartmeter(hass, smartmeter)
+    await async_sm.login()
+
+    async_fire_time_changed(hass, dt_util.utcnow() + dt.timedelta(seconds=300))
+    while smartmeter.renewals == 0:
+        await asyncio.sleep(0)
+    assert not async_sm._renewal.done()
+
+    # the renewal is still blocked, but the token is valid
+    assert smartmeter is await asyncio.wait_for(async_sm.login(), 1)
+
+    smartmeter.release.set()
+    await hass.async_block_till_done()
+    assert async_sm._renewal.done()
+    async_sm.async_stop()
+
+
+async def test_failed_renewal_is_rescheduled(hass):
+    smartmeter = FakeSmartmeter(expires_in=300)
+    smartmeter.fail = True
+    smartmeter.release.set()
+    async_sm = AsyncSmartmeter(hass, smartmeter)
+    await async_sm.login()
+
+    async_fire_time_changed(hass, dt_util.utcnow() + dt.timedelta(seconds=300))
+    await hass.async_block_till_done()
+
+    assert 1 == smartmeter.renewals
+    assert smartmeter.is_logged_in()
+    assert async_sm._cancel_renewal_timer is not None
+    async_sm.async_stop()
+
+
+class FakeContractsSmartmeter:
+    """Counts the requests of the contracts, which block until released (or fail, if fail is set)"""
+
+    def __init__(self):
+        self.requests = 0
+        self.release = asyncio.Event()
+        self.fail = False
+
+    async def zaehlpunkte(self):
+        self.requests += 1
+        await self.release.wait()
+        if self.fail:
+            raise SmartmeterConnectionError("Could not load contracts")
+        return [{"geschaeftspartner": "1234", "zaehlpunkte": [{"zaehlpunktnummer": "AT1"}]}]
+
+
+async def test_concurrent_identical_calls_share_one_request(hass, caplog):
+    smartmeter = FakeContractsSmartmeter()
+    async_sm = AsyncSmartmeter(hass, smartmeter)
+
+    callers = [hass.async_create_task(async_sm.get_zaehlpunkte_details()) for _ in range(5)]
+    await asyncio.sleep(0)
+    smartmeter.release.set()
+    details = await asyncio.gather(*callers)
+
+    assert 1 == smartmeter.requests
+    assert all("AT1" in zaehlpunkte and "1234" == zaehlpunkte["AT1"]["customerId"] for zaehlpunkte in details)
+    assert 4 == caplog.text.count("Joining in-flight request")
+    assert {} == async_sm._in_flight
+
+
+async def test_cancelled_caller_does_not_cancel_the_shared_request(hass):
+    smartmeter = FakeContractsSmartmeter()
+    async_sm = AsyncSmartmeter(hass, smartmeter)
+
+    cancelled = hass.async_create_task(async_sm.get_zaehlpunkte_details())
+    waiting = hass.async_create_task(async_sm.get_zaehlpunkte_details())
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+    smartmeter.release.set()
+
+    assert "AT1" in await waiting
+    assert cancelled.cancelled()
+    assert 1 == smartmeter.requests
+
+
+async def test_failed_call_reaches_every_caller_and_is_not_cached(hass):
+    smartmeter = FakeContractsSmartmeter()
+    smartmeter.fail = True
+    async_sm = AsyncSmartmeter(hass, smartmeter)
+
+    callers = [hass.async_create_task(async_sm.get_zaehlpunkte_details()) for _ in range(3)]
+    await asyncio.sleep(0)
+    smartmeter.release.set()
+    results = await asyncio.gather(*callers, return_exceptions=True)
+
+    assert all(isinstance(result, SmartmeterConnectionError) for result in results)
+    assert 1 == smartmeter.requests
+
+    smartmeter.fail = False
+    assert "AT1" in await async_sm.get_zaehlpunkte_details()
+    assert 2 == smartmeter.requests
+
+
+def test_window_sizer_moves_halfway_to_the_target():
+    sizer = _WindowSizer()
+    assert BACKFILL_WINDOW_DAYS == sizer.days
+
+    # 31 days took 31 seconds (the target is 15): the target is 15 days
+    sizer.observe(31, 31.0, 31 * 96)
+    assert 31 - 8 == sizer.days
+    # fast and small responses grow the windows up to the maximum
+    for _ in range(10):
+        sizer.observe(sizer.days, 0.1, 96)
+    assert BACKFILL_MAX_WINDOW_DAYS == sizer.days
+    # too many values shrink them
+    sizer.observe(92, 0.1, 92 * 96 * 10)
+    assert 92 - (92 - 10) // 2 == sizer.days
+
+
+def test_window_sizer_shrinks_to_half_of_a_timed_out_window():
+    sizer = _WindowSizer()
+    sizer.shrink(20)
+    assert 10 == sizer.days
+    sizer.shrink(40)
+    assert 10 == sizer.days
+    sizer.shrink(2)
+    assert BACKFILL_MIN_WINDOW_DAYS == sizer.days
+
+
+class FakeStreamingSmartmeter:
+    """
+    Streams a value per day in batches of batch_size,
+    windows longer than max_days time out after the batches delivered before the timeout
+    """
+
+    def __init__(self, max_days: int = 1000, batch_size: int = 2, delivered_before_timeout: int = 1):
+        self.max_days = max_days
+        self.batch_size = batch_size
+        self.delivered_before_timeout = delivered_before_timeout
+        self.requests: list[tuple[dt.date, dt.date]] = []
+
+    async def bewegungsdaten_stream(self, zaehlpunkt, start, last_day, granularity):
+        first = start.date() if isinstance(start, dt.datetime) else start
+        self.requests.append((first, last_day))
+        days = [first + dt.timedelta(days=offset) for offset in range((last_day - first).days + 1)]
+        values = [{"zeitpunktVon": f"{day.isoformat()}T00:00:00Z", "wert": 1.0} for day in days]
+        for offset in range(0, len(values), self.batch_size):
+            if offset >= self.delivered_before_timeout * self.batch_size and len(days) > self.max_days:
+                raise TimeoutError()
+            yield ValuesBatch({"descriptor": {"zaehlpunktnummer": zaehlpunkt}}, values[offset:offset + self.batch_size])
+            await asyncio.sleep(0)
+
+
+async def collect_windows(async_sm: AsyncSmartmeter, start: dt.datetime, end: dt.datetime) -> list:
+    windows = []
+    async for window_start, last_day, head, batches in async_sm.iter_bewegungsdaten_windows("AT1", start, end):
+        windows.append((window_start.date(), last_day, head["zaehlpunkt"], [value async for batch in batches for value in batch]))
+    return windows
+
+
+async def test_windows_are_yielded_in_order(hass):
+    start = dt.datetime(2023, 1, 1, tzinfo=dt.timezone.utc)
+    async_sm = AsyncSmartmeter(hass, FakeStreamingSmartmeter())
+
+    windows = await collect_windows(async_sm, start, dt.datetime(2023, 3, 15, tzinfo=dt.timezone.utc))
+
+    days = [dt.date.fromisoformat(value["zeitpunktVon"][:10]) for *_, values in windows for value in values]
+    assert [start.date() + dt.timedelta(days=offset) for offset in range(len(days))] == days
+    assert dt.date(2023, 3, 15) == days[-1]
+    assert all("AT1" == zaehlpunkt for _, _, zaehlpunkt, _ in windows)
+    assert all(values[0]["zeitpunktVon"].startswith(window_start.isoformat()) for window_start, _, _, values in windows)
+
+
+async def test_timed_out_window_is_split_without_duplicating_values(hass):
+    start = dt.datetime(2023, 1, 1, tzinfo=dt.timezone.utc)
+    smartmeter = FakeStreamingSmartmeter(max_days=8)
+    async_sm = AsyncSmartmeter(hass, smartmeter)
+
+    windows = await collect_windows(async_sm, start, dt.datetime(2023, 1, 31, tzinfo=dt.timezone.utc))
+
+    assert 1 == len(windows)
+    values = windows[0][3]
+    assert [f"{(start.date() + dt.timedelta(days=offset)).isoformat()}T00:00:00Z" for offset in range(31)] == [
+        value["zeitpunktVon"] for value in values]
+    # 31 days -> 15 + 16 -> 7 + 8 + 8 + 8
+    assert (dt.date(2023, 1, 1), dt.date(2023, 1, 31)) == smartmeter.requests[0]
+    assert {(dt.date(2023, 1, 1), dt.date(2023, 1, 7)), (dt.date(2023, 1, 24), dt.date(2023, 1, 31))} <= set(smartmeter.requests)
+
+
+async def test_timed_out_single_day_fails_the_window(hass):
+    start = dt.datetime(2023, 1, 1, tzinfo=dt.timezone.utc)
+    smartmeter = FakeStreamingSmartmeter(max_days=0, delivered_before_timeout=0)
+    async_sm = AsyncSmartmeter(hass, smartmeter)
+
+    with pytest.raises(TimeoutError):
+        await collect_windows(async_sm, start, dt.datetime(2023, 1, 4, tzinfo=dt.timezone.utc))
+
+
+class FakeHistorySmartmeter:
+    """
+    Measured values from first_day until (including) published_until, the daily historical data
+    is only available if daily is set
+    """
+
+    def __init__(self, first_day: dt.date | None, published_until: dt.date, daily: bool = False):
+        self.first_day = first_day
+        self.published_until = published_until
+        self.daily = daily
+        self.days_queried: list[dt.date] = []
+
+    def _measured(self, day: dt.date) -> bool:
+        return self.first_day is not None and self.first_day <= day <= self.published_until
+
+    async def historical_data(self, zaehlpunkt, date_from, date_to, valuetype):
+        if not self.daily:
+            raise SmartmeterQueryError("Returned data does not contain any zaehlwerke or is empty.")
+        days = [date_from + dt.timedelta(days=offset) for offset in range((date_to - date_from).days + 1)]
+        return {"messwerte": [{
+            "zeitVon": f"{day.isoformat()}T00:00:00Z", "zeitBis": f"{day.isoformat()}T23:59:59Z",
+            "messwert": 1000 if self._measured(day) else None,
+        } for day in days]}
+
+    async def bewegungsdaten(self, zaehlpunkt, start, last_day, valuetype, aggregat, cached):
+        self.days_queried.append(last_day)
+        return {"values": [{
+            "zeitpunktVon": start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "wert": 0.1 if self._measured(last_day) else None,
+        }]}
+
+
+START = dt.datetime(2023, 1, 1, 6, tzinfo=dt.timezone.utc)
+END = dt.datetime(2023, 3, 1, tzinfo=dt.timezone.utc)
+
+
+def midnight(day: dt.date) -> dt.datetime:
+    return dt.datetime.combine(day, dt.time(), dt.timezone.utc)
+
+
+@pytest.mark.parametrize("daily", [False, True])
+async def test_first_data_of_a_meter_without_data(hass, daily):
+    async_sm = AsyncSmartmeter(hass, FakeHistorySmartmeter(None, END.date(), daily))
+
+    assert await async_sm.find_first_data("AT1", START, END) is None
+
+
+@pytest.mark.parametrize("daily", [False, True])
+async def test_first_data_from_the_first_day(hass, daily):
+    async_sm = AsyncSmartmeter(hass, FakeHistorySmartmeter(dt.date(2022, 6, 1), END.date(), daily))
+
+    # not before start, although the first day started before it
+    assert START == await async_sm.find_first_data("AT1", START, END)
+
+
+@pytest.mark.parametrize("daily", [False, True])
+async def test_first_data_in_between(hass, daily):
+    async_sm = AsyncSmartmeter(hass, FakeHistorySmartmeter(dt.date(2023, 2, 7), END.date(), daily))
+
+    assert midnight(dt.date(2023, 2, 7)) == await async_sm.find_first_data("AT1", START, END)
+
+
+async def test_first_data_searched_in_days_of_bewegungsdaten(hass):
+    smartmeter = FakeHistorySmartmeter(dt.date(2023, 2, 7), END.date())
+    async_sm = AsyncSmartmeter(hass, smartmeter)
+
+    await async_sm.find_first_data("AT1", START, END)
+
+    # a binary search instead of every day
+    assert len(smartmeter.days_queried) <= 8
+
+
+async def test_first_data_on_the_last_day_only(hass):
+    smartmeter = FakeHistorySmartmeter(END.date(), END.date())
+
+    assert END == await AsyncSmartmeter(hass, smartmeter).find_first_data("AT1", START, END)
+
+
+async def test_first_data_if_the_last_day_is_not_published_yet(hass):
+    day_before = END.date() - dt.timedelta(days=1)
+    async_sm = AsyncSmartmeter(hass, FakeHistorySmartmeter(dt.date(2023, 2, 7), day_before))
+    assert midnight(dt.date(2023, 2, 7)) == await async_sm.find_first_data("AT1", START, END)
+
+    # only the unpublished last day would have data
+    async_sm = AsyncSmartmeter(hass, FakeHistorySmartmeter(END.date(), day_before))
+    assert await async_sm.find_first_data("AT1", START, END) is None
+
+
+async def test_first_data_within_a_single_day(hass):
+    end = START.replace(hour=23)
+    async_sm = AsyncSmartmeter(hass, FakeHistorySmartmeter(START.date(), START.date()))
+    assert START == await async_sm.find_first_data("AT1", START, end)
+
+    # the day before (to try, as the day might not be published yet) is before start
+    smartmeter = FakeHistorySmartmeter(None, START.date())
+    assert await AsyncSmartmeter(hass, smartmeter).find_first_data("AT1", START, end) is None
+    assert [START.date()] == smartmeter.days_queried
@@ -0,0 +1,239 @@
+import asyncio
+import datetime as dt
+import os
+
+import pytest
+import voluptuous as vol
+from homeassistant.const import CONF_PASSWORD, CONF_USERNAME
+from homeassistant.data_entry_flow import FlowResultType
+from pytest_homeassistant_custom_component.common import MockConfigEntry
+
+from it import PASSWORD, USERNAME
+from wnsm import async_remove_entry, coordinator
+from wnsm.config_flow import WienerNetzeSmartMeterOptionsFlow, options_schema
+from wnsm.const import (
+    CONF_METER_CONCURRENCY,
+    CONF_ZAEHLPUNKTE,
+    DEFAULT_METER_CONCURRENCY,
+    DOMAIN,
+    STORAGE_KEY_SNAPSHOT,
+    STORAGE_VERSION,
+)
+from wnsm.coordinator import WienerNetzeCoordinator, response_cache_path
+from wnsm.sensor import WNSMCoordinatedSensor
+
+ZAEHLPUNKTE = ["AT1", "AT2", "AT3"]
+
+
+class FakeAsyncSmartmeter:
+    def __init__(self):
+        self.details = {zp: {"zaehlpunktnummer": zp, "granularity": "QUARTER_HOUR"} for zp in ZAEHLPUNKTE}
+
+    async def login(self):
+        return self
+
+    async def get_zaehlpunkte_details(self):
+        return self.details
+
+    def is_active(self, zp_details):
+        return True
+
+    def async_stop(self):
+        pass
+
+
+class FakeImporter:
+    """Meter readings by zaehlpunkt (an exception is raised), counting the meters read at the same time"""
+    readings: dict = {}
+    running = 0
+    max_running = 0
+
+    def __init__(self, hass, async_smartmeter, zaehlpunkt, unit_of_measurement, granularity, import_state):
+        self.zaehlpunkt = zaehlpunkt
+
+    async def async_meter_reading(self):
+        cls = type(self)
+        cls.running += 1
+        cls.max_running = max(cls.max_running, cls.running)
+        try:
+            await asyncio.sleep(0.01)
+            reading = cls.readings[self.zaehlpunkt]
+            if isinstance(reading, Exception):
+                raise reading
+            return reading
+        finally:
+            cls.running -= 1
+
+
+@pytest.fixture
+def importer(monkeypatch):
+    FakeImporter.readings = {zp: 1000.0 + index for index, zp in enumerate(ZAEHLPUNKTE)}
+    FakeImporter.running, FakeImporter.max_running = 0, 0
+    monkeypatch.setattr(coordinator, "Importer", FakeImporter)
+    return FakeImporter
+
+
+@pytest.fixture
+async def wnsm_coordinator(hass):
+    """Creates coordinators (of the meters ZAEHLPUNKTE with the given options), unloaded after the test"""
+    created = []
+
+    def create(options: dict = None) -> WienerNetzeCoordinator:
+        entry = MockConfigEntry(domain=DOMAIN, options=options or {}, data={
+            CONF_USERNAME: USERNAME, CONF_PASSWORD: PASSWORD,
+            CONF_ZAEHLPUNKTE: [{"zaehlpunktnummer": zp} for zp in ZAEHLPUNKTE],
+        })
+        wnsm = WienerNetzeCoordinator(hass, entry)
+        wnsm.async_smartmeter = FakeAsyncSmartmeter()
+        wnsm.import_scheduler.async_schedule = lambda *args: True
+        created.append(wnsm)
+        return wnsm
+
+    yield create
+    for wnsm in created:
+        await wnsm.entry._async_process_on_unload(hass)
+
+
+async def test_error_of_one_meter_does_not_affect_the_others(hass, wnsm_coordinator, importer):
+    importer.readings["AT2"] = RuntimeError("Cannot access the meter reading")
+    wnsm = wnsm_coordinator()
+
+    data = await wnsm._async_update_data()
+
+    assert 1000.0 == data["AT1"]["reading"] and 1002.0 == data["AT3"]["reading"]
+    assert "Cannot access the meter reading" == data["AT2"]["error"]
+    assert "error" not in data["AT1"] and "error" not in data["AT3"]
+
+
+async def test_meters_are_refreshed_concurrently_as_set_in_the_options(hass, wnsm_coordinator, importer):
+    await wnsm_coordinator()._async_update_data()
+    assert len(ZAEHLPUNKTE) == importer.max_running
+
+    importer.max_running = 0
+    await wnsm_coordinator({CONF_METER_CONCURRENCY: 1})._async_update_data()
+    assert 1 == importer.max_running
+
+
+async def test_options_flow_sets_the_meter_concurrency(hass):
+    entry = MockConfigEntry(domain=DOMAIN, options={CONF_METER_CONCURRENCY: 2})
+    flow = WienerNetzeSmartMeterOptionsFlow(entry)
+    flow.hass = hass
+
+    form = await flow.async_step_init()
+    assert FlowResultType.FORM == form["type"]
+    assert {CONF_METER_CONCURRENCY: 2} == form["data_schema"]({})
+
+    result = await flow.async_step_init(form["data_schema"]({CONF_METER_CONCURRENCY: "3"}))
+    assert FlowResultType.CREATE_ENTRY == result["type"]
+    assert {CONF_METER_CONCURRENCY: 3} == result["data"]
+
+
+@pytest.mark.parametrize("meter_concurrency", [0, 11, "many"])
+def test_options_schema_rejects_invalid_meter_concurrency(meter_concurrency):
+    with pytest.raises(vol.Invalid):
+        options_schema()({CONF_METER_CONCURRENCY: meter_concurrency})
+    assert {CONF_METER_CONCURRENCY: DEFAULT_METER_CONCURRENCY} == options_schema()({})
+
+
+def listen(wnsm: WienerNetzeCoordinator, contexts) -> list:
+    """Adds a listener per context, returns the contexts notified"""
+    notified = []
+    for context in contexts:
+        wnsm.async_add_listener(lambda context=context: notified.append(context), context)
+    return notified
+
+
+class Clock:
+    """Replaces the datetime of the coordinator, its time only moves by tick"""
+    current = dt.datetime(2024, 1, 1, 6)
+
+    @classmethod
+    def now(cls) -> dt.datetime:
+        return cls.current
+
+    @classmethod
+    def tick(cls, seconds: int) -> None:
+        cls.current += dt.timedelta(seconds=seconds)
+
+
+async def test_only_the_listeners_of_changed_meters_are_notified(hass, wnsm_coordinator, importer, monkeypatch):
+    monkeypatch.setattr(coordinator, "datetime", Clock)
+    wnsm = wnsm_coordinator()
+    notified = listen(wnsm, ZAEHLPUNKTE + [None])
+
+    await wnsm.async_refresh()
+    assert sorted(ZAEHLPUNKTE) == sorted(context for context in notified if context)
+    first = wnsm.data["AT1"]["timestamp"]
+
+    notified.clear()
+    Clock.tick(60)
+    await wnsm.async_refresh()
+    assert [] == notified
+
+    importer.readings["AT2"] = 1005.0
+    Clock.tick(60)
+    await wnsm.async_refresh()
+    assert ["AT2", None] == notified
+    # the unchanged meters keep the time of their last change, the time of the refresh is volatile
+    assert first == wnsm.data["AT1"]["changed"] != wnsm.data["AT1"]["timestamp"]
+    assert wnsm.data["AT2"]["timestamp"] == wnsm.data["AT2"]["changed"]
+    await wnsm.async_shutdown()
+
+
+async def test_all_listeners_are_notified_if_the_refresh_fails(hass, wnsm_coordinator, importer):
+    wnsm = wnsm_coordinator()
+    notified = listen(wnsm, ZAEHLPUNKTE)
+    await wnsm.async_refresh()
+    notified.clear()
+
+    async def fail():
+        raise RuntimeError("Cannot log in")
+
+    wnsm.async_smartmeter.login = fail
+    await wnsm.async_refresh()
+
+    assert not wnsm.last_update_success
+    assert ZAEHLPUNKTE == notified
+    await wnsm.async_shutdown()
+
+
+async def test_sensors_have_the_restored_state_before_the_first_refresh(hass, wnsm_coordinator, hass_storage, importer):
+    wnsm = wnsm_coordinator()
+    key = f"{STORAGE_KEY_SNAPSHOT}.{wnsm.entry.entry_id}"
+    hass_storage[key] = {"version": STORAGE_VERSION, "key": key, "data": {
+        "AT1": {"details": {"zaehlpunktnummer": "AT1"}, "reading": 1234.5, "timestamp": "01.01.2024 06:00:00"},
+        "AT2": {"error": "Zaehlpunkt AT2 not found", "details": None, "reading": None, "timestamp": "01.01.2024 06:00:00"},
+    }}
+    sensors = {zp: WNSMCoordinatedSensor(wnsm, zp) for zp in ZAEHLPUNKTE}
+
+    assert await wnsm.async_restore_snapshot()
+
+    assert 0 == importer.max_running
+    assert 1234.5 == sensors["AT1"].native_value
+    attributes = sensors["AT1"].extra_state_attributes
+    assert "01.01.2024 06:00:00" == attributes["last_update"] == attributes["last_changed"]
+    assert not sensors["AT2"].available and not sensors["AT3"].available
+
+    await wnsm.async_refresh()
+    assert 1000.0 == sensors["AT1"].native_value
+    assert sensors["AT3"].available
+
+
+async def test_without_a_snapshot_nothing_is_restored(hass, wnsm_coordinator, importer):
+    wnsm = wnsm_coordinator()
+
+    assert not await wnsm.async_restore_snapshot()
+    assert wnsm.data is None
+
+
+async def test_response_cache_is_removed_with_the_entry(hass):
+    entry = MockConfigEntry(domain=DOMAIN)
+    path = response_cache_path(hass, entry.entry_id)
+    assert ".storage" not in path.split(os.sep)
+    os.makedirs(os.path.join(path, "bewegungsdaten"))
+    with open(os.path.join(path, "bewegungsdaten", "2024-01-01.json"), "w") as file:
+        file.write("{}")
+
+    await async_remove_entry(hass, entry)
+
+    assert not os.path.exists(path)
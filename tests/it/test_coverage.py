@@ -0,0 +1,23 @@
+from wnsm.coverage import IntervalSet
+
+
+def test_interval_set_merges_overlapping_and_adjacent_intervals():
+    intervals = IntervalSet()
+    intervals.add(10, 20)
+    intervals.add(30, 40)
+    intervals.add(20, 25)
+    intervals.add(35, 50)
+
+    assert [[10, 25], [30, 50]] == intervals.to_list()
+
+    intervals.add(0, 100)
+    assert [[0, 100]] == intervals.to_list()
+
+
+def test_interval_set_gaps():
+    intervals = IntervalSet([[10, 20], [30, 40]])
+
+    assert [(0, 10), (20, 30), (40, 50)] == intervals.gaps(0, 50)
+    assert [(20, 30)] == intervals.gaps(15, 35)
+    assert [] == intervals.gaps(12, 18)
+    assert [(0, 5)] == IntervalSet().gaps(0, 5)
@@ -0,0 +1,475 @@
+import datetime as dt
+
+import pytest
+from homeassistant.components.recorder import get_instance
+from homeassistant.components.recorder.statistics import async_add_external_statistics, statistics_during_period
+from homeassistant.util import dt as dt_util
+
+import it  # noqa: F401
+from wnsm.aggregation import to_milli_wh
+from wnsm.api.constants import ValueType
+from wnsm.importer import Importer, StatisticsWriter, _statistics
+from wnsm.storage import ImportStateStore
+
+ZAEHLPUNKT = "AT0010000000000000001000011111111"
+STATISTIC_ID = f"wnsm:{ZAEHLPUNKT.lower()}"
+
+
+class FakeSmartmeter:
+    """Serves quarter hours of usage(hour) kWh per hour and meter readings consistent with meter_usage(hour)"""
+
+    def __init__(self, usage=lambda hour: 0.4, meter_usage=None, first_data: dt.datetime = None,
+                 window_days: int = 5, fail_from: dt.datetime = None):
+        self.usage = usage
+        self.meter_usage = meter_usage or usage
+        self.requests = []
+        self.first_data = first_data
+        self.window_days = window_days
+        self.fail_from = fail_from  #: windows starting from then fail
+        self.meter_reads = 0
+
+    async def login(self):
+        return self
+
+    def is_active(self, zaehlpunkt):
+        return True
+
+    def _values(self, start: dt.datetime, end: dt.datetime) -> list[dict]:
+        values, quarter = [], start
+        while quarter < end:
+            hour = quarter.replace(minute=0)
+            values.append({
+                "wert": None if self.usage(hour) is None else self.usage(hour) / 4,
+                "zeitpunktVon": quarter.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                "zeitpunktBis": (quarter + dt.timedelta(minutes=15)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                "geschaetzt": False,
+            })
+            quarter += dt.timedelta(minutes=15)
+        return values
+
+    async def get_bewegungsdaten(self, zaehlpunkt, start, last_day, granularity=ValueType.QUARTER_HOUR, cached=True):
+        self.requests.append((start, last_day, cached))
+        end = dt.datetime.combine(last_day + dt.timedelta(days=1), dt.time(), dt.timezone.utc)
+        return {"unitOfMeasurement": "KWH", "values": self._values(start, end)}
+
+    async def find_first_data(self, zaehlpunkt, start, end):
+        return self.first_data
+
+    async def iter_bewegungsdaten_windows(self, zaehlpunkt, start, end, granularity=ValueType.QUARTER_HOUR):
+        """Windows of window_days (values until the end, as the days after it are not published yet)"""
+        window_start = start
+        while window_start.date() <= end.date():
+            last_day = min(window_start.date() + dt.timedelta(days=self.window_days - 1), end.date())
+            self.requests.append((window_start, last_day, True))
+            if self.fail_from is not None and window_start >= self.fail_from:
+                raise RuntimeError("Cannot access bewegungsdaten")
+            window_end = min(dt.datetime.combine(last_day + dt.timedelta(days=1), dt.time(), dt.timezone.utc), end)
+            values = self._values(window_start, window_end)
+
+            async def batches(values=values):
+                for offset in range(0, len(values), 96):
+                    yield values[offset:offset + 96]
+
+            yield window_start, last_day, {"unitOfMeasurement": "KWH"}, batches()
+            window_start = dt.datetime.combine(last_day + dt.timedelta(days=1), dt.time(), dt.timezone.utc)
+
+    async def get_historic_data(self, zaehlpunkt, date_from, date_to, granularity):
+        assert ValueType.METER_READ == granularity
+        self.meter_reads += 1
+        values, reading, day = [], 1000.0, date_from
+        while day <= date_to:
+            midnight = dt_util.start_of_local_day(day)
+            values.append({"zeitVon": midnight.isoformat(), "zeitBis": midnight.isoformat(), "messwert": round(reading, 3)})
+            hour = midnight
+            while hour < dt_util.start_of_local_day(day + dt.timedelta(days=1)):
+                reading += self.meter_usage(dt_util.as_utc(hour))
+                hour += dt.timedelta(hours=1)
+            day += dt.timedelta(days=1)
+        return {"unitOfMeasurement": "KWH", "values": values}
+
+
+@pytest.fixture
+async def import_state(recorder_mock, hass):
+    state = ImportStateStore(hass, "test")
+    await state.async_load()
+    return state
+
+
+def importer(hass, smartmeter, import_state) -> Importer:
+    return Importer(hass, smartmeter, ZAEHLPUNKT, "kWh", ValueType.QUARTER_HOUR, import_state)
+
+
+async def write_hours(hass, imp: Importer, start: dt.datetime, end: dt.datetime, usage, missing=()):
+    """Writes hourly statistics of usage(hour) kWh from start until end (without the missing hours)"""
+    rows, total, hour = [], 0, start
+    while hour < end:
+        if hour not in missing:
+            total += to_milli_wh(usage(hour))
+            rows.append((hour, to_milli_wh(usage(hour)), total))
+        hour += dt.timedelta(hours=1)
+    writer = StatisticsWriter(hass, imp.get_statistics_metadata())
+    for statistics in _statistics([rows]):
+        await writer.write(statistics)
+    await writer.flush()
+    imp._remember_last_statistic(end, total)
+
+
+async def daily_changes(hass, start: dt.datetime, end: dt.datetime) -> dict[dt.date, float]:
+    rows = await get_instance(hass).async_add_executor_job(
+        statistics_during_period, hass, start, end, {STATISTIC_ID}, "day", None, {"change"})
+    return {dt_util.as_local(dt_util.utc_from_timestamp(row["start"])).date(): round(row["change"], 3)
+            for row in rows.get(STATISTIC_ID, [])}
+
+
+def local_days(today: dt.date, first: int, last: int) -> tuple[dt.datetime, dt.datetime]:
+    """Start of the local day today - first until the start of today - last"""
+    return (dt_util.as_utc(dt_util.start_of_local_day(today - dt.timedelta(days=first))),
+            dt_util.as_utc(dt_util.start_of_local_day(today - dt.timedelta(days=last))))
+
+
+def hours_of(day: dt.date) -> int:
+    return int((dt_util.start_of_local_day(day + dt.timedelta(days=1)) - dt_util.start_of_local_day(day)).total_seconds() // 3600)
+
+
+async def test_reconcile_refetches_differing_days_bypassing_the_cache(recorder_mock, hass, import_state):
+    today = dt_util.now().date()
+    day = today - dt.timedelta(days=5)
+    start, end = local_days(today, 7, 3)
+    smartmeter = FakeSmartmeter(usage=lambda hour: 0.4)
+    imp = importer(hass, smartmeter, import_state)
+    # the statistics of the day were imported with wrong values (e.g. from a stale cache)
+    day_start, day_end = local_days(today, 5, 4)
+    await write_hours(hass, imp, start, end, lambda hour: 0.3 if day_start <= hour < day_end else 0.4)
+
+    await imp._reconcile()
+
+    assert smartmeter.requests and all(not cached for _, _, cached in smartmeter.requests)
+    changes = await daily_changes(hass, start, end)
+    assert pytest.approx(hours_of(day) * 0.4) == changes[day]
+    assert pytest.approx(hours_of(day + dt.timedelta(days=1)) * 0.4) == changes[day + dt.timedelta(days=1)]
+    assert {} == (import_state.get(STATISTIC_ID, "unreconcilable") or {})
+
+
+async def test_reconcile_marks_days_still_differing_unreconcilable(recorder_mock, hass, import_state):
+    today = dt_util.now().date()
+    day = today - dt.timedelta(days=5)
+    start, end = local_days(today, 7, 3)
+    day_start, day_end = local_days(today, 5, 4)
+    # the meter readings count 0.1 kWh per hour more than the quarter hours published
+    smartmeter = FakeSmartmeter(usage=lambda hour: 0.3 if day_start <= hour < day_end else 0.4,
+                                meter_usage=lambda hour: 0.4)
+    imp = importer(hass, smartmeter, import_state)
+    await write_hours(hass, imp, start, end, smartmeter.usage)
+
+    await imp._reconcile()
+
+    assert {day.isoformat(): to_milli_wh(hours_of(day) * 0.4)} == import_state.get(STATISTIC_ID, "unreconcilable")
+    # not fetched again while the readings do not change
+    smartmeter.requests.clear()
+    import_state.set(STATISTIC_ID, "reconciled", None)
+    await imp._reconcile()
+    assert [] == smartmeter.requests
+
+
+async def test_remembered_last_statistic_is_checked_against_the_recorder_after_a_start(recorder_mock, hass, import_state):
+    today = dt_util.now().date()
+    start, end = local_days(today, 7, 3)
+    imp = importer(hass, FakeSmartmeter(), import_state)
+    await write_hours(hass, imp, start, end, lambda hour: 0.4)
+    # remembered before the last days were purged from the recorder (while Home Assistant was stopped)
+    purged = {"end": (end + dt.timedelta(days=2)).isoformat(), "sum_mwh": to_milli_wh(999.0)}
+    import_state.set(STATISTIC_ID, "last", purged)
+    import_state.set(STATISTIC_ID, "checkpoint", {"last_day": today.isoformat(), "sum_mwh": 1, "pending": []})
+
+    last = await imp._async_get_last_statistic()
+
+    assert end.timestamp() == last[STATISTIC_ID][0]["end"]
+    assert end.isoformat() == import_state.get(STATISTIC_ID, "last")["end"]
+    assert import_state.get(STATISTIC_ID, "checkpoint") is None
+    # checked once per start, the remembered statistic is used from now on
+    import_state.set(STATISTIC_ID, "last", purged)
+    assert (end + dt.timedelta(days=2)).timestamp() == (await imp._async_get_last_statistic())[STATISTIC_ID][0]["end"]
+
+
+async def test_remembered_last_statistic_without_statistics_is_dropped(recorder_mock, hass, import_state):
+    imp = importer(hass, FakeSmartmeter(), import_state)
+    import_state.set(STATISTIC_ID, "last", {"end": dt_util.utcnow().isoformat(), "sum_mwh": 1})
+
+    last = await imp._async_get_last_statistic()
+
+    assert not imp.is_last_inserted_stat_valid(last)
+    assert import_state.get(STATISTIC_ID, "last") is None
+
+
+async def hourly_sums(hass, start: dt.datetime, end: dt.datetime) -> dict[dt.datetime, tuple[float, float]]:
+    rows = await get_instance(hass).async_add_executor_job(
+        statistics_during_period, hass, start, end, {STATISTIC_ID}, "hour", None, {"state", "sum"})
+    return {dt_util.utc_from_timestamp(row["start"]): (round(row["state"], 3), round(row["sum"], 3))
+            for row in rows.get(STATISTIC_ID, [])}
+
+
+@pytest.fixture
+def adjustments(hass, monkeypatch) -> list:
+    """The calls of async_adjust_statistics (passed on to the recorder)"""
+    recorder, calls = get_instance(hass), []
+    adjust = recorder.async_adjust_statistics
+
+    def spy(statistic_id, start_time, sum_adjustment, unit):
+        calls.append((start_time, round(sum_adjustment, 3)))
+        adjust(statistic_id, start_time, sum_adjustment, unit)
+
+    monkeypatch.setattr(recorder, "async_adjust_statistics", spy)
+    return calls
+
+
+async def test_replace_hours_shifts_the_sums_with_a_single_adjustment(recorder_mock, hass, import_state, adjustments):
+    start, end = local_days(dt_util.now().date(), 4, 1)
+    imp = importer(hass, FakeSmartmeter(), import_state)
+    await write_hours(hass, imp, start, end, lambda hour: 0.4)
+    first, second = start + dt.timedelta(hours=5), start + dt.timedelta(hours=30)
+    known = await imp._async_get_hourly_statistics(start, end, [first, second])
+
+    result = await imp._replace_hours(known, {first: to_milli_wh(0.5), second: to_milli_wh(0.2)})
+    await get_instance(hass).async_block_till_done()
+
+    assert [(second + dt.timedelta(hours=1), -0.1)] == adjustments
+    assert {first: (to_milli_wh(0.5), to_milli_wh(6 * 0.4 + 0.1)),
+            second: (to_milli_wh(0.2), to_milli_wh(31 * 0.4 - 0.1))} == result
+    sums = await hourly_sums(hass, start, end)
+    hour, total = start, 0
+    while hour < end:
+        usage = 0.5 if hour == first else 0.2 if hour == second else 0.4
+        total += usage
+        assert (usage, round(total, 3)) == sums[hour], hour
+        hour += dt.timedelta(hours=1)
+    assert to_milli_wh(total) == import_state.get(STATISTIC_ID, "last")["sum_mwh"]
+
+
+async def test_replace_hours_without_changes_writes_nothing(recorder_mock, hass, import_state, adjustments):
+    start, end = local_days(dt_util.now().date(), 2, 1)
+    imp = importer(hass, FakeSmartmeter(), import_state)
+    await write_hours(hass, imp, start, end, lambda hour: 0.4)
+    known = await imp._async_get_hourly_statistics(start, end, [start])
+
+    assert known == await imp._replace_hours(known, {start: to_milli_wh(0.4)})
+    assert [] == adjustments
+
+
+async def test_estimated_hours_are_revised(recorder_mock, hass, import_state, adjustments):
+    start, end = local_days(dt_util.now().date(), 3, 1)
+    estimated = {start + dt.timedelta(hours=hours) for hours in (2, 3, 26)}
+    smartmeter = FakeSmartmeter(usage=lambda hour: 0.4)
+    imp = importer(hass, smartmeter, import_state)
+    await write_hours(hass, imp, start, end, lambda hour: 0.1 if hour in estimated else 0.4)
+    import_state.set(STATISTIC_ID, "estimated", {
+        hour.isoformat(): list(usage_sum) for hour, usage_sum in
+        (await imp._async_get_hourly_statistics(start, end, estimated)).items()})
+
+    await imp._revise_estimated_hours()
+    await get_instance(hass).async_block_till_done()
+
+    assert 1 == len(adjustments)
+    assert import_state.get(STATISTIC_ID, "estimated") is None
+    sums = await hourly_sums(hass, start, end)
+    assert all(0.4 == usage for usage, _ in sums.values())
+    assert pytest.approx(len(sums) * 0.4) == sums[end - dt.timedelta(hours=1)][1]
+
+
+def epochs(*datetimes: dt.datetime) -> list[int]:
+    return [int(datetime.timestamp()) for datetime in datetimes]
+
+
+async def test_gap_is_fetched_in_a_minimal_window_and_the_missing_hour_inserted(recorder_mock, hass, import_state):
+    start, end = local_days(dt_util.now().date(), 5, 1)
+    missing = start + dt.timedelta(days=2, hours=5)
+    smartmeter = FakeSmartmeter(usage=lambda hour: 0.4)
+    imp = importer(hass, smartmeter, import_state)
+    await write_hours(hass, imp, start, end, lambda hour: 0.4, missing={missing})
+    import_state.set(STATISTIC_ID, "coverage", [
+        epochs(start, missing), epochs(missing + dt.timedelta(hours=1), end)])
+
+    await imp._fill_gaps()
+    await get_instance(hass).async_block_till_done()
+
+    # only the (UTC) day of the gap is fetched
+    day = missing.date()
+    assert [(dt.datetime.combine(day, dt.time(), dt.timezone.utc), day, True)] == smartmeter.requests
+    sums = await hourly_sums(hass, start, end)
+    assert 0.4 == sums[missing][0]
+    hour, total = start, 0
+    while hour < end:
+        total += 0.4
+        assert pytest.approx(total) == sums[hour][1], hour
+        hour += dt.timedelta(hours=1)
+    assert to_milli_wh(total) == import_state.get(STATISTIC_ID, "last")["sum_mwh"]
+    assert [epochs(start, end)] == import_state.get(STATISTIC_ID, "coverage")
+    assert import_state.get(STATISTIC_ID, "unfillable") is None
+
+
+async def test_permanently_missing_quarter_hours_are_not_fetched_again(recorder_mock, hass, import_state):
+    start, end = local_days(dt_util.now().date(), 3, 1)
+    missing = start + dt.timedelta(hours=5)
+    smartmeter = FakeSmartmeter(usage=lambda hour: None if hour == missing else 0.4)
+    imp = importer(hass, smartmeter, import_state)
+    await write_hours(hass, imp, start, end, lambda hour: 0.4, missing={missing})
+    import_state.set(STATISTIC_ID, "coverage", [
+        epochs(start, missing), epochs(missing + dt.timedelta(hours=1), end)])
+
+    await imp._fill_gaps()
+    assert 1 == len(smartmeter.requests)
+    assert [epochs(missing, missing + dt.timedelta(hours=1))] == import_state.get(STATISTIC_ID, "unfillable")
+
+    # the next check skips the gap
+    import_state.set(STATISTIC_ID, "gaps_checked", None)
+    await imp._fill_gaps()
+    assert 1 == len(smartmeter.requests)
+
+
+async def test_interrupted_import_resumes_from_the_checkpoint(recorder_mock, hass, import_state):
+    end = dt.datetime.now(dt.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    first_data = end - dt.timedelta(days=20)
+    fail_from = first_data + dt.timedelta(days=10)
+    smartmeter = FakeSmartmeter(first_data=first_data, fail_from=fail_from)
+
+    # raised, so that the scheduler backs off
+    with pytest.raises(RuntimeError, match="Cannot access bewegungsdaten"):
+        await importer(hass, smartmeter, import_state).async_import({})
+
+    # the two windows before the failure are imported and checkpointed
+    checkpoint = import_state.get(STATISTIC_ID, "checkpoint")
+    assert [[fail_from.isoformat(), end.isoformat()]] == checkpoint["pending"]
+    assert to_milli_wh(10 * 24 * 0.4) == checkpoint["sum_mwh"]
+    sums = await hourly_sums(hass, first_data, end)
+    assert fail_from - dt.timedelta(hours=1) == max(sums)
+    assert pytest.approx(10 * 24 * 0.4) == sums[max(sums)][1]
+    # the last statistic is remembered along with the checkpoint
+    assert {"end": fail_from.isoformat(), "sum_mwh": to_milli_wh(10 * 24 * 0.4)} == import_state.get(STATISTIC_ID, "last")
+
+    # e.g. after a restart, the remembered last statistic matches the recorder's and the checkpoint is kept
+    import_state.verified.clear()
+    await importer(hass, smartmeter, import_state)._async_get_last_statistic()
+    assert checkpoint == import_state.get(STATISTIC_ID, "checkpoint")
+    smartmeter.fail_from, smartmeter.requests = None, []
+    await importer(hass, smartmeter, import_state).async_import({})
+
+    windows = [(start, last_day) for start, last_day, _ in smartmeter.requests if isinstance(start, dt.datetime)]
+    assert fail_from == windows[0][0]
+    assert first_data not in [start for start, _ in windows]
+    assert import_state.get(STATISTIC_ID, "checkpoint") is None
+    sums = await hourly_sums(hass, first_data, end)
+    assert 20 * 24 == len(sums)
+    hour, total = first_data, 0
+    while hour < end:
+        total += 0.4
+        assert pytest.approx(total) == sums[hour][1], hour
+        hour += dt.timedelta(hours=1)
+    assert {"end": end.isoformat(), "sum_mwh": to_milli_wh(20 * 24 * 0.4)} == import_state.get(STATISTIC_ID, "last")
+
+
+async def test_statistics_writer_waits_for_the_recorder_between_batches(recorder_mock, hass, import_state, monkeypatch):
+    start, end = local_days(dt_util.now().date(), 3, 1)
+    imp = importer(hass, FakeSmartmeter(), import_state)
+    recorder, events = get_instance(hass), []
+    block_till_done = recorder.async_block_till_done
+
+    async def spy_block_till_done():
+        events.append("wait")
+        await block_till_done()
+
+    def spy_add_external_statistics(hass, metadata, statistics):
+        events.append(len(statistics))
+        async_add_external_statistics(hass, metadata, statistics)
+
+    monkeypatch.setattr(recorder, "async_block_till_done", spy_block_till_done)
+    monkeypatch.setattr("wnsm.importer.async_add_external_statistics", spy_add_external_statistics)
+
+    writer = StatisticsWriter(hass, imp.get_statistics_metadata(), expected=48, batch_size=20)
+    hours = [start + dt.timedelta(hours=offset) for offset in range(48)]
+    for offset in range(0, 48, 7):
+        await writer.write([{"start": hour, "state": 0.4, "sum": 0.4 * (index + 1)}
+                            for index, hour in enumerate(hours[offset:offset + 7], offset)])
+    # full batches are written while writing, each after the previous one was committed
+    assert [20, "wait", 20] == events
+    await writer.flush()
+
+    assert [20, "wait", 20, "wait", 8, "wait"] == events
+    assert 48 == writer.written
+    assert hours[-1] == writer.last["start"]
+    sums = await hourly_sums(hass, start, end)
+    assert pytest.approx(48 * 0.4) == sums[hours[-1]][1]
+
+
+async def meter_reading_setup(hass, import_state, hours_after_midnight: int = 5):
+    """Statistics of 0.4 kWh per hour until hours after the last midnight, returns the importer and the reading then"""
+    today = dt_util.now().date()
+    start, midnight = local_days(today, 4, 0)
+    smartmeter = FakeSmartmeter()
+    imp = importer(hass, smartmeter, import_state)
+    await write_hours(hass, imp, start, midnight + dt.timedelta(hours=hours_after_midnight), lambda hour: 0.4)
+    # the latest meter reading is taken at the last midnight, the readings are requested from two days before
+    at_midnight = 1000 + 0.4 * (hours_of(today - dt.timedelta(days=2)) + hours_of(today - dt.timedelta(days=1)))
+    return imp, smartmeter, midnight, at_midnight
+
+
+async def test_meter_reading_is_derived_from_the_anchor(recorder_mock, hass, import_state):
+    imp, smartmeter, midnight, at_midnight = await meter_reading_setup(hass, import_state)
+
+    assert pytest.approx(at_midnight + 5 * 0.4) == await imp.async_meter_reading()
+    anchor = import_state.get(STATISTIC_ID, "anchor")
+    assert midnight == dt_util.parse_datetime(anchor["at"])
+    assert to_milli_wh(at_midnight) == anchor["reading_mwh"]
+
+    # further imports move the reading without requesting the meter readings again
+    imp._remember_last_statistic(midnight + dt.timedelta(hours=6), int(import_state.get(STATISTIC_ID, "last")["sum_mwh"]) + to_milli_wh(0.4))
+    assert pytest.approx(at_midnight + 6 * 0.4) == await imp.async_meter_reading()
+    assert 1 == smartmeter.meter_reads
+
+
+async def test_meter_reading_is_re_anchored_if_it_drifted(recorder_mock, hass, import_state, caplog):
+    imp, smartmeter, midnight, at_midnight = await meter_reading_setup(hass, import_state)
+    statistics_sum = int(import_state.get(STATISTIC_ID, "last")["sum_mwh"]) - to_milli_wh(5 * 0.4)
+    # anchored a day ago with a reading 1 kWh too low
+    import_state.set(STATISTIC_ID, "anchor", {
+        "at": (midnight - dt.timedelta(days=1)).isoformat(), "reading_mwh": to_milli_wh(at_midnight - 1 - 24 * 0.4),
+        "sum_mwh": statistics_sum - to_milli_wh(24 * 0.4),
+        "anchored": (dt_util.utcnow() - dt.timedelta(hours=25)).isoformat(),
+    })
+
+    assert pytest.approx(at_midnight + 5 * 0.4) == await imp.async_meter_reading()
+
+    assert "drifted by 1.0 kWh, re-anchoring" in caplog.text
+    anchor = import_state.get(STATISTIC_ID, "anchor")
+    assert (midnight, to_milli_wh(at_midnight), statistics_sum) == (
+        dt_util.parse_datetime(anchor["at"]), anchor["reading_mwh"], anchor["sum_mwh"])
+
+
+async def test_meter_reading_without_statistics_until_the_reading(recorder_mock, hass, import_state):
+    imp, smartmeter, midnight, at_midnight = await meter_reading_setup(hass, import_state, hours_after_midnight=-30)
+
+    # the reading as it is, nothing to anchor it to
+    assert pytest.approx(at_midnight) == await imp.async_meter_reading()
+    assert import_state.get(STATISTIC_ID, "anchor") is None
+    assert 1 == smartmeter.meter_reads
+
+
+async def test_meter_reading_with_an_invalid_anchor_is_requested_again(recorder_mock, hass, import_state):
+    imp, smartmeter, midnight, at_midnight = await meter_reading_setup(hass, import_state)
+    # a fresh anchor, but at a sum above the statistics (they were replaced since)
+    import_state.set(STATISTIC_ID, "anchor", {
+        "at": midnight.isoformat(), "reading_mwh": to_milli_wh(at_midnight), "sum_mwh": to_milli_wh(10000),
+        "anchored": dt_util.utcnow().isoformat(),
+    })
+
+    assert pytest.approx(at_midnight + 5 * 0.4) == await imp.async_meter_reading()
+    assert 1 == smartmeter.meter_reads
+    assert to_milli_wh(10000) != import_state.get(STATISTIC_ID, "anchor")["sum_mwh"]
+
+
+async def test_meter_reading_without_any_reading(recorder_mock, hass, import_state):
+    imp, smartmeter, *_ = await meter_reading_setup(hass, import_state)
+
+    async def no_readings(*args):
+        return {"unitOfMeasurement": "KWH", "values": [{"zeitVon": None, "zeitBis": None, "messwert": None}]}
+
+    smartmeter.get_historic_data = no_readings
+    assert await imp.async_meter_reading() is None
@@ -0,0 +1,207 @@
+import asyncio
+import datetime as dt
+
+import pytest
+from homeassistant.util import dt as dt_util
+from pytest_homeassistant_custom_component.common import MockConfigEntry, async_fire_time_changed
+
+import it  # noqa: F401
+from wnsm import scheduler
+from wnsm.api.constants import ValueType
+from wnsm.const import DOMAIN
+from wnsm.scheduler import BACKOFF_MIN, DEFAULT_PUBLICATION_OFFSET, OVERDUE_POLL_MIN, ImportScheduler
+from wnsm.storage import ImportStateStore
+
+
+class FakeImporter:
+    """Records the imports, which block until released (or raise fail, if set)"""
+    running: list[str] = []
+    imported: list[str] = []
+    max_running = 0
+    release: asyncio.Event
+    fail: Exception | None = None
+
+    def __init__(self, hass, async_smartmeter, zaehlpunkt, unit_of_measurement, granularity, import_state):
+        self.zaehlpunkt = zaehlpunkt
+        self.id = f"{DOMAIN}:{zaehlpunkt.lower()}"
+
+    async def async_import(self, details):
+        cls = type(self)
+        cls.running.append(self.zaehlpunkt)
+        cls.max_running = max(cls.max_running, len(cls.running))
+        try:
+            await cls.release.wait()
+            if cls.fail is not None:
+                raise cls.fail
+            cls.imported.append(self.zaehlpunkt)
+        finally:
+            cls.running.remove(self.zaehlpunkt)
+
+
+@pytest.fixture
+def importer(monkeypatch):
+    FakeImporter.running, FakeImporter.imported, FakeImporter.max_running = [], [], 0
+    FakeImporter.release, FakeImporter.fail = asyncio.Event(), None
+    monkeypatch.setattr(scheduler, "Importer", FakeImporter)
+    return FakeImporter
+
+
+@pytest.fixture
+async def import_scheduler(hass, importer):
+    entry = MockConfigEntry(domain=DOMAIN)
+    import_state = ImportStateStore(hass, entry.entry_id)
+    import_scheduler = ImportScheduler(hass, entry, None, import_state, concurrency=2)
+    yield import_scheduler
+    import_scheduler.async_stop()
+
+
+async def until(condition) -> None:
+    """Waits (briefly) for the background imports to reach the condition"""
+    async with asyncio.timeout(1):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+
+def schedule(import_scheduler: ImportScheduler, zaehlpunkt: str) -> bool:
+    return import_scheduler.async_schedule(zaehlpunkt, {}, "kWh", ValueType.QUARTER_HOUR)
+
+
+async def test_imports_are_queued_without_waiting(hass, import_scheduler, importer):
+    assert schedule(import_scheduler, "AT1")
+
+    await until(lambda: importer.running)
+    assert ["AT1"] == importer.running
+    importer.release.set()
+    await until(lambda: importer.imported)
+    assert ["AT1"] == importer.imported
+
+
+async def test_queued_import_is_not_queued_twice(hass, import_scheduler, importer):
+    assert schedule(import_scheduler, "AT1")
+    assert not schedule(import_scheduler, "AT1")
+    await until(lambda: importer.running)
+    # neither while it is running
+    assert not schedule(import_scheduler, "AT1")
+
+    importer.release.set()
+    await until(lambda: not import_scheduler._jobs)
+    assert ["AT1"] == importer.imported
+    # nor before it is due again
+    assert not schedule(import_scheduler, "AT1")
+
+
+async def test_imports_are_limited_to_the_concurrency(hass, import_scheduler, importer):
+    for zaehlpunkt in ("AT1", "AT2", "AT3", "AT4", "AT5"):
+        assert schedule(import_scheduler, zaehlpunkt)
+    await until(lambda: len(importer.running) == 2)
+    await asyncio.sleep(0.05)
+    assert 2 == len(importer.running)
+
+    importer.release.set()
+    await until(lambda: len(importer.imported) == 5)
+    assert 2 == importer.max_running
+    assert ["AT1", "AT2", "AT3", "AT4", "AT5"] == sorted(importer.imported)
+
+
+async def test_stop_cancels_running_imports(hass, import_scheduler, importer):
+    schedule(import_scheduler, "AT1")
+    schedule(import_scheduler, "AT2")
+    await until(lambda: len(importer.running) == 2)
+
+    import_scheduler.async_stop()
+    await until(lambda: not importer.running)
+
+    assert [] == importer.running
+    assert [] == importer.imported
+    assert import_scheduler._cancel_wakeup is None
+
+
+@pytest.mark.parametrize("error", [RuntimeError("Cannot access bewegungsdaten"), TimeoutError()])
+async def test_failed_import_is_retried_on_its_own(hass, import_scheduler, importer, error):
+    importer.fail = error
+    importer.release.set()
+    schedule(import_scheduler, "AT1")
+    await until(lambda: "AT1" in import_scheduler._next_run)
+    assert [] == importer.imported
+
+    importer.fail = None
+    async_fire_time_changed(hass, dt_util.utcnow() + BACKOFF_MIN + dt.timedelta(seconds=1))
+    await until(lambda: importer.imported)
+
+    # without the sensors being refreshed (i.e. the import scheduled) again
+    assert ["AT1"] == importer.imported
+
+
+STATISTIC_ID = f"{DOMAIN}:at1"
+
+
+def at(day: dt.date, hours: float) -> dt.datetime:
+    """hours after the local midnight starting day, in UTC"""
+    return dt_util.as_utc(dt_util.start_of_local_day(day) + dt.timedelta(hours=hours))
+
+
+def imported(import_scheduler: ImportScheduler, before: dt.datetime | None, last: dt.datetime | None,
+             started: dt.datetime, failed: bool = False) -> dt.datetime:
+    """Plans the next import after an import (started at started) that moved the last statistic from before to last"""
+    if last is not None:
+        import_scheduler.import_state.set(STATISTIC_ID, "last", {"end": last.isoformat(), "sum_mwh": 1})
+    import_scheduler._plan("AT1", STATISTIC_ID, before and {"end": before.isoformat(), "sum_mwh": 1}, started, failed)
+    return import_scheduler._next_run["AT1"]
+
+
+async def test_failed_imports_grow_the_back_off(hass, import_scheduler, freezer):
+    today = dt_util.now().date()
+    freezer.move_to(at(today, 10))
+    yesterday = at(today - dt.timedelta(days=1), 0)
+
+    assert at(today, 10) + BACKOFF_MIN == imported(import_scheduler, yesterday, None, at(today, 10), failed=True)
+    assert at(today, 10) + 2 * BACKOFF_MIN == imported(import_scheduler, yesterday, None, at(today, 10), failed=True)
+    # a successful import resets the back-off
+    imported(import_scheduler, yesterday, at(today, 0), at(today, 10))
+    assert at(today, 10) + BACKOFF_MIN == imported(import_scheduler, at(today, 0), None, at(today, 10), failed=True)
+
+
+async def test_successful_imports_do_not_back_off(hass, import_scheduler, freezer):
+    today = dt_util.now().date()
+    tomorrow = today + dt.timedelta(days=1)
+    freezer.move_to(at(today, 10))
+
+    # part of today imported: waits for the rest of it
+    assert at(tomorrow, 0) + DEFAULT_PUBLICATION_OFFSET == imported(
+        import_scheduler, at(today, 0), at(today, 8), at(today, 10))
+    # yesterday is overdue: polled after as long as it is overdue, as often as it is not found
+    yesterday = at(today - dt.timedelta(days=1), 0)
+    overdue = at(today, 10) - at(today, 0) - DEFAULT_PUBLICATION_OFFSET
+    for _ in range(3):
+        assert at(today, 10) + overdue == imported(import_scheduler, yesterday, yesterday, at(today, 10))
+    freezer.move_to(at(today, 6) + dt.timedelta(minutes=5))
+    assert at(today, 6) + dt.timedelta(minutes=5) + OVERDUE_POLL_MIN == imported(
+        import_scheduler, yesterday, yesterday, at(today, 6))
+    assert {} == import_scheduler._failures
+
+
+async def test_publication_is_learned_from_when_the_day_was_first_seen(hass, import_scheduler, freezer):
+    today = dt_util.now().date()
+    yesterday = at(today - dt.timedelta(days=1), 0)
+    freezer.move_to(at(today, 9))
+
+    # not published at 05:00 yet, found by the import started at 07:00 (and finishing at 09:00)
+    imported(import_scheduler, yesterday, yesterday, at(today, 5))
+    next_run = imported(import_scheduler, yesterday, at(today, 0), at(today, 7))
+
+    assert [6 * 3600] == import_scheduler.import_state.get(STATISTIC_ID, "publication")
+    assert at(today + dt.timedelta(days=1), 6) == next_run
+
+    # without a previous import that missed it, the start of the import that found it
+    imported(import_scheduler, at(today, 0), at(today + dt.timedelta(days=1), 0), at(today + dt.timedelta(days=1), 7.5))
+    assert [6 * 3600, 7.5 * 3600] == import_scheduler.import_state.get(STATISTIC_ID, "publication")
+
+
+async def test_publication_is_not_learned_from_a_partial_day(hass, import_scheduler, freezer):
+    today = dt_util.now().date()
+    freezer.move_to(at(today, 9))
+
+    imported(import_scheduler, at(today - dt.timedelta(days=1), 0), at(today, 0), at(today, 7))
+    imported(import_scheduler, at(today, 0), at(today, 8), at(today, 9))
+
+    assert [7 * 3600] == import_scheduler.import_state.get(STATISTIC_ID, "publication")
@@ -0,0 +1,105 @@
+"""
+Compares the aggregation of bewegungsdaten into hourly statistics:
+the former per-value Decimal loop against the integer milli-Wh engine (NumPy and plain Python).
+"""
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from operator import itemgetter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'custom_components'))
+from wnsm import aggregation  # noqa: E402
+from wnsm.aggregation import aggregate_hourly  # noqa: E402
+
+
+def generate(days: int, seed: int = 42) -> list[dict]:
+    """Quarter hour bewegungsdaten of the given number of days, as returned by the API"""
+    rnd = random.Random(seed)
+    start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    return [
+        {
+            "wert": round(rnd.gauss(0.045, 0.015), 3),
+            "zeitpunktVon": (start + timedelta(minutes=15 * i)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            "zeitpunktBis": (start + timedelta(minutes=15 * (i + 1))).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            "geschaetzt": False,
+        }
+        for i in range(days * 96)
+    ]
+
+
+def decimal_loop(values: list[dict], start: datetime) -> list[tuple]:
+    """The importer's aggregation before the milli-Wh engine"""
+    from homeassistant.util import dt as dt_util
+    dates = defaultdict(Decimal)
+    last_ts = start
+    for value in values:
+        ts = dt_util.parse_datetime(value['zeitpunktVon'])
+        if ts < last_ts:
+            continue
+        last_ts = ts
+        if value['wert'] is None:
+            continue
+        reading = Decimal(value['wert'] * 1.0)
+        if ts.minute % 15 != 0 or ts.second != 0 or ts.microsecond != 0:
+            pass  # was only logged
+        dates[ts.replace(minute=0)] += reading
+    total_usage = Decimal(0)
+    statistics = []
+    for ts, usage in sorted(dates.items(), key=itemgetter(0)):
+        total_usage += usage
+        statistics.append((ts, float(total_usage), float(usage)))
+    return statistics
+
+
+def milli_wh(values: list[dict], start: datetime) -> list[tuple]:
+    hourly = aggregate_hourly(values, start=start)
+    return [(ts, aggregation.from_milli_wh(s), aggregation.from_milli_wh(u))
+            for ts, u, s in zip(hourly.hours, hourly.usage, hourly.sums)]
+
+
+def measure(func, values, start, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        began = time.perf_counter()
+        func(values, start)
+        best = min(best, time.perf_counter() - began)
+    return best
+
+
+def benchmark(days: int, repeat: int):
+    values = generate(days)
+    start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    print(f"{len(values)} quarter hour values ({days} days), best of {repeat} runs")
+
+    baseline = measure(decimal_loop, values, start, repeat)
+    print(f"  Decimal loop:         {baseline * 1000:9.1f} ms")
+    results = {}
+    numpy = aggregation.np
+    for name in ("numpy", "python"):
+        if name == "numpy" and numpy is None:
+            continue
+        aggregation.np = numpy if name == "numpy" else None
+        try:
+            results[name] = measure(milli_wh, values, start, repeat)
+        finally:
+            aggregation.np = numpy
+        print(f"  milli-Wh ({name + '):':8} {results[name] * 1000:9.1f} ms  ({baseline / results[name]:.1f}x)")
+
+    # Same hours, and the running sum without the Decimal(float) error
+    expected, actual = decimal_loop(values, start), milli_wh(values, start)
+    assert [row[0] for row in expected] == [row[0] for row in actual]
+    exact = sum(round(v["wert"] * 1000) for v in values) / 1000
+    print(f"  final sum: Decimal loop {expected[-1][1]!r}, milli-Wh {actual[-1][1]!r}, exact {exact!r}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the aggregation of bewegungsdaten into hourly statistics')
+    parser.add_argument('-d', '--days', type=int, help='Number of days of quarter hour data', default=3 * 365)
+    parser.add_argument('-r', '--repeat', type=int, help='Number of runs (the best one is reported)', default=3)
+    args = parser.parse_args()
+    benchmark(args.days, args.repeat)
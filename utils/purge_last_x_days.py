@@ -1,3 +1,6 @@
+import glob
+import json
+import os
 import sqlite3
 
 
@@ -20,11 +23,37 @@ def purge(database:str, days: int, sensor_id: str):
     conn.commit()
     conn.close()
 
+
+def forget_import_state(storage: str, sensor_id: str):
+    """
+    Drops what the integration remembers of the statistic's end (its last sum and the checkpoint of an interrupted
+    import), so that the next import continues from the database again. The rest of the import state is kept.
+    Home Assistant has to be stopped, it would overwrite the files otherwise.
+    """
+    for path in glob.glob(os.path.join(storage, "wnsm.import.*")):
+        with open(path, encoding="utf-8") as file:
+            content = json.load(file)
+        state = content.get("data", {}).get(sensor_id)
+        if not state:
+            continue
+        dropped = [key for key in ("last", "checkpoint") if state.pop(key, None) is not None]
+        if dropped:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(content, file, indent=4)
+            print(f"Dropped {', '.join(dropped)} of {sensor_id} from {path}")
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description='Purge the last x days of data from the statistics table')
     parser.add_argument('-db', '--database', type=str, help='Path to the SQLite database', default="home-assistant_v2.db")
     parser.add_argument('-d', '--days', type=int, help='Number of days to keep', default=2)
     parser.add_argument('-s', '--sensor', type=str, help='Name in the statistics_meta table', default="sensor.at00100000000000000010000XXXXXXX_statistics")
+    parser.add_argument('--storage', type=str, help='Path to the .storage directory of Home Assistant, the remembered '
+                        'end of the imported statistics is dropped there as well (default: next to the database)', default=None)
+    parser.add_argument('--keep-import-state', action='store_true', help='Do not touch the import state in the .storage directory')
     args = parser.parse_args()
     purge(args.database, args.days, args.sensor)
+    if not args.keep_import_state:
+        storage = args.storage or os.path.join(os.path.dirname(os.path.abspath(args.database)), ".storage")
+        forget_import_state(storage, args.sensor)